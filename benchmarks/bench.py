@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""Offline benchmarks for the ci-configurator hooks.
+
+Runs the expensive parts of the hooks against local stand-ins for Gerrit,
+Jenkins and Launchpad (see fakes.py) and reports throughput and latency at
+several sizes:
+
+    $ make bench
+    $ PYTHONPATH=hooks python benchmarks/bench.py --sizes 10,100 \\
+        --only create_projects --delay 0.02
+
+No network access is required.  --delay adds a fixed per-command latency to
+the fake Gerrit to approximate a remote server.
+"""
+import argparse
+import contextlib
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock
+import paramiko
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARM_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(CHARM_DIR, 'hooks'))
+
+import common  # NOQA
+import gerrit  # NOQA
+import launchpad_sync  # NOQA
+import fakes  # NOQA
+
+from charmhelpers.canonical_ci import gerrit as gerrit_client  # NOQA
+from charmhelpers.canonical_ci import trace  # NOQA
+
+DEFAULT_SIZES = [10, 100, 1000]
+UPSTREAM_HOST = 'upstream.invalid'
+
+
+class Result(object):
+    def __init__(self, name, size, elapsed, latencies):
+        self.name = name
+        self.size = size
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return 0.0
+        index = int(round((len(self.latencies) - 1) * pct / 100.0))
+        return self.latencies[index]
+
+    def row(self):
+        mean = (sum(self.latencies) / len(self.latencies)
+                if self.latencies else 0.0)
+        return ('%-22s %6d %9.2f %10.1f %9.2f %9.2f %9.2f' %
+                (self.name, self.size, self.elapsed,
+                 self.size / self.elapsed if self.elapsed else 0.0,
+                 mean * 1000, self.percentile(50) * 1000,
+                 self.percentile(95) * 1000))
+
+
+HEADER = ('%-22s %6s %9s %10s %9s %9s %9s' %
+          ('benchmark', 'n', 'total(s)', 'ops/s', 'mean(ms)', 'p50(ms)',
+           'p95(ms)'))
+
+
+def span_latencies(prefix):
+    """Durations of trace spans directly below prefix."""
+    depth = prefix.count('/') + 1
+    return [r['duration'] for r in trace.records()
+            if r['name'].startswith(prefix + '/') and
+            r['name'].count('/') == depth]
+
+
+def command_latencies(name):
+    return [r['duration'] for r in trace.records()
+            if r['kind'] == 'cmd' and r['name'].endswith(name)]
+
+
+_check_call = subprocess.check_call
+
+
+def check_call(cmd, *args, **kwargs):
+    # The benchmark runs as an unprivileged user, so skip the chown of
+    # temporary directories to the gerrit user.
+    if cmd[0] == 'chown':
+        return 0
+    return _check_call(cmd, *args, **kwargs)
+
+
+class Environment(object):
+    """Temporary directories, git config and fake services shared by all
+    benchmarks."""
+
+    def __init__(self, delay):
+        self.root = tempfile.mkdtemp(prefix='ci-configurator-bench')
+        self.home = os.path.join(self.root, 'home')
+        self.git_path = os.path.join(self.root, 'git')
+        self.upstream = os.path.join(self.root, 'upstream')
+        for path in (self.home, self.git_path, self.upstream):
+            os.mkdir(path)
+
+        # Point the https:// upstream urls used by create_projects at local
+        # bare repositories.
+        with open(os.path.join(self.home, '.gitconfig'), 'w') as fd:
+            fd.write('[url "file://%s/"]\n\tinsteadOf = https://%s/\n' %
+                     (self.upstream, UPSTREAM_HOST))
+
+        self.key_file = os.path.join(self.root, 'id_rsa')
+        paramiko.RSAKey.generate(1024).write_private_key_file(self.key_file)
+
+        self.gerrit = fakes.FakeGerrit(self.git_path, delay=delay).start()
+        self.jenkins = fakes.FakeJenkins().start()
+        self.launchpad = fakes.FakeLaunchpad()
+
+    @contextlib.contextmanager
+    def patched(self):
+        env = {'HOME': self.home, 'CHARM_DIR': CHARM_DIR}
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(gerrit, 'GIT_PATH', self.git_path), \
+                mock.patch.object(gerrit, 'SSH_PORT', self.gerrit.port), \
+                mock.patch.object(gerrit, 'log'), \
+                mock.patch.object(gerrit_client, 'log'), \
+                mock.patch.object(common, '_run_as_user',
+                                  lambda user: None), \
+                mock.patch('subprocess.check_call', check_call):
+            yield
+
+    def client(self):
+        return gerrit_client.GerritClient(host='localhost', user='admin',
+                                          port=self.gerrit.port,
+                                          key_file=self.key_file)
+
+    def reset(self):
+        self.gerrit.state.reset()
+        self.jenkins.jobs.clear()
+        self.launchpad.people.clear()
+        for conn in gerrit_client._connections.values():
+            conn.cache.clear()
+        trace.reset()
+        for path in (self.git_path, self.upstream):
+            shutil.rmtree(path)
+            os.mkdir(path)
+
+    def cleanup(self):
+        self.gerrit.stop()
+        self.jenkins.stop()
+        shutil.rmtree(self.root)
+
+
+def _create_projects(env, projects):
+    env.client().ssh.cache.clear()
+    tmpdir = tempfile.mkdtemp(dir=env.root)
+    start = time.time()
+    gerrit.create_projects('admin', 'admin@localhost', env.key_file,
+                           UPSTREAM_HOST, projects, ['master'], 'localhost',
+                           tmpdir)
+    elapsed = time.time() - start
+    shutil.rmtree(tmpdir)
+    return elapsed, span_latencies('create_projects')
+
+
+def _upstream_projects(env, size):
+    projects = []
+    for i in range(size):
+        name = 'project-%04d' % i
+        fakes.make_bare_repo(os.path.join(env.upstream, name),
+                             'refs/heads/master', 'Initial commit')
+        projects.append({'name': name, 'repo': name})
+    return projects
+
+
+def bench_create_projects(env, size):
+    return _create_projects(env, _upstream_projects(env, size))
+
+
+def bench_create_projects_rerun(env, size):
+    """create_projects when every project already exists."""
+    projects = _upstream_projects(env, size)
+    _create_projects(env, projects)
+    trace.reset()
+    return _create_projects(env, projects)
+
+
+def bench_create_users_batch(env, size):
+    team = env.launchpad.add_team(
+        'bench-team', ['user-%04d' % i for i in range(size)])
+    users = [(p.name, p.display_name, p.preferred_email_address.email,
+              tuple('ssh-rsa %s %s' % (k.keytext, k.comment)
+                    for k in p.sshkeys),
+              'https://login.launchpad.net/+id/%s' % p.name)
+             for p in team.members]
+    client = env.client()
+
+    start = time.time()
+    status = client.create_users_batch('bench-group', users)
+    elapsed = time.time() - start
+    if 'failed' in status.values():
+        raise Exception('failed to create users: %s' % status)
+    return elapsed, command_latencies('gerrit create-account')
+
+
+def _openid(login):
+    return 'https://login.launchpad.net/+id/%s' % login
+
+
+def bench_lp_sync(env, size):
+    """launchpad_sync.sync() of two groups sharing a nested team."""
+    half = size // 2
+    env.launchpad.add_team('bench-core', ['user-%04d' % i
+                                          for i in range(half)])
+    env.launchpad.add_team('bench-all', ['user-%04d' % i
+                                         for i in range(half, size)],
+                           teams=['bench-core'])
+    groups = {'bench-core': 'bench-core', 'bench-all': 'bench-all'}
+    client = env.client()
+
+    start = time.time()
+    # sync() prints a line per team member.
+    with open(os.devnull, 'w') as devnull, \
+            mock.patch('sys.stdout', devnull):
+        results = launchpad_sync.sync(groups, client, env.launchpad,
+                                      openid=_openid)
+    elapsed = time.time() - start
+    if 'failed' in [s for r in results.values() for s in r.values()]:
+        raise Exception('failed to sync users: %s' % results)
+    members = env.gerrit.state.members
+    if len(members['bench-core']) != half or len(members['bench-all']) != size:
+        raise Exception('wrong group members: %s' % members)
+    return elapsed, command_latencies('gerrit create-account')
+
+
+def bench_create_groups(env, size):
+    groups = ['group-%04d' % i for i in range(size)]
+    client = env.client()
+
+    start = time.time()
+    client.create_groups(groups)
+    elapsed = time.time() - start
+    return elapsed, command_latencies('gerrit create-group')
+
+
+def bench_sync_dir(env, size):
+    src = os.path.join(env.root, 'sync-src')
+    dst = os.path.join(env.root, 'sync-dst')
+    for i in range(size):
+        path = os.path.join(src, 'dir-%d' % (i % 10))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'file-%04d' % i), 'w') as fd:
+            fd.write('x' * 4096)
+    os.mkdir(dst)
+
+    latencies = []
+    start = time.time()
+    for _ in range(3):
+        t = time.time()
+        common.sync_dir(src, dst)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    shutil.rmtree(src)
+    shutil.rmtree(dst)
+    return elapsed / 3, [latency / size for latency in latencies]
+
+
+JOB_TEMPLATE = """
+- job-template:
+    name: '{component}-unit'
+    builders:
+      - shell: 'echo {component}'
+
+- project:
+    name: bench
+    component: [%s]
+    jobs:
+      - '{component}-unit'
+"""
+
+
+def bench_jjb_update(env, size):
+    if not distutils.spawn.find_executable('jenkins-jobs'):
+        return None
+
+    jobs_dir = os.path.join(env.root, 'jobs')
+    os.mkdir(jobs_dir)
+    names = ', '.join('job%04d' % i for i in range(size))
+    with open(os.path.join(jobs_dir, 'jobs.yml'), 'w') as fd:
+        fd.write(JOB_TEMPLATE % names)
+    ini = os.path.join(env.root, 'jenkins_jobs.ini')
+    with open(ini, 'w') as fd:
+        fd.write('[job_builder]\nignore_cache=True\n\n'
+                 '[jenkins]\nuser=admin\npassword=secret\nurl=%s\n' %
+                 env.jenkins.url)
+
+    cmd = ['jenkins-jobs', '--conf', ini, 'update', jobs_dir]
+    start = time.time()
+    common.run_as_user(user=common.CI_USER, cmd=cmd)
+    elapsed = time.time() - start
+    shutil.rmtree(jobs_dir)
+    if len(env.jenkins.jobs) != size:
+        raise Exception('expected %d jobs in jenkins, found %d' %
+                        (size, len(env.jenkins.jobs)))
+    return elapsed, [elapsed / size] * size
+
+
+BENCHMARKS = [
+    ('create_projects', bench_create_projects),
+    ('create_projects_rerun', bench_create_projects_rerun),
+    ('create_users_batch', bench_create_users_batch),
+    ('create_groups', bench_create_groups),
+    ('lp_sync', bench_lp_sync),
+    ('sync_dir', bench_sync_dir),
+    ('jjb_update', bench_jjb_update),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated list of sizes to run')
+    parser.add_argument('--only', action='append', default=[],
+                        help='only run the named benchmark (repeatable)')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds of latency added to each gerrit '
+                             'command')
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    env = Environment(args.delay)
+    print HEADER
+    try:
+        with env.patched():
+            for name, func in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+                for size in sizes:
+                    env.reset()
+                    result = func(env, size)
+                    if result is None:
+                        print '%-22s %6d %9s' % (name, size, 'skipped')
+                        continue
+                    print Result(name, size, *result).row()
+                    sys.stdout.flush()
+    finally:
+        env.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""Local stand-ins for the services the charm talks to.
+
+None of these need network access: the fake Gerrit is a paramiko SSH server
+bound to localhost, the fake Jenkins is a small HTTP server bound to
+localhost and the fake Launchpad is an in-process object model exposing the
+subset of the launchpadlib API used by scripts/query_lp_members.py.
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import re
+import shlex
+import socket
+import subprocess
+import threading
+import time
+import urlparse
+
+import paramiko
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench',
+               GIT_COMMITTER_EMAIL='bench@localhost')
+
+
+def git(args, cwd=None):
+    return subprocess.check_output(['git'] + args, cwd=cwd, env=GIT_ENV,
+                                   stderr=subprocess.STDOUT)
+
+
+def make_bare_repo(path, ref, message):
+    """Create a bare repository at path with a single empty commit on ref."""
+    git(['init', '--quiet', '--bare', path])
+    tree = git(['hash-object', '-t', 'tree', '-w', '/dev/null'],
+               cwd=path).strip()
+    commit = git(['commit-tree', tree, '-m', message], cwd=path).strip()
+    git(['update-ref', ref, commit], cwd=path)
+
+
+class GerritState(object):
+    """In-memory model of the Gerrit server state."""
+
+    def __init__(self, git_path, delay=0.0):
+        self.git_path = git_path
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.projects = set()
+            self.groups = {}
+            for group in ('Administrators', 'Non-Interactive Users'):
+                self.create_group(group)
+            self.accounts = {}
+            self.members = {}
+            self.commands = []
+
+    def create_project(self, name):
+        if name in self.projects:
+            return '', 'fatal: project "%s" exists\n' % name, 1
+        self.projects.add(name)
+        make_bare_repo(os.path.join(self.git_path, '%s.git' % name),
+                       'refs/meta/config', 'Created project')
+        return '', '', 0
+
+    def ls_projects(self):
+        projects = dict((name, {'id': name}) for name in self.projects)
+        return json.dumps(projects) + '\n', '', 0
+
+    def create_group(self, name):
+        if name in self.groups:
+            return '', 'fatal: Name Already Used\n', 1
+        self.groups[name] = '%040x' % (len(self.groups) + 1)
+        return '', '', 0
+
+    def ls_groups(self):
+        lines = ['%s\t%s\t\tAdministrators\t%s\ttrue' %
+                 (name, uuid, self.groups['Administrators'])
+                 for name, uuid in sorted(self.groups.items())]
+        return ''.join(line + '\n' for line in lines), '', 0
+
+    def set_members(self, argv):
+        group = argv[0]
+        if group not in self.groups:
+            return '', 'fatal: Group Not Found: %s\n' % group, 1
+        members = self.members.setdefault(group, set())
+        for flag, login in zip(argv[1::2], argv[2::2]):
+            if flag != '--add':
+                return '', 'fatal: unsupported option %s\n' % flag, 1
+            if login not in self.accounts:
+                return '', 'fatal: "%s" is not registered\n' % login, 1
+            members.add(login)
+        return '', '', 0
+
+    def create_account(self, argv):
+        login = argv[0]
+        if login in self.accounts:
+            return '', 'fatal: username %s already exists\n' % login, 1
+        self.accounts[login] = len(self.accounts) + 1000000
+        return '', '', 0
+
+    def query(self, sql):
+        """Run one statement, returning its output lines in gsql's json
+        format.  Only account id lookups return rows; other statements
+        report a single updated row."""
+        if not sql.startswith('SELECT'):
+            return [json.dumps({'type': 'update-stats', 'rowCount': 1,
+                                'runTimeMilliseconds': 0})]
+
+        rows = []
+        match = re.match(r"SELECT account_id(, external_id)? FROM "
+                         r"account_external_ids WHERE external_id"
+                         r"(=| IN \()(.+?)\)?$", sql)
+        if match:
+            for login in re.findall(r"'username:([^']+)'", match.group(3)):
+                if login in self.accounts:
+                    row = {'account_id': str(self.accounts[login])}
+                    if match.group(1):
+                        row['external_id'] = 'username:%s' % login
+                    rows.append(row)
+        out = [json.dumps({'type': 'row', 'columns': r}) for r in rows]
+        out.append(json.dumps({'type': 'query-stats', 'rowCount': len(rows),
+                               'runTimeMilliseconds': 0}))
+        return out
+
+    def gsql(self, argv, stdin=''):
+        if '-c' in argv:
+            statements = [argv[argv.index('-c') + 1]]
+        else:
+            statements = [sql.strip() for sql in stdin.split(';\n')
+                          if sql.strip()]
+        json_format = '--format' in argv and \
+            argv[argv.index('--format') + 1].lower() == 'json'
+
+        out = []
+        for sql in statements:
+            out.extend(self.query(sql))
+        if json_format:
+            return ''.join(line + '\n' for line in out), '', 0
+        return '(%d statements; 0 ms)\n' % len(statements), '', 0
+
+    def reads_stdin(self, command):
+        """A gsql without -c reads its statements from stdin."""
+        argv = shlex.split(command)
+        return argv[:2] == ['gerrit', 'gsql'] and '-c' not in argv
+
+    def dispatch(self, command, stdin=''):
+        argv = shlex.split(command)
+        if argv[:1] != ['gerrit'] or len(argv) < 2:
+            return '', 'fatal: unknown command %s\n' % command, 1
+
+        with self.lock:
+            self.commands.append(command)
+            sub, args = argv[1], argv[2:]
+            if sub == 'create-project':
+                return self.create_project(args[0])
+            elif sub == 'create-group':
+                return self.create_group(args[0])
+            elif sub == 'ls-projects':
+                return self.ls_projects()
+            elif sub == 'ls-groups':
+                return self.ls_groups()
+            elif sub == 'create-account':
+                return self.create_account(args)
+            elif sub == 'set-members':
+                return self.set_members(args)
+            elif sub == 'gsql':
+                return self.gsql(args, stdin)
+            elif sub == 'flush-caches':
+                return '', '', 0
+        return '', 'fatal: unknown command %s\n' % sub, 1
+
+
+class _GerritInterface(paramiko.ServerInterface):
+
+    def __init__(self, state):
+        self.state = state
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        t = threading.Thread(target=self._exec, args=(channel, command))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _exec(self, channel, command):
+        try:
+            if self.state.delay:
+                time.sleep(self.state.delay)
+            stdin = ''
+            if self.state.reads_stdin(command):
+                while True:
+                    data = channel.recv(65536)
+                    if not data:
+                        break
+                    stdin += data
+            out, err, status = self.state.dispatch(command, stdin)
+        except Exception as exc:
+            out, err, status = '', 'fatal: %s\n' % exc, 1
+        try:
+            channel.sendall(out)
+            channel.sendall_stderr(err)
+            channel.send_exit_status(status)
+            channel.shutdown_write()
+            # Closing straight away can race with the transport's reply to
+            # the exec request, so wait for the client to close first.
+            channel.settimeout(5)
+            channel.recv(1)
+        except socket.timeout:
+            pass
+        finally:
+            channel.close()
+
+
+class FakeGerrit(object):
+    """Fake Gerrit SSH daemon listening on localhost.
+
+    Accepts any public key and understands create-project, ls-projects,
+    create-group, ls-groups, create-account, set-members, gsql and
+    flush-caches.
+    """
+
+    def __init__(self, git_path, delay=0.0):
+        self.state = GerritState(git_path, delay=delay)
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+
+    def start(self):
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_GerritInterface(self.state))
+            self.transports.append(transport)
+
+    def stop(self):
+        for transport in self.transports:
+            transport.close()
+        self.sock.close()
+
+
+class _JenkinsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body='', content_type='application/json'):
+        self.send_response(code)
+        self.send_header('X-Jenkins', '1.651')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        return self.rfile.read(length)
+
+    def _job(self, path):
+        match = re.match(r'^/job/([^/]+)/(.*)$', path)
+        if match:
+            return match.group(1), match.group(2)
+        return None, None
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        jobs = self.server.jobs
+        name, rest = self._job(url.path)
+        if url.path in ('/', '/api/json'):
+            body = {'jobs': [{'name': n} for n in sorted(jobs)]}
+            return self._reply(200, json.dumps(body))
+        elif url.path == '/me/api/json':
+            return self._reply(200, json.dumps({'id': 'admin'}))
+        elif name is not None and name in jobs:
+            if rest == 'config.xml':
+                return self._reply(200, jobs[name], 'application/xml')
+            return self._reply(200, json.dumps({'name': name}))
+        return self._reply(404)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        jobs = self.server.jobs
+        name, rest = self._job(url.path)
+        body = self._body()
+        if url.path == '/createItem':
+            name = urlparse.parse_qs(url.query)['name'][0]
+            if name in jobs:
+                return self._reply(400)
+            jobs[name] = body
+            return self._reply(200)
+        elif name is not None and name in jobs:
+            if rest == 'config.xml':
+                jobs[name] = body
+            elif rest == 'doDelete':
+                del jobs[name]
+            return self._reply(200)
+        return self._reply(404)
+
+    def do_HEAD(self):
+        self._reply(200)
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeJenkins(object):
+    """Fake Jenkins master exposing the REST calls jenkins-job-builder
+    makes to list, create and reconfigure jobs."""
+
+    def __init__(self):
+        self.server = _ThreadedHTTPServer(('127.0.0.1', 0), _JenkinsHandler)
+        self.server.jobs = {}
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+    @property
+    def jobs(self):
+        return self.server.jobs
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeEntry(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakePerson(object):
+    """A Launchpad person or team."""
+
+    def __init__(self, name, is_team=False, members=None, email=None,
+                 keys=None):
+        self.name = name
+        self.display_name = name.replace('-', ' ').title()
+        self.is_team = is_team
+        self.members = members or []
+        self.preferred_email_address = FakeEntry(
+            email=email or '%s@example.com' % name)
+        self.sshkeys = [FakeEntry(keytype='RSA', keytext=k, comment=name)
+                        for k in (keys or [])]
+
+    @property
+    def members_details(self):
+        link = 'https://api.launchpad.net/1.0/~%s/+member/%s'
+        return [FakeEntry(self_link=link % (self.name, m.name),
+                          status='Approved')
+                for m in self.members]
+
+
+class FakeLaunchpad(object):
+    """Minimal launchpadlib look-alike: people[name] returns a FakePerson."""
+
+    def __init__(self):
+        self.people = {}
+
+    def add(self, person):
+        self.people[person.name] = person
+        return person
+
+    def add_team(self, name, users, teams=None):
+        members = [self.add(FakePerson(u, keys=['AAAA%s' % u]))
+                   for u in users]
+        members += [self.people[t] for t in (teams or [])]
+        return self.add(FakePerson(name, is_team=True, members=members))
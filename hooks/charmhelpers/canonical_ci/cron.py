@@ -1,6 +1,38 @@
+import argparse
+import errno
+import fcntl
+import json
+import logging
 import os
+import pipes
+import pwd
+import random
+import subprocess
+import sys
+import time
 
-from charmhelpers.core.hookenv import log, INFO
+from charmhelpers.core.hookenv import (
+    log as _log,
+    INFO,
+    WARNING
+)
+
+# Lock and status file of each job run through run_job(), in a directory
+# named after the job.
+STATE_DIR = os.path.join('/var', 'lib', 'ci-configurator', 'cron')
+JENKINS_JOBS = '/usr/local/bin/jenkins-jobs'
+
+logging.basicConfig(level=logging.INFO)
+
+
+def log(msg, level=None):
+    # wrap log calls and distribute to correct logger
+    # depending if this code is being run by a hook
+    # or a cron job.
+    if os.getenv('JUJU_AGENT_SOCKET'):
+        _log(msg, level=level)
+    else:
+        logging.info(msg)
 
 
 def write_cronjob(content, job_name=''):
@@ -35,27 +67,166 @@ def schedule_backup(sources, ci_user, target, schedule, retention_count):
     write_cronjob(content)
 
 
-def schedule_repo_updates(schedule, ci_user, ci_config_dir, ci_repo_rcs,
-                          jobs_config_dir):
-    log("Creating cronjob to update CI repo config.", INFO)
+def user_ids(user):
+    pw = pwd.getpwnam(user)
+    return pw.pw_uid, pw.pw_gid
+
+
+def prepare_job(name, user):
+    """Create the state directory of job name, owned by user."""
+    job_dir = os.path.join(STATE_DIR, name)
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    os.chown(job_dir, *user_ids(user))
+
+
+def wrap_job(name, user, job, jitter=0):
+    """Return the command running job through scripts/cron_job.py, which
+    skips a run while the previous one is still going.
+
+    The state directory of the job is created for user, who runs it.
+    """
+    prepare_job(name, user)
+    script = os.path.join(os.environ['CHARM_DIR'], 'scripts', 'cron_job.py')
+    args = [script]
+    if jitter:
+        args += ['--jitter', str(jitter)]
+    return '%s %s %s' % (' '.join(args), name, pipes.quote(job))
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+
+def read_status(name, state_dir=None):
+    """Return the status of the last run of job name, see run_job()."""
+    job_dir = os.path.join(state_dir or STATE_DIR, name)
+    status = _read_json(os.path.join(job_dir, 'status.json'))
+    status.update(_read_json(os.path.join(job_dir, 'skipped.json')))
+    return status
 
+
+def _record_skip(job_dir):
+    # Skips are counted in their own file, under their own lock, so that
+    # the run holding the job lock never writes back a stale count.
+    with open(os.path.join(job_dir, 'skipped.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(job_dir, 'skipped.json')
+        skips = _read_json(path)
+        skips['skipped'] = skips.get('skipped', 0) + 1
+        skips['last_skipped'] = time.time()
+        _write_json(path, skips)
+
+
+def run_job(name, job, jitter=0, state_dir=None):
+    """Run the shell command job, unless the previous run of job name still
+    holds its lock, and return its exit status.
+
+    The start is delayed by up to jitter seconds so that units sharing a
+    schedule do not all hit the same services at once.  The start, duration
+    and outcome ('running', 'success' or 'failed') of the run are recorded
+    in the status.json of the job, and the number of skipped runs in its
+    skipped.json.  Returns None if the run was skipped.
+    """
+    job_dir = os.path.join(state_dir or STATE_DIR, name)
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+
+    if jitter:
+        time.sleep(random.uniform(0, jitter))
+
+    with open(os.path.join(job_dir, 'lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            status = read_status(name, state_dir)
+            log('Previous %s run started at %s is still running, skipping.' %
+                (name, time.ctime(status.get('start', 0))), WARNING)
+            _record_skip(job_dir)
+            return None
+
+        path = os.path.join(job_dir, 'status.json')
+        status = {'start': time.time(), 'duration': None,
+                  'outcome': 'running', 'returncode': None}
+        _write_json(path, status)
+        # Don't leak the lock to daemons started by the job.
+        ret = subprocess.call(job, shell=True, close_fds=True)
+        status.update({'duration': time.time() - status['start'],
+                       'outcome': 'success' if ret == 0 else 'failed',
+                       'returncode': ret})
+        _write_json(path, status)
+        return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a cron job unless it is already running.')
+    parser.add_argument('--jitter', type=int, default=0,
+                        help='delay the start by up to this many seconds')
+    parser.add_argument('name', help='name of the job')
+    parser.add_argument('job', help='shell command to run')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    return run_job(args.name, args.job, jitter=args.jitter)
+
+
+def repo_update_command(ci_config_dir, ci_repo_rcs, jobs_config_dir,
+                        state_dir=None):
+    """Return the shell command updating ci_config_dir and, unless the
+    jenkins jobs are already up to date with the resulting revision, the
+    jenkins jobs.  Returns None for an unknown RCS.
+
+    The revision is saved in the repo_update state directory once
+    jenkins-jobs update succeeds, so that a failed update is retried by the
+    next run even if no new revision has landed.
+    """
     #XXX: matsubara perhaps would be better to bzr pull and then
     # trigger jjb.update_jenkins()
     if ci_repo_rcs == 'bzr':
-        ci_update_command = '/usr/bin/bzr update {}'.format(ci_config_dir)
+        revision = '/usr/bin/bzr revno'
+        ci_update_command = '/usr/bin/bzr update'
     elif ci_repo_rcs == 'git':
-        ci_update_command = 'cd {} && /usr/bin/git pull'.format(ci_config_dir)
+        revision = '/usr/bin/git rev-parse HEAD'
+        ci_update_command = '/usr/bin/git pull'
     else:
         log('Unknown RCS: {}'.format(ci_repo_rcs))
+        return None
+    saved = pipes.quote(os.path.join(state_dir or STATE_DIR, 'repo_update',
+                                     'revision'))
+    return ('cd {0} && {2} && rev=$({1}) && '
+            'if [ "$rev" != "$(cat {5} 2>/dev/null)" ]; then '
+            '{3} --flush-cache update {4} && '
+            'echo "$rev" > {5}; fi'.format(
+                ci_config_dir, revision, ci_update_command, JENKINS_JOBS,
+                jobs_config_dir, saved))
+
+
+def schedule_repo_updates(schedule, ci_user, ci_config_dir, ci_repo_rcs,
+                          jobs_config_dir, jitter=0):
+    log("Creating cronjob to update CI repo config.", INFO)
+
+    update_command = repo_update_command(ci_config_dir, ci_repo_rcs,
+                                         jobs_config_dir)
+    if update_command is None:
         return False
-    update_command = ("%s && "
-                      "/usr/local/bin/jenkins-jobs --flush-cache update %s" %
-                      (ci_update_command, jobs_config_dir))
 
-    content = "%s %s %s\n" % (schedule, ci_user, update_command)
+    job = wrap_job('repo_update', ci_user, update_command, jitter)
+    content = "%s %s %s\n" % (schedule, ci_user, job)
     write_cronjob(content)
 
 
-def schedule_generic_job(schedule, user, name, job):
+def schedule_generic_job(schedule, user, name, job, jitter=0):
+    job = wrap_job(name, user, job, jitter)
     content = "%s %s %s\n" % (schedule, user, job)
     write_cronjob(content, job_name=name)
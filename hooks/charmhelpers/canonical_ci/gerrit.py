@@ -1,10 +1,14 @@
+import contextlib
 import json
 import logging
 import os
 import paramiko
 import re
+import socket
 import sys
 import subprocess
+import threading
+import time
 
 from charmhelpers.core.hookenv import (
     log as _log,
@@ -12,9 +16,23 @@ from charmhelpers.core.hookenv import (
     WARNING,
     ERROR
 )
+from charmhelpers.canonical_ci import trace
 
-_connection = None
 GERRIT_DAEMON = "/etc/init.d/gerrit"
+# Seconds between keepalive packets on idle connections.
+KEEPALIVE_INTERVAL = 30
+# Maximum number of commands run concurrently over one connection.
+MAX_CHANNELS = 8
+# Number of statements sent to one gsql session by gsql_batch().
+GSQL_BATCH_SIZE = 500
+# Commands that can safely be re-run if the connection drops while they are
+# in flight.  create-* commands report "already exists" when re-run.
+IDEMPOTENT_COMMANDS = re.compile(r'^gerrit (ls-\S+|flush-caches|'
+                                 r'create-(project|group|account) |'
+                                 r'gsql .*-c "SELECT )')
+
+_connections = {}
+_connections_lock = threading.Lock()
 
 logging.basicConfig(level=logging.INFO)
 
@@ -29,22 +47,107 @@ def log(msg, level=None):
         logging.info(msg)
 
 
-def get_ssh(host, user, port, key_file):
-    global _connection
-    if _connection:
-        return _connection
+class SSHConnection(object):
+    """A pooled SSH connection to Gerrit.
 
-    _connection = paramiko.SSHClient()
-    _connection.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    _connection.connect(host, username=user, port=port, key_filename=key_file)
+    The connection is re-established when its transport has died and at most
+    MAX_CHANNELS commands are run over it at once.
+    """
+    def __init__(self, host, user, port, key_file):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.key_file = key_file
+        self.client = None
+        # State looked up from this gerrit server, e.g. its groups.
+        self.cache = {}
+        self.channels = threading.BoundedSemaphore(MAX_CHANNELS)
+        self.lock = threading.Lock()
+        self.connect()
+
+    def connect(self, stale=None):
+        """(Re)connect to gerrit.
+
+        If stale is given, the connection is only replaced if stale, the
+        client a caller saw fail, is still the current one; otherwise another
+        thread has already reconnected and its channels are left alone.
+        """
+        with self.lock:
+            if stale is not None and self.client is not stale:
+                return
+            if self.client:
+                self.client.close()
+            self.client = paramiko.SSHClient()
+            self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            self.client.connect(self.host, username=self.user,
+                                port=self.port, key_filename=self.key_file)
+            transport = self.client.get_transport()
+            transport.set_keepalive(KEEPALIVE_INTERVAL)
+            # Commands are small request/response exchanges so don't let
+            # Nagle hold back the next channel open.
+            transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                      1)
+
+    def is_alive(self, client=None):
+        client = client or self.client
+        transport = client and client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        # is_active() stays True until paramiko notices that the session has
+        # gone, so send an ignore message to find out.
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, socket.error, EOFError):
+            return False
+        return True
+
+    def ensure_connected(self):
+        """Reconnect if the connection has died, and return the client."""
+        client = self.client
+        if not self.is_alive(client):
+            log('SSH connection to %s@%s:%s lost, reconnecting.' %
+                (self.user, self.host, self.port), level=WARNING)
+            self.connect(stale=client)
+        return self.client
+
+    def run(self, cmd, client=None):
+        """Run cmd, over client if given, returning (stdout, stderr, exit
+        status)."""
+        client = client or self.client
+        with self.channels:
+            _, stdout, stderr = client.exec_command(cmd)
+            out, err = stdout.read(), stderr.read()
+            return (out, err, stdout.channel.recv_exit_status())
+
+    def exec_command(self, cmd):
+        return self.client.exec_command(cmd)
+
+    def close(self):
+        with _connections_lock:
+            for key, conn in _connections.items():
+                if conn is self:
+                    del _connections[key]
+        self.client.close()
+
+
+def get_ssh(host, user, port, key_file):
+    """Return a live pooled connection for (host, port, user, key_file)."""
+    key = (host, port, user, key_file)
+    with _connections_lock:
+        conn = _connections.get(key)
+        if conn is None:
+            conn = _connections[key] = SSHConnection(host, user, port,
+                                                     key_file)
+            return conn
 
-    return _connection
+    conn.ensure_connected()
+    return conn
 
 
 # start gerrit application
 def start_gerrit():
     try:
-        subprocess.check_call([GERRIT_DAEMON, "start"])
+        trace.run(subprocess.check_call, [GERRIT_DAEMON, "start"])
     except:
         pass
 
@@ -52,7 +155,7 @@ def start_gerrit():
 # stop gerrit application
 def stop_gerrit():
     try:
-        subprocess.check_call([GERRIT_DAEMON, "stop"])
+        trace.run(subprocess.check_call, [GERRIT_DAEMON, "stop"])
     except:
         pass
 
@@ -63,153 +166,480 @@ class GerritException(Exception):
         super(GerritException, self).__init__(msg)
 
 
+def parse_gsql(lines, types=None, stats=None):
+    """Parse the output of gsql --format json, one line at a time.
+
+    Yields the columns of each row as a dict, converting the columns named
+    in types with the given callable, e.g. {'account_id': int}.  If stats is
+    a dict it is updated with the trailing query-stats or update-stats row.
+    Raises GerritException if gsql reports an error.
+    """
+    types = types or {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        res = json.loads(line)
+        kind = res.get('type')
+        if kind == 'row':
+            row = res.get('columns', {})
+            for column, convert in types.iteritems():
+                if row.get(column) is not None:
+                    row[column] = convert(row[column])
+            yield row
+        elif kind == 'error':
+            raise GerritException(res.get('message', line))
+        elif stats is not None:
+            stats.update(res)
+
+
+def parse_gsql_results(lines):
+    """Split the output of a gsql --format json session running several
+    statements into one result per statement, in order.
+
+    Yields a dict per statement holding its 'rows' and either the 'stats'
+    row that ended it or the 'error' message gsql reported for it.
+    """
+    rows = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        res = json.loads(line)
+        kind = res.get('type')
+        if kind == 'row':
+            rows.append(res.get('columns', {}))
+        elif kind == 'error':
+            yield {'rows': rows, 'error': res.get('message', line)}
+            rows = []
+        else:
+            yield {'rows': rows, 'stats': res}
+            rows = []
+
+
 class GerritClient(object):
     def __init__(self, host, user, port, key_file):
         self.ssh = get_ssh(host, user, port, key_file)
+        # Effects of changes made inside batch(), applied when it exits.
+        self._deferred = set()
+        self._batch_depth = 0
 
-    def _run_cmd(self, cmd):
-        _, stdout, stderr = self.ssh.exec_command(cmd)
-        return (stdout.read(), stderr.read())
+    def _exec(self, cmd, idempotent=None):
+        """Run a gerrit command over ssh, returning (stdout, stderr, status).
 
-    def create_user(self, user, name, group, ssh_key):
+        If the connection has dropped it is re-established and, if the
+        command is idempotent, the command is retried once.  idempotent
+        defaults to matching cmd against IDEMPOTENT_COMMANDS.
+        """
+        if idempotent is None:
+            idempotent = bool(IDEMPOTENT_COMMANDS.match(cmd))
+
+        client = self.ssh.ensure_connected()
+        try:
+            return self.ssh.run(cmd, client)
+        except (paramiko.SSHException, socket.error) as exc:
+            log('SSH command failed (%s), reconnecting.' % exc,
+                level=WARNING)
+            # Other commands running concurrently may have failed with it,
+            # only the first of them reconnects.
+            self.ssh.connect(stale=client)
+            if not idempotent:
+                raise
+            return self.ssh.run(cmd)
+
+    def _run_cmd(self, cmd, idempotent=None):
+        with trace.command(cmd, name=' '.join(cmd.split()[:2])) as record:
+            out, err, record['status'] = self._exec(cmd, idempotent)
+        return (out, err)
+
+    def _run_cmds(self, cmds):
+        """Run several commands concurrently over the connection, at most
+        MAX_CHANNELS at a time.
+
+        Returns a list of (stdout, stderr, status) in the order of cmds.  A
+        command that raised gets ('', <error>, -1).
+        """
+        results = [None] * len(cmds)
+        pending = list(enumerate(cmds))
+        pending_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with pending_lock:
+                    if not pending:
+                        return
+                    index, cmd = pending.pop(0)
+                start = time.time()
+                try:
+                    results[index] = self._exec(cmd)
+                except Exception as exc:
+                    results[index] = ('', str(exc), -1)
+                trace.add(' '.join(cmd.split()[:2]), cmd, start,
+                          time.time() - start, results[index][2])
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(MAX_CHANNELS, len(cmds)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def gsql_query(self, sql, types=None, stats=None):
+        """Run a gsql SELECT and yield its rows as they arrive.
+
+        Rows are parsed from the channel one line at a time, so large
+        result sets such as every account are never held in memory at once.
+        See parse_gsql() for types and stats.
+        """
+        cmd = 'gerrit gsql --format json -c "%s"' % sql
+        self.ssh.ensure_connected()
+
+        start = time.time()
+        status = -1
+        with self.ssh.channels:
+            _, stdout, stderr = self.ssh.exec_command(cmd)
+            try:
+                for row in parse_gsql(stdout, types=types, stats=stats):
+                    yield row
+                status = stdout.channel.recv_exit_status()
+                if status:
+                    raise GerritException(stderr.read().strip() or
+                                          'gsql exited with %d' % status)
+            finally:
+                # Also reached if the caller stops iterating early.
+                stdout.channel.close()
+                trace.add('gerrit gsql', cmd, start, time.time() - start,
+                          status)
+
+    def get_account_id(self, user):
+        """Return the account id of user, or None if it has no account."""
+        sql = ("SELECT account_id FROM account_external_ids WHERE "
+               "external_id='username:%s'" % (user))
+        try:
+            rows = list(self.gsql_query(sql, types={'account_id': int}))
+        except GerritException:
+            return None
+        return rows[0]['account_id'] if rows else None
+
+    def get_account_ids(self, users):
+        """Return a dict mapping each of users that has an account to its
+        account id, looked up with one query per GSQL_BATCH_SIZE users.
+        """
+        account_ids = {}
+        users = list(users)
+        for i in range(0, len(users), GSQL_BATCH_SIZE):
+            external_ids = ', '.join("'username:%s'" % user
+                                     for user in users[i:i + GSQL_BATCH_SIZE])
+            sql = ("SELECT account_id, external_id FROM account_external_ids "
+                   "WHERE external_id IN (%s)" % external_ids)
+            try:
+                for row in self.gsql_query(sql, types={'account_id': int}):
+                    user = row['external_id'].split(':', 1)[1]
+                    account_ids[user] = row['account_id']
+            except GerritException:
+                pass
+        return account_ids
+
+    def gsql_batch(self, statements, chunk_size=GSQL_BATCH_SIZE):
+        """Run gsql statements in chunks of chunk_size, each chunk written to
+        the stdin of a single gsql session rather than one ssh command per
+        statement.
+
+        statements is a list of (tag, sql) where tag says what the statement
+        is for, e.g. the account it updates.  gsql commits each statement on
+        its own, so a failure does not undo the statements before it.
+
+        Returns a list of (tag, sql, error) for the statements that failed.
+        """
+        failed = []
+        for i in range(0, len(statements), chunk_size):
+            chunk = statements[i:i + chunk_size]
+            cmd = 'gerrit gsql --format json'
+            self.ssh.ensure_connected()
+
+            start = time.time()
+            results = []
+            status = -1
+            with self.ssh.channels:
+                stdin, stdout, stderr = self.ssh.exec_command(cmd)
+                try:
+                    stdin.write(''.join('%s;\n' % sql for _, sql in chunk))
+                    stdin.flush()
+                    stdin.channel.shutdown_write()
+                    results = list(parse_gsql_results(stdout))
+                    status = stdout.channel.recv_exit_status()
+                    err = stderr.read().strip()
+                finally:
+                    stdout.channel.close()
+                    trace.add('gerrit gsql', '%s (%d statements)' %
+                              (cmd, len(chunk)), start, time.time() - start,
+                              status)
+
+            for index, (tag, sql) in enumerate(chunk):
+                if index >= len(results):
+                    error = err or 'no result from gsql'
+                else:
+                    error = results[index].get('error')
+                if error:
+                    failed.append((tag, sql, error))
+        return failed
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer cache flushes and restarts until the end of the block, e.g.
+
+            with client.batch():
+                for user in users:
+                    client.create_user(*user)
+
+        Batches nest; deferred effects are applied once when the outermost
+        batch exits.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.apply_deferred()
+
+    def defer(self, effect):
+        """Record that effect ('flush-caches' or 'restart') is needed for
+        changes to be seen by gerrit.  It is applied straight away outside
+        of a batch.
+        """
+        self._deferred.add(effect)
+        if not self._batch_depth:
+            self.apply_deferred()
+
+    def apply_deferred(self):
+        """Apply deferred effects: a single restart if one was requested,
+        otherwise a single flush of gerrit's caches, restarting gerrit only
+        if the flush fails.
+        """
+        deferred, self._deferred = self._deferred, set()
+        if not deferred:
+            return
+        if 'restart' not in deferred and self.flush_cache():
+            return
+        log('Restarting gerrit to pick up account changes.', level=WARNING)
+        stop_gerrit()
+        start_gerrit()
+
+    def _create_user(self, user, name, group, ssh_key):
+        """Create user or replace the ssh key of an existing user.
+
+        Returns 'created', 'updated' or 'failed'.
+        """
         log('Creating gerrit new user %s in group %s.' % (user, group))
         cmd = ('gerrit create-account %(user)s --full-name "%(name)s" '
                '--group "%(group)s" --ssh-key '
                '"%(ssh_key)s"' % locals())
         stdout, stderr = self._run_cmd(cmd)
-        if not stdout and not stderr:
+        if not stderr.startswith('fatal'):
             log('Created new gerrit user %s in group %s.' % (user, group))
+            self.defer('flush-caches')
+            return 'created'
+
+        if 'already exists' not in stderr:
+            # different error
+            log('Error creating account %s (stderr=\'%s\').' %
+                (user, stderr.strip()), ERROR)
+            return 'failed'
+
+        # retrieve user id and update keys
+        account_id = self.get_account_id(user)
+
+        # if found, update ssh keys
+        if account_id:
+            sql = ("DELETE FROM account_ssh_keys WHERE account_id=%s"
+                   % account_id)
+            cmd = ('gerrit gsql -c "%s"' % (sql))
+            stdout, stderr = self._run_cmd(cmd)
 
-        if stderr.startswith('fatal'):
-            if 'already exists' not in stderr:
-                # different error
-                log('Error creating account', ERROR)
-                sys.exit(1)
-            else:
-                # retrieve user id and update keys
-                account_id = None
-                sql = ("SELECT account_id FROM account_external_ids WHERE "
-                       "external_id='username:%s'" % (user))
-                cmd = ('gerrit gsql --format json -c "%s"' % (sql))
-                stdout, stderr = self._run_cmd(cmd)
-                if not stderr:
-                    # load and decode json, extract account id
-                    lines = stdout.splitlines()
-                    if len(lines) > 0:
-                        res = json.loads(lines[0])
-                        try:
-                            account_id = res['columns']['account_id']
-                        except:
-                            pass
-
-                # if found, update ssh keys
-                if account_id:
-                    sql = ("DELETE FROM account_ssh_keys WHERE account_id=%s"
-                           % account_id)
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                    stdout, stderr = self._run_cmd(cmd)
-
-                    # insert new key
-                    sql = ("INSERT INTO account_ssh_keys (ssh_public_key, "
-                           "valid, account_id, seq) VALUES ('%s', 'Y', "
-                           "'%s', 0)" % (ssh_key, account_id))
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                    stdout, stderr = self._run_cmd(cmd)
-
-        # reboot gerrit to refresh accounts
-        stop_gerrit()
-        start_gerrit()
+            # insert new key
+            sql = ("INSERT INTO account_ssh_keys (ssh_public_key, "
+                   "valid, account_id, seq) VALUES ('%s', 'Y', "
+                   "'%s', 0)" % (ssh_key, account_id))
+            cmd = ('gerrit gsql -c "%s"' % (sql))
+            stdout, stderr = self._run_cmd(cmd)
+
+        # The keys were written straight to the database, behind the back
+        # of gerrit's account caches.
+        self.defer('flush-caches')
+        return 'updated'
+
+    def create_user(self, user, name, group, ssh_key):
+        if self._create_user(user, name, group, ssh_key) == 'failed':
+            sys.exit(1)
+
+    def create_users(self, users):
+        """Create or update several users, flushing gerrit's caches once at
+        the end rather than once per user.
+
+        users is a list of (user, name, group, ssh_key) tuples.  Returns a
+        dict mapping each user to 'created', 'updated' or 'failed'.
+        """
+        status = {}
+        with self.batch():
+            for user, name, group, ssh_key in users:
+                status[user] = self._create_user(user, name, group, ssh_key)
+        failed = sorted(u for u, s in status.iteritems() if s == 'failed')
+        if failed:
+            log('Failed to create gerrit users: %s' % ', '.join(failed),
+                level=ERROR)
+        return status
+
+    def _account_statements(self, account_id, email, ssh, openid):
+        """Return the gsql statements replacing the ssh keys and openid of
+        account_id."""
+        statements = []
+        # remove old keys and add new
+        if len(ssh) > 0:
+            statements.append(
+                "DELETE FROM account_ssh_keys WHERE account_id=%s "
+                "AND ssh_public_key NOT IN (%s)" %
+                (account_id, (', '.join("'%s'" % item for item in ssh))))
+        else:
+            statements.append("DELETE FROM account_ssh_keys "
+                              "WHERE account_id=%s" % account_id)
+
+        for num_key, ssh_key in enumerate(ssh):
+            # insert new keys
+            statements.append(
+                "INSERT INTO account_ssh_keys (ssh_public_key, "
+                "valid, account_id, seq) SELECT %(ssh_key)s, "
+                "%(valid)s, %(account_id)s, %(num_key)s WHERE NOT "
+                "EXISTS (SELECT account_id FROM account_ssh_keys "
+                "WHERE account_id=%(account_id)s AND "
+                "ssh_public_key=%(ssh_key)s)" %
+                {'ssh_key': "'%s'" % ssh_key,
+                 'valid': "'Y'",
+                 'account_id': "'%s'" % account_id,
+                 'num_key': num_key})
+
+        # replace external id
+        if openid:
+            openid = openid.replace('login.launchpad.net',
+                                    'login.ubuntu.com')
+            statements.append(
+                "DELETE FROM account_external_ids WHERE "
+                "account_id=%s AND external_id NOT IN (%s) AND "
+                "external_id LIKE 'http%%'" %
+                (account_id, "'%s'" % openid))
+
+            # replace launchpad for ubuntu account
+            statements.append(
+                "INSERT INTO account_external_ids "
+                "(account_id, email_address, external_id) SELECT "
+                "%(account_id)s, %(email_address)s, "
+                "%(external_id)s WHERE NOT EXISTS (SELECT "
+                "account_id FROM account_external_ids WHERE "
+                "account_id=%(account_id)s AND "
+                "external_id=%(external_id)s)" %
+                {'account_id': "'%s'" % account_id,
+                 'email_address': "'%s'" % str(email),
+                 'external_id': "'%s'" % openid})
+        return statements
 
     def create_users_batch(self, group, users):
+        """Create users in group, or in no group if group is None, and bring
+        their ssh keys and openid up to date.
+
+        users is a list of (login, name, email, ssh_keys, openid) tuples.
+        Accounts are created one command at a time, then every key and
+        openid change is written through gsql_batch() and statement failures
+        are reported against the account they were for.
+
+        Returns a dict mapping each login to 'created', 'updated' or
+        'failed'.
+        """
+        status = {}
+        details = {}
         for user in users:
             # sets container user, name, ssh, openid
-            login = user[0]
-            name = user[1]
-            email = user[2]
-            ssh = user[3]
-            openid = user[4]
+            login, name, email, ssh, openid = user
 
             cmd = (u'gerrit create-account %s --full-name "%s" '
-                   u'--group "%s" --email "%s"' %
-                   (login, name, group, email))
+                   u'--email "%s"' % (login, name, email))
+            if group is not None:
+                cmd += u' --group "%s"' % group
             stdout, stderr = self._run_cmd(cmd)
 
-            if stderr.startswith('fatal'):
-                if 'already exists' not in stderr:
-                    sys.exit(1)
-
-            # retrieve user id
-            account_id = None
-            sql = ("SELECT account_id FROM account_external_ids WHERE "
-                   "external_id='username:%s'" % (login))
-            cmd = ('gerrit gsql --format json -c "%s"' % (sql))
-            stdout, stderr = self._run_cmd(cmd)
-            if not stderr:
-                # load and decode json, extract account id
-                lines = stdout.splitlines()
-                if len(lines) > 0:
-                    res = json.loads(lines[0])
-                    try:
-                        account_id = res['columns']['account_id']
-                    except:
-                        pass
-
-            # if found, update ssh keys and openid
-            if account_id:
-                # remove old keys and add new
-                if len(ssh) > 0:
-                    sql = ("DELETE FROM account_ssh_keys WHERE account_id=%s "
-                           "AND ssh_public_key NOT IN (%s)" %
-                           (account_id,
-                            (', '.join("'%s'" % item for item in ssh))))
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                else:
-                    cmd = ('gerrit gsql -c "DELETE FROM account_ssh_keys '
-                           'WHERE account_id=%s' % account_id)
-
-                stdout, stderr = self._run_cmd(cmd)
-
-                num_key = 0
-                for ssh_key in ssh:
-                    # insert new keys
-                    sql = ("INSERT INTO account_ssh_keys (ssh_public_key, "
-                           "valid, account_id, seq) SELECT %(ssh_key)s, "
-                           "%(valid)s, %(account_id)s, %(num_key)s WHERE NOT "
-                           "EXISTS (SELECT account_id FROM account_ssh_keys "
-                           "WHERE account_id=%(account_id)s AND "
-                           "ssh_public_key=%(ssh_key)s)" %
-                           {'ssh_key': "'%s'" % ssh_key,
-                            'valid': "'Y'",
-                            'account_id': "'%s'" % account_id,
-                            'num_key': num_key})
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                    num_key += 1
-                    stdout, stderr = self._run_cmd(cmd)
-
-                # replace external id
-                if openid:
-                    openid = openid.replace('login.launchpad.net',
-                                            'login.ubuntu.com')
-                    sql = ("DELETE FROM account_external_ids WHERE "
-                           "account_id=%s AND external_id NOT IN (%s) AND "
-                           "external_id LIKE 'http%%'" %
-                           (account_id, "'%s'" % openid))
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                    stdout, stderr = self._run_cmd(cmd)
-
-                    # replace launchpad for ubuntu account
-                    sql = ("INSERT INTO account_external_ids "
-                           "(account_id, email_address, external_id) SELECT "
-                           "%(account_id)s, %(email_address)s, "
-                           "%(external_id)s WHERE NOT EXISTS (SELECT "
-                           "account_id FROM account_external_ids WHERE "
-                           "account_id=%(account_id)s AND "
-                           "external_id=%(external_id)s)" %
-                           {'account_id': "'%s'" % account_id,
-                            'email_address': "'%s'" % str(email),
-                            'external_id': "'%s'" % openid})
-                    cmd = ('gerrit gsql -c "%s"' % (sql))
-                    stdout, stderr = self._run_cmd(cmd)
+            if stderr.startswith('fatal') and 'already exists' not in stderr:
+                log("Failed to create account %s (stderr='%s')." %
+                    (login, stderr.strip()), level=ERROR)
+                status[login] = 'failed'
+                continue
+            status[login] = 'updated' if stderr else 'created'
+            details[login] = (email, ssh, openid)
+
+        # retrieve user ids
+        account_ids = self.get_account_ids(details.keys())
+
+        # if found, update ssh keys and openid
+        statements = []
+        for login, (email, ssh, openid) in details.iteritems():
+            if login not in account_ids:
+                log('No account id found for %s.' % login, level=WARNING)
+                continue
+            statements.extend(
+                (login, sql) for sql in self._account_statements(
+                    account_ids[login], email, ssh, openid))
+
+        for login, sql, error in self.gsql_batch(statements):
+            log("Failed to update account %s: %s (sql='%s')." %
+                (login, error, sql), level=ERROR)
+            status[login] = 'failed'
+
+        if statements:
+            self.defer('flush-caches')
+        return status
+
+    def add_group_members(self, group, users):
+        """Add users to group, GSQL_BATCH_SIZE at a time with set-members.
+        Users that are already members are left alone.
+
+        A single bad account fails the whole set-members, so the users of a
+        chunk that failed are retried one at a time to find which of them
+        could not be added.
+
+        Returns the list of users that could not be added.
+        """
+        failed = []
+        added = False
+        for i in range(0, len(users), GSQL_BATCH_SIZE):
+            chunk = users[i:i + GSQL_BATCH_SIZE]
+            stderr = self._set_members(group, chunk)
+            if not stderr.startswith('fatal'):
+                added = True
+                continue
+            if len(chunk) > 1:
+                log("Failed to add %d members to group '%s' (stderr='%s'), "
+                    "adding them one at a time." %
+                    (len(chunk), group, stderr.strip()), level=WARNING)
+                for user in chunk:
+                    stderr = self._set_members(group, [user])
+                    if not stderr.startswith('fatal'):
+                        added = True
+                        continue
+                    log("Failed to add %s to group '%s' (stderr='%s')." %
+                        (user, group, stderr.strip()), level=ERROR)
+                    failed.append(user)
+            else:
+                log("Failed to add %s to group '%s' (stderr='%s')." %
+                    (chunk[0], group, stderr.strip()), level=ERROR)
+                failed.extend(chunk)
+        if added:
+            self.defer('flush-caches')
+        return failed
+
+    def _set_members(self, group, users):
+        cmd = ('gerrit set-members "%s" %s' %
+               (group, ' '.join('--add %s' % user for user in users)))
+        stdout, stderr = self._run_cmd(cmd)
+        return stderr
 
     def create_project(self, project):
         """Create project in gerrit.
@@ -222,6 +652,11 @@ class GerritClient(object):
 
         Returns True if the operation succeeded, otherwise False.
         """
+        projects = self.list_projects()
+        if projects is not None and project in projects:
+            log("Project '%s' already exists." % project)
+            return True
+
         log('Creating gerrit project %s' % project)
 
         cmd = ('gerrit create-project %s' % project)
@@ -239,9 +674,31 @@ class GerritClient(object):
                 log(msg, level=WARNING)
                 return True
 
+        if projects is not None:
+            projects.add(project)
         log("Successfully created new project '%s'." % project, level=INFO)
         return True
 
+    def list_projects(self, refresh=False):
+        """Return the set of names of all projects in gerrit.
+
+        The result of a single 'gerrit ls-projects' is cached on the
+        connection for later calls unless refresh is True.  Returns None if
+        the projects could not be listed.
+        """
+        if refresh or 'projects' not in self.ssh.cache:
+            cmd = 'gerrit ls-projects --type all --format json'
+            stdout, stderr = self._run_cmd(cmd)
+            try:
+                if stderr:
+                    raise ValueError(stderr.strip())
+                projects = set(json.loads(stdout or '{}'))
+            except ValueError as exc:
+                log("Failed to list projects (%s)." % exc, level=WARNING)
+                return None
+            self.ssh.cache['projects'] = projects
+        return self.ssh.cache['projects']
+
     def create_group(self, group):
         """Create group in gerrit.
 
@@ -267,8 +724,76 @@ class GerritClient(object):
                 log(msg, level=WARNING)
                 return
 
+        # The cached group list no longer includes every group.
+        self.ssh.cache.pop('groups', None)
         log("Successfully created new group '%s'." % group, level=INFO)
+        return True
+
+    def list_groups(self, refresh=False):
+        """Return a dict mapping the name of every gerrit group to its UUID.
+
+        The result of a single 'gerrit ls-groups' is cached on the connection
+        for later calls unless refresh is True.  Returns None if the groups
+        could not be listed.
+        """
+        if refresh or 'groups' not in self.ssh.cache:
+            stdout, stderr = self._run_cmd('gerrit ls-groups --verbose')
+            if stderr:
+                log("Failed to list groups (stderr='%s')." % stderr.strip(),
+                    level=WARNING)
+                return None
+
+            groups = {}
+            for line in stdout.splitlines():
+                fields = line.split('\t')
+                if len(fields) > 1:
+                    groups[fields[0]] = fields[1]
+            self.ssh.cache['groups'] = groups
+        return self.ssh.cache['groups']
+
+    def create_groups(self, groups):
+        """Create every group in groups that does not already exist.
+
+        Existing groups are listed once and only the missing ones are
+        created, concurrently.  Falls back to create_group() for each group
+        if groups cannot be listed.
+
+        Returns the list of groups that were created.
+        """
+        existing = self.list_groups()
+        if existing is None:
+            return [g for g in groups if self.create_group(g)]
+
+        missing = [g for g in groups if g not in existing]
+        if not missing:
+            log('All %d gerrit groups already exist.' % len(groups))
+            return []
+
+        log('Creating gerrit groups %s' % ', '.join(missing))
+        cmds = ['gerrit create-group "%s"' % g for g in missing]
+        created = []
+        for group, (_, stderr, _) in zip(missing, self._run_cmds(cmds)):
+            if not stderr:
+                created.append(group)
+            elif stderr.startswith('fatal: Name Already Used'):
+                # Created since it was listed, nothing for us to do.
+                log("Group '%s' already exists." % group, level=WARNING)
+            else:
+                msg = ("Failed to create group '%s' (stderr='%s')." %
+                       (group, stderr.strip()))
+                log(msg, level=ERROR)
+
+        # Pick up the UUIDs of the new groups.
+        self.list_groups(refresh=True)
+        log("Created %d new gerrit groups." % len(created), level=INFO)
+        return created
 
     def flush_cache(self):
+        """Flush gerrit's caches.  Returns True if the flush succeeded."""
         cmd = ('gerrit flush-caches')
-        self._run_cmd(cmd)
+        stdout, stderr = self._run_cmd(cmd)
+        if stderr:
+            log("Failed to flush caches (stderr='%s')." % stderr.strip(),
+                level=WARNING)
+            return False
+        return True
@@ -0,0 +1,186 @@
+import json
+import os
+import subprocess
+import time
+
+from functools import wraps
+
+from charmhelpers.core.hookenv import (
+    log,
+    INFO,
+)
+
+TRACE_FILE = os.path.join('/var', 'log', 'ci-configurator', 'trace.jsonl')
+# Size past which the trace file is moved to <file>.1, replacing the previous
+# one, before more records are appended.
+MAX_TRACE_SIZE = 10 * 1024 * 1024
+
+# Names of the currently open spans, outermost first.
+_stack = []
+# Completed spans and commands, in order of completion.
+_records = []
+
+
+class _Span(object):
+    """Context manager timing a named phase.
+
+    Spans nest, so a span 'clone' opened inside 'create_projects/neutron' is
+    recorded as 'create_projects/neutron/clone'.  If ``cmd`` is given the
+    span is recorded as a command and its exit status should be set on the
+    returned record by the caller; otherwise status is 0 on success and 1 if
+    an exception escapes.
+    """
+    def __init__(self, name, cmd=None):
+        self.name = name
+        self.cmd = cmd
+        self.record = None
+
+    def __enter__(self):
+        _stack.append(self.name)
+        self.record = {'name': '/'.join(_stack),
+                       'kind': 'cmd' if self.cmd is not None else 'span',
+                       'start': time.time(),
+                       'status': 0}
+        if self.cmd is not None:
+            if isinstance(self.cmd, basestring):
+                self.record['cmd'] = self.cmd
+            else:
+                self.record['cmd'] = ' '.join(self.cmd)
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _stack.pop()
+        self.record['duration'] = time.time() - self.record['start']
+        if exc_type is not None and not self.record['status']:
+            self.record['status'] = getattr(exc_value, 'returncode', 1)
+        _records.append(self.record)
+        return False
+
+
+def span(name):
+    """Time a named phase, e.g.
+
+        with trace.span('clone'):
+            ...
+    """
+    return _Span(name)
+
+
+def command(cmd, name=None):
+    """Time a single external command.  Returns a record whose 'status' the
+    caller should set to the command's exit status.
+    """
+    if name is None:
+        if isinstance(cmd, basestring):
+            name = cmd.split()[0]
+        else:
+            name = os.path.basename(cmd[0])
+    return _Span(name, cmd=cmd)
+
+
+def add(name, cmd, start, duration, status):
+    """Record a command timed elsewhere, e.g. on a worker thread, as a child
+    of the current span."""
+    _records.append({'name': '/'.join(_stack + [name]),
+                     'kind': 'cmd',
+                     'cmd': cmd,
+                     'start': start,
+                     'duration': duration,
+                     'status': status})
+
+
+def phase(f):
+    """Decorator recording every call of f as a span named after it."""
+    @wraps(f)
+    def wrapped_f(*args, **kwargs):
+        with span(f.__name__):
+            return f(*args, **kwargs)
+    return wrapped_f
+
+
+def run(func, cmd, *args, **kwargs):
+    """Run cmd with one of the subprocess call functions, recording its
+    duration and exit status, e.g.
+
+        trace.run(subprocess.check_call, ['git', 'init'])
+    """
+    with command(cmd) as record:
+        ret = func(cmd, *args, **kwargs)
+        if func is subprocess.call:
+            record['status'] = ret
+        return ret
+
+
+def records():
+    """Return the spans and commands recorded so far."""
+    return list(_records)
+
+
+def reset():
+    """Discard the spans and commands recorded so far, and any spans left
+    open by an exception."""
+    del _records[:]
+    del _stack[:]
+
+
+def summary():
+    """Aggregate recorded spans and commands by name.
+
+    Returns a list of (name, count, failures, total, max) tuples sorted by
+    total time, slowest first.
+    """
+    totals = {}
+    for record in _records:
+        count, failures, total, longest = totals.get(record['name'],
+                                                     (0, 0, 0.0, 0.0))
+        totals[record['name']] = (count + 1,
+                                  failures + (1 if record['status'] else 0),
+                                  total + record['duration'],
+                                  max(longest, record['duration']))
+    rows = [(name,) + values for name, values in totals.iteritems()]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def log_summary(limit=25):
+    """Write a table of the slowest recorded phases to the log."""
+    rows = summary()
+    if not rows:
+        return
+
+    lines = ['%-60s %6s %6s %10s %10s' %
+             ('phase', 'count', 'failed', 'total(s)', 'max(s)')]
+    for name, count, failures, total, longest in rows[:limit]:
+        lines.append('%-60s %6d %6d %10.2f %10.2f' %
+                     (name, count, failures, total, longest))
+    log('Trace summary:\n%s' % '\n'.join(lines), level=INFO)
+
+
+def write(path=None):
+    """Append recorded spans and commands to path as JSON lines.
+
+    Once path has grown past MAX_TRACE_SIZE it is rotated to path.1 first.
+    """
+    path = path or os.getenv('CI_CONFIGURATOR_TRACE_FILE', TRACE_FILE)
+    if not _records:
+        return
+
+    trace_dir = os.path.dirname(path)
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    if os.path.isfile(path) and os.path.getsize(path) >= MAX_TRACE_SIZE:
+        os.rename(path, path + '.1')
+
+    with open(path, 'a') as f:
+        for record in _records:
+            f.write(json.dumps(record) + '\n')
+
+
+def finish(path=None):
+    """Write the trace file and summary, then reset recorded state."""
+    try:
+        write(path)
+        log_summary()
+    except (IOError, OSError) as exc:
+        log('Failed to write trace (%s)' % exc)
+    finally:
+        reset()
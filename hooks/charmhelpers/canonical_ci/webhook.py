@@ -0,0 +1,216 @@
+import argparse
+import BaseHTTPServer
+import hashlib
+import hmac
+import json
+import os
+import pipes
+import sys
+import threading
+import time
+
+from charmhelpers.core.hookenv import ERROR, INFO, WARNING
+from charmhelpers.core.host import service_restart, service_stop
+from charmhelpers.canonical_ci import cron
+from charmhelpers.canonical_ci.cron import log
+
+SERVICE = 'ci-configurator-webhook'
+UPSTART_CONF = os.path.join('/etc', 'init', SERVICE + '.conf')
+SECRET_FILE = os.path.join('/etc', 'ci-configurator', 'webhook-secret')
+# Seconds to wait after the last push before updating, so that a burst of
+# pushes results in a single update.
+DEBOUNCE_DELAY = 10
+
+UPSTART_TEMPLATE = """description "ci-configurator webhook listener"
+
+start on runlevel [2345]
+stop on runlevel [!2345]
+
+respawn
+setuid %(user)s
+
+exec %(command)s
+"""
+
+
+class Debouncer(object):
+    """Calls action once delay seconds have passed without a trigger().
+
+    Triggers received while action is running cause it to be called again
+    afterwards.  If action returns None, as cron.run_job() does when the
+    job is already running, it is retried after another delay.
+    """
+    def __init__(self, action, delay=DEBOUNCE_DELAY):
+        self.action = action
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._due = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def trigger(self):
+        with self._cond:
+            self._due = time.time() + self.delay
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                if self._due is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._due - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._due = None
+            try:
+                result = self.action()
+            except Exception as exc:
+                log('Webhook job failed: %s' % exc, ERROR)
+                continue
+            if result is None:
+                with self._cond:
+                    if self._due is None:
+                        self._due = time.time() + self.delay
+
+
+def _equal(a, b):
+    """Compare a and b in constant time; hmac.compare_digest() only exists
+    from python 2.7.7."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def check_signature(secret, body, headers):
+    """Return True if the request is signed with secret, either github
+    style with an X-Hub-Signature HMAC of the body or by passing the secret
+    itself as X-Webhook-Token (e.g. from a post-receive hook).
+
+    Without a secret every request is accepted, so make_server() then only
+    listens on localhost.
+    """
+    if not secret:
+        return True
+    signature = headers.get('X-Hub-Signature', '')
+    if signature:
+        expected = 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest()
+        return _equal(signature, expected)
+    return _equal(headers.get('X-Webhook-Token', ''), secret)
+
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST / queues an update of the job, GET /status returns the status
+    of its last run."""
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body) + '\n')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not check_signature(self.server.secret, body, self.headers):
+            self._reply(403, {'error': 'bad signature'})
+            return
+        self.server.debouncer.trigger()
+        self._reply(202, {'queued': self.server.name})
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/status':
+            self._reply(404, {'error': 'not found'})
+            return
+        if not check_signature(self.server.secret, '', self.headers):
+            self._reply(403, {'error': 'bad signature'})
+            return
+        self._reply(200, cron.read_status(self.server.name))
+
+    def log_message(self, fmt, *args):
+        log('webhook: %s %s' % (self.address_string(), fmt % args), INFO)
+
+
+def make_server(port, name, job, secret=None, delay=DEBOUNCE_DELAY,
+                address=None):
+    """Return an HTTP server queueing cron.run_job(name, job) on each
+    push it is sent.
+
+    Unless an address is given, the server listens on all interfaces if a
+    secret is set and only on localhost otherwise.
+    """
+    if address is None:
+        address = '' if secret else '127.0.0.1'
+    if not secret and address != '127.0.0.1':
+        log('No webhook secret set, anyone who can reach port %d can '
+            'trigger updates.' % port, WARNING)
+    server = BaseHTTPServer.HTTPServer((address, port), WebhookHandler)
+    server.name = name
+    server.secret = secret
+    server.debouncer = Debouncer(lambda: cron.run_job(name, job), delay)
+    return server
+
+
+def install(port, user, name, job, secret=''):
+    """Install and (re)start the webhook listener running job."""
+    # Created readable by its owner only, so the secret is never exposed.
+    fd = os.open(SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    os.fchmod(fd, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secret)
+    os.chown(SECRET_FILE, *cron.user_ids(user))
+    cron.prepare_job(name, user)
+
+    script = os.path.join(os.environ['CHARM_DIR'], 'scripts',
+                          'webhook_listener.py')
+    command = ' '.join(pipes.quote(arg) for arg in
+                       [script, '--port', str(port), '--secret-file',
+                        SECRET_FILE, name, job])
+    with open(UPSTART_CONF, 'w') as f:
+        f.write(UPSTART_TEMPLATE % {'user': user, 'command': command})
+    log('Wrote webhook listener job to %s.' % UPSTART_CONF, INFO)
+    service_restart(SERVICE)
+
+
+def remove():
+    """Stop and remove the webhook listener, if installed."""
+    if not os.path.exists(UPSTART_CONF):
+        return
+    service_stop(SERVICE)
+    os.unlink(UPSTART_CONF)
+    log('Removed webhook listener job %s.' % UPSTART_CONF, INFO)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a job when a push webhook is received.')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--secret-file',
+                        help='file containing the shared webhook secret')
+    parser.add_argument('--delay', type=float, default=DEBOUNCE_DELAY,
+                        help='seconds to wait for further pushes')
+    parser.add_argument('name', help='name of the job')
+    parser.add_argument('job', help='shell command to run')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    secret = None
+    if args.secret_file:
+        with open(args.secret_file) as f:
+            secret = f.read().strip()
+    server = make_server(args.port, args.name, args.job, secret, args.delay)
+    log('Listening for webhooks on %s:%d.' % server.server_address, INFO)
+    server.serve_forever()
@@ -198,15 +198,52 @@ def mounts():
     return system_mounts
 
 
+# Size of the reads used to hash files.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Hash of each file hashed by file_hash(), keyed by path, along with the
+# (device, inode, size, mtime) of the file it was computed for.
+_hash_memo = {}
+
+
 def file_hash(path):
-    """Generate a md5 hash of the contents of 'path' or None if not found """
-    if os.path.exists(path):
-        h = hashlib.md5()
-        with open(path, 'r') as source:
-            h.update(source.read())  # IGNORE:E1101 - it does have update
-        return h.hexdigest()
-    else:
+    """Generate a md5 hash of the contents of 'path' or None if not found
+
+    The file is read in chunks rather than at once, and is not read again
+    by later calls while its inode, size and mtime are unchanged."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        _hash_memo.pop(path, None)
         return None
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    memo = _hash_memo.get(path)
+    if memo and memo[0] == key:
+        return memo[1]
+
+    # md5 is still the fastest of the hashlib digests here.
+    h = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), ''):
+            h.update(chunk)  # IGNORE:E1101 - it does have update
+    _hash_memo[path] = (key, h.hexdigest())
+    return h.hexdigest()
+
+
+def path_hash(path):
+    """Generate a md5 hash of 'path', or None if not found.  If 'path' is a
+    directory the hash covers the names and contents of every file below
+    it."""
+    if not os.path.isdir(path):
+        return file_hash(path)
+    h = hashlib.md5()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            h.update('%s\0%s\0' % (os.path.relpath(filename, path),
+                                    file_hash(filename)))
+    return h.hexdigest()
 
 
 def restart_on_change(restart_map, stopstart=False):
@@ -222,17 +259,18 @@ def restart_on_change(restart_map, stopstart=False):
 
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
-    ceph_client_changed function.
+    ceph_client_changed function.  A path may also be a directory, in
+    which case a change to any file below it triggers the restart.
     """
     def wrap(f):
         def wrapped_f(*args):
             checksums = {}
             for path in restart_map:
-                checksums[path] = file_hash(path)
+                checksums[path] = path_hash(path)
             f(*args)
             restarts = []
             for path in restart_map:
-                if checksums[path] != file_hash(path):
+                if checksums[path] != path_hash(path):
                     restarts += restart_map[path]
             services_list = list(OrderedDict.fromkeys(restarts))
             if not stopstart:
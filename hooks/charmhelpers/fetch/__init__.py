@@ -106,25 +106,98 @@ class BaseFetchHandler(object):
         return urlunparse(parts)
 
 
+# apt_pkg.Cache() of the installed packages, built on first use and kept
+# until apt changes them, and the installed version of each package looked
+# up in it (None if it is not installed).
+_apt_cache = None
+_package_state = {}
+
+
+def invalidate_package_cache():
+    """Forget the cached package state, e.g. after running apt-get."""
+    global _apt_cache
+    _apt_cache = None
+    _package_state.clear()
+
+
+def _get_apt_cache():
+    global _apt_cache
+    if _apt_cache is None:
+        apt_pkg.init()
+
+        # Tell apt to build an in-memory cache to prevent race conditions (if
+        # another process is already building the cache).
+        apt_pkg.config.set("Dir::Cache::pkgcache", "")
+
+        _apt_cache = apt_pkg.Cache()
+    return _apt_cache
+
+
+def installed_versions(packages):
+    """Returns a dict mapping each of packages to its installed version, or
+    None if it is not installed.
+
+    The apt cache is only read once per process, until a package is
+    installed or removed with the functions of this module."""
+    missing = [p for p in packages if p not in _package_state]
+    if missing:
+        cache = _get_apt_cache()
+        for package in missing:
+            try:
+                current_ver = cache[package].current_ver
+            except KeyError:
+                log('Package {} has no installation candidate.'.format(
+                    package), level='WARNING')
+                current_ver = None
+            _package_state[package] = current_ver and current_ver.ver_str
+    return dict((p, _package_state[p]) for p in packages)
+
+
 def filter_installed_packages(packages):
     """Returns a list of packages that require installation"""
-    apt_pkg.init()
+    versions = installed_versions(packages)
+    return [p for p in packages if not versions[p]]
+
 
-    # Tell apt to build an in-memory cache to prevent race conditions (if
-    # another process is already building the cache).
-    apt_pkg.config.set("Dir::Cache::pkgcache", "")
+# Packages queued by queue_packages() for the next install_queued_packages(),
+# as (options, packages) pairs so that each set of apt-get options only
+# applies to the packages it was queued with.
+_queued_packages = []
 
-    cache = apt_pkg.Cache()
-    _pkgs = []
+
+def queue_packages(packages, options=None):
+    """Note that packages are needed, so that they are installed along with
+    every other package queued with the same options by
+    install_queued_packages()"""
+    if isinstance(packages, basestring):
+        packages = [packages]
+    if options is not None:
+        options = list(options)
+    for queued_options, queued in _queued_packages:
+        if queued_options == options:
+            break
+    else:
+        queued = []
+        _queued_packages.append((options, queued))
     for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+        if not any(package in q for _, q in _queued_packages):
+            queued.append(package)
+
+
+def install_queued_packages(fatal=False):
+    """Install the queued packages that are not yet installed, in one
+    apt-get transaction per set of options, and empty the queue.
+
+    Returns the packages that were installed."""
+    groups = list(_queued_packages)
+    del _queued_packages[:]
+    installed = []
+    for options, queued in groups:
+        packages = filter_installed_packages(queued)
+        if packages:
+            apt_install(packages, options=options, fatal=fatal)
+            installed.extend(packages)
+    return installed
 
 
 def apt_install(packages, options=None, fatal=False):
@@ -317,24 +390,28 @@ def _run_apt_command(cmd, fatal=False):
     if 'DEBIAN_FRONTEND' not in env:
         env['DEBIAN_FRONTEND'] = 'noninteractive'
 
-    if fatal:
-        retry_count = 0
-        result = None
-
-        # If the command is considered "fatal", we need to retry if the apt
-        # lock was not acquired.
-
-        while result is None or result == APT_NO_LOCK:
-            try:
-                result = subprocess.check_call(cmd, env=env)
-            except subprocess.CalledProcessError, e:
-                retry_count = retry_count + 1
-                if retry_count > APT_NO_LOCK_RETRY_COUNT:
-                    raise
-                result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
-
-    else:
-        subprocess.call(cmd, env=env)
+    try:
+        if fatal:
+            retry_count = 0
+            result = None
+
+            # If the command is considered "fatal", we need to retry if the
+            # apt lock was not acquired.
+
+            while result is None or result == APT_NO_LOCK:
+                try:
+                    result = subprocess.check_call(cmd, env=env)
+                except subprocess.CalledProcessError, e:
+                    retry_count = retry_count + 1
+                    if retry_count > APT_NO_LOCK_RETRY_COUNT:
+                        raise
+                    result = e.returncode
+                    log("Couldn't acquire DPKG lock. Will retry in {} "
+                        "seconds.".format(APT_NO_LOCK_RETRY_DELAY))
+                    time.sleep(APT_NO_LOCK_RETRY_DELAY)
+
+        else:
+            subprocess.call(cmd, env=env)
+    finally:
+        # Packages may have been installed or removed even if apt failed.
+        invalidate_package_cache()
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import urllib2
 import urlparse
@@ -10,11 +11,25 @@ from charmhelpers.payload.archive import (
     get_archive_handler,
     extract,
 )
+from charmhelpers.core.hookenv import log
 from charmhelpers.core.host import mkdir
 
+# Size of the reads and writes used to stream downloads to disk.
+CHUNK_SIZE = 64 * 1024
+
+
+class ChecksumError(ValueError):
+    pass
+
 
 class ArchiveUrlFetchHandler(BaseFetchHandler):
-    """Handler for archives via generic URLs"""
+    """Handler for archives via generic URLs
+
+    A sha256 of the archive may be given in the url fragment, as in
+    http://example.com/foo.tgz#sha256=<hexdigest>, to check the download.
+    Downloads are kept under $CHARM_DIR/fetched, keyed by url and checksum,
+    and reused by later installs of the same source.
+    """
     def can_handle(self, source):
         url_parts = self.parse_url(source)
         if url_parts.scheme not in ('http', 'https', 'ftp', 'file'):
@@ -23,9 +38,9 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
-        # propogate all exceptions
-        # URLError, OSError, etc
+    def _strip_auth(self, source):
+        """Install an opener for any credentials in source and return it
+        without them."""
         proto, netloc, path, params, query, fragment = urlparse.urlparse(source)
         if proto in ('http', 'https'):
             auth, barehost = urllib2.splituser(netloc)
@@ -39,25 +54,80 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
                 authhandler = urllib2.HTTPBasicAuthHandler(passman)
                 opener = urllib2.build_opener(authhandler)
                 urllib2.install_opener(opener)
-        response = urllib2.urlopen(source)
+        return source
+
+    def download(self, source, dest, checksum=None):
+        """Stream source to dest, checking it against the sha256 checksum if
+        given.
+
+        The data is written to dest.part first; if that is left by an
+        interrupted download of an http(s) source, the rest of it is
+        requested with a Range header instead of starting again.
+        """
+        # propogate all exceptions
+        # URLError, OSError, etc
+        source = self._strip_auth(source)
+        partial = dest + '.part'
+        offset = 0
+        request = urllib2.Request(source)
+        if (self.parse_url(source).scheme in ('http', 'https') and
+                os.path.isfile(partial)):
+            offset = os.path.getsize(partial)
+            request.add_header('Range', 'bytes=%d-' % offset)
+
         try:
-            with open(dest, 'w') as dest_file:
-                dest_file.write(response.read())
-        except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
-            raise e
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code != 416:
+                raise
+            # The partial download can't be resumed, start again.
+            os.unlink(partial)
+            return self.download(source, dest, checksum)
+
+        digest = hashlib.sha256()
+        if offset and response.getcode() == 206:
+            log('Resuming download of %s at byte %d' % (source, offset))
+            mode = 'ab'
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    digest.update(chunk)
+        else:
+            mode = 'wb'
+
+        with open(partial, mode) as dest_file:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                dest_file.write(chunk)
+                digest.update(chunk)
+
+        if checksum and digest.hexdigest() != checksum.lower():
+            os.unlink(partial)
+            raise ChecksumError('%s has sha256 %s, expected %s' %
+                                (source, digest.hexdigest(), checksum))
+        os.rename(partial, dest)
+
+    def cache_path(self, source, checksum=None):
+        """Return where the download of source is kept."""
+        url = urlparse.urldefrag(self._strip_auth(source))[0]
+        key = hashlib.sha256('%s#%s' % (url, checksum or '')).hexdigest()
+        return os.path.join(os.environ.get('CHARM_DIR'), 'fetched', key,
+                            os.path.basename(self.parse_url(url).path))
 
     def install(self, source):
-        url_parts = self.parse_url(source)
-        dest_dir = os.path.join(os.environ.get('CHARM_DIR'), 'fetched')
+        url, fragment = urlparse.urldefrag(source)
+        checksum = urlparse.parse_qs(fragment).get('sha256', [None])[0]
+        dld_file = self.cache_path(source, checksum)
+        dest_dir = os.path.dirname(dld_file)
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0755)
-        dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
-        try:
-            self.download(source, dld_file)
-        except urllib2.URLError as e:
-            raise UnhandledSource(e.reason)
-        except OSError as e:
-            raise UnhandledSource(e.strerror)
+        if os.path.isfile(dld_file):
+            log('Using cached download %s' % dld_file)
+        else:
+            try:
+                self.download(url, dld_file, checksum)
+            except urllib2.URLError as e:
+                raise UnhandledSource(e.reason)
+            except OSError as e:
+                raise UnhandledSource(e.strerror)
+            except ChecksumError as e:
+                raise UnhandledSource(str(e))
         return extract(dld_file)
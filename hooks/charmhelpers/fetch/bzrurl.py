@@ -3,6 +3,7 @@ from charmhelpers.fetch import (
     BaseFetchHandler,
     UnhandledSource
 )
+from charmhelpers.core.hookenv import log
 from charmhelpers.core.host import mkdir
 
 try:
@@ -11,6 +12,8 @@ except ImportError:
     from charmhelpers.fetch import apt_install
     apt_install("python-bzrlib")
     from bzrlib.branch import Branch
+from bzrlib.bzrdir import BzrDir
+from bzrlib.errors import NotBranchError, NoWorkingTree
 
 
 class BzrUrlFetchHandler(BaseFetchHandler):
@@ -22,7 +25,19 @@ class BzrUrlFetchHandler(BaseFetchHandler):
         else:
             return True
 
+    def shared_repository(self, path):
+        """Make path a shared repository, so that the branches fetched into
+        it share their revisions."""
+        if not os.path.exists(os.path.join(path, '.bzr')):
+            log("Creating shared repository {}".format(path))
+            BzrDir.create(path).create_repository(shared=True)
+
     def branch(self, source, dest):
+        """Branch source into dest or, if dest is already a branch, pull the
+        new revisions of source into it.
+
+        Returns the number of revisions added to the branch, which is 0 if
+        overwriting it with source went back in history."""
         url_parts = self.parse_url(source)
         # If we use lp:branchname scheme we need to load plugins
         if not self.can_handle(source):
@@ -30,21 +45,33 @@ class BzrUrlFetchHandler(BaseFetchHandler):
         if url_parts.scheme == "lp":
             from bzrlib.plugin import load_plugins
             load_plugins()
+        remote_branch = Branch.open(source)
         try:
-            remote_branch = Branch.open(source)
-            remote_branch.bzrdir.sprout(dest).open_branch()
-        except Exception as e:
-            raise e
+            local_branch = Branch.open(dest)
+        except NotBranchError:
+            local_branch = remote_branch.bzrdir.sprout(dest).open_branch()
+            return local_branch.revno()
+
+        try:
+            tree = local_branch.bzrdir.open_workingtree()
+        except NoWorkingTree:
+            result = local_branch.pull(remote_branch, overwrite=True)
+        else:
+            result = tree.pull(remote_branch, overwrite=True)
+        return max(0, result.new_revno - result.old_revno)
 
     def install(self, source):
         url_parts = self.parse_url(source)
         branch_name = url_parts.path.strip("/").split("/")[-1]
-        dest_dir = os.path.join(os.environ.get('CHARM_DIR'), "fetched",
-                                branch_name)
+        fetched_dir = os.path.join(os.environ.get('CHARM_DIR'), "fetched")
+        dest_dir = os.path.join(fetched_dir, branch_name)
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0755)
         try:
-            self.branch(source, dest_dir)
+            self.shared_repository(fetched_dir)
+            revisions = self.branch(source, dest_dir)
         except OSError as e:
             raise UnhandledSource(e.strerror)
+        log("Fetched {} new revision(s) of {} into {}".format(
+            revisions, source, dest_dir))
         return dest_dir
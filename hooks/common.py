@@ -6,6 +6,7 @@ import yaml
 
 from charmhelpers.core.host import adduser, add_user_to_group
 from charmhelpers.core.hookenv import charm_dir, config, log, ERROR
+from charmhelpers.canonical_ci import trace
 
 PACKAGES = [
     'bzr'
@@ -141,7 +142,8 @@ def _run_as_user(user):
 
 
 def run_as_user(user, cmd, cwd='/'):
-    return subprocess.check_output(cmd, preexec_fn=_run_as_user(user), cwd=cwd)
+    return trace.run(subprocess.check_output, cmd,
+                     preexec_fn=_run_as_user(user), cwd=cwd)
 
 
 def ensure_user():
@@ -1,5 +1,8 @@
 from base64 import b64decode
 import common
+import hashlib
+import launchpad_sync
+import json
 import os
 import re
 import shutil
@@ -9,8 +12,8 @@ import urlparse
 import yaml
 
 from charmhelpers.fetch import (
-    apt_install,
-    filter_installed_packages
+    install_queued_packages,
+    queue_packages
 )
 from charmhelpers.core.hookenv import (
     charm_dir,
@@ -23,12 +26,14 @@ from charmhelpers.core.hookenv import (
     INFO,
     ERROR
 )
+from charmhelpers.core.host import path_hash
 from charmhelpers.canonical_ci.gerrit import (
     GerritClient,
+    parse_gsql,
     start_gerrit,
     stop_gerrit
 )
-from charmhelpers.canonical_ci import cron
+from charmhelpers.canonical_ci import cron, trace
 
 GERRIT_INIT_SCRIPT = '/etc/init.d/gerrit'
 GERRIT_CONFIG_DIR = os.path.join(common.CI_CONFIG_DIR, 'gerrit')
@@ -45,15 +50,21 @@ GERRIT_HOME = os.path.join('/home', GERRIT_USER)
 WAR_PATH = os.path.join(GERRIT_HOME, 'gerrit-wars', 'gerrit.war')
 SITE_PATH = os.path.join(GERRIT_HOME, 'review_site')
 LOGS_PATH = os.path.join(SITE_PATH, 'logs')
-LAUNCHPAD_DIR = os.path.join(GERRIT_HOME, '.launchpadlib')
+LAUNCHPAD_DIR = launchpad_sync.LAUNCHPAD_DIR
 TEMPLATES = 'templates'
 INITIAL_PERMISSIONS_COMMIT_MSG = "@ CI-CONFIGURATOR INITIAL PERMISSIONS SET @"
+PERMISSIONS_SYNC_COMMIT_MSG = "Update permissions from ci-configurator"
+# refs/meta/config commit of each repository whose permissions were last
+# found to be initialised or synced.
+PERMISSIONS_STATE_FILE = os.path.join(GERRIT_HOME,
+                                      '.ci-configurator-permissions.json')
 
 
 class GerritConfigurationException(Exception):
     pass
 
 
+@trace.phase
 def update_theme(theme_dest, static_dest):
     if not os.path.isdir(THEME_DIR):
         log('Gerrit theme directory not found @ %s, skipping theme refresh.' %
@@ -68,20 +79,24 @@ def update_theme(theme_dest, static_dest):
             'Skipping theme refresh.' % THEME_DIR, level=WARNING)
         return False
 
+    before = [path_hash(theme_dest), path_hash(static_dest)]
     log('Installing theme from %s to %s.' % (theme_orig, theme_dest))
     common.sync_dir(theme_orig, theme_dest)
     log('Installing static files from %s to %s.' % (theme_orig, theme_dest))
     common.sync_dir(static_orig, static_dest)
 
-    return True
+    # Only restart gerrit if the theme actually changed.
+    return [path_hash(theme_dest), path_hash(static_dest)] != before
 
 
+@trace.phase
 def update_hooks(hooks_dest, settings):
     if not os.path.isdir(HOOKS_DIR):
         log('Gerrit hooks directory not found @ %s, skipping hooks refresh.' %
             HOOKS_DIR, level=WARNING)
         return False
 
+    before = path_hash(hooks_dest)
     log('Installing gerrit hooks in %s to %s.' % (HOOKS_DIR, hooks_dest))
     common.sync_dir(HOOKS_DIR, hooks_dest)
 
@@ -97,55 +112,66 @@ def update_hooks(hooks_dest, settings):
             with open(current_path, 'w') as f:
                 f.write(contents)
 
-    return True
+    return path_hash(hooks_dest) != before
 
 
-def setup_gerrit_groups(gerritperms_path, admin_username, admin_email):
-    """Generate groups file"""
-    cwd = os.getcwd()
-    os.chdir(gerritperms_path)
-    try:
-        query = 'SELECT name, group_uuid FROM account_groups'
-        cmd = ['java', '-jar', WAR_PATH, 'gsql', '-d', SITE_PATH, '-c', query]
-        result = subprocess.check_output(cmd)
-        if result:
-            # parse file and generate groups
-            output = result.splitlines()
-            with open('groups', 'w') as f:
-                for item in output[2:]:
-                    # split between name and id
-                    data = item.split('|')
-                    if len(data) == 2:
-                        group_cfg = ('%s\t%s\n' %
-                                     (data[1].strip(), data[0].strip()))
-                        f.write(group_cfg)
-
-            cmds = [['git', 'config', '--global', 'user.name',
-                     admin_username],
-                    ['git', 'config', '--global', 'user.email',
-                     admin_email],
-                    ['git', 'commit', '-a', '-m', '"%s"' %
-                     (INITIAL_PERMISSIONS_COMMIT_MSG)],
-                    ['git', 'push', 'repo', 'meta/config:meta/config']]
-            for cmd in cmds:
-                common.run_as_user(user=GERRIT_USER, cmd=cmd,
-                                   cwd=gerritperms_path)
-        else:
-            msg = 'Failed to query gerrit db for groups'
-            raise GerritConfigurationException(msg)
-    finally:
-        os.chdir(cwd)
-
-
-def is_permissions_initialised(repo_name, repo_path):
+def query_gerrit_groups():
+    """Return a dict mapping group name to UUID read straight from the site
+    database with the offline gsql.  This starts a JVM so is only used when
+    gerrit cannot be asked over ssh.
+    """
+    query = 'SELECT name, group_uuid FROM account_groups'
+    cmd = ['java', '-jar', WAR_PATH, 'gsql', '-d', SITE_PATH,
+           '--format', 'JSON', '-c', query]
+    groups = {}
+    with trace.command(cmd) as record:
+        # parse rows as gsql prints them
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        for row in parse_gsql(iter(proc.stdout.readline, '')):
+            groups[row['name']] = row['group_uuid']
+        record['status'] = proc.wait()
+    if record['status']:
+        return {}
+    return groups
+
+
+@trace.phase
+def setup_gerrit_groups(gerritperms_path, admin_username, admin_email,
+                        gerrit_client=None):
+    """Generate groups file
+
+    Group UUIDs are taken from gerrit_client's cached group list if
+    possible, falling back to querying the site database offline.
+    """
+    groups = gerrit_client.list_groups() if gerrit_client else None
+    if not groups:
+        log('Querying gerrit db for groups.', level=WARNING)
+        groups = query_gerrit_groups()
+    if not groups:
+        msg = 'Failed to query gerrit db for groups'
+        raise GerritConfigurationException(msg)
+
+    with open(os.path.join(gerritperms_path, 'groups'), 'w') as f:
+        for name, uuid in sorted(groups.iteritems()):
+            f.write('%s\t%s\n' % (uuid, name))
+
+    cmds = [['git', '-c', 'user.name=%s' % admin_username,
+             '-c', 'user.email=%s' % admin_email,
+             'commit', '-a', '-m', '"%s"' % (INITIAL_PERMISSIONS_COMMIT_MSG)],
+            ['git', 'push', 'repo', 'meta/config:meta/config']]
+    for cmd in cmds:
+        common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=gerritperms_path)
+
+
+def is_permissions_initialised(repo_name, repo_path, ref='HEAD'):
     """ The All-Projects.git repository is created by the Gerrit charm and
     configured by this charm. In order for it to be deemed initialised we need:
 
     1. expected branches
-    2. initial permissions commit message
+    2. initial permissions commit message in the history of ref
     """
     if repo_is_initialised("%s/%s" % (GIT_PATH, repo_name)):
-        cmd = ['git', 'log', '--grep', INITIAL_PERMISSIONS_COMMIT_MSG]
+        cmd = ['git', 'log', '--format=%s', ref]
         stdout = common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=repo_path)
         if stdout and INITIAL_PERMISSIONS_COMMIT_MSG in stdout:
             return True
@@ -155,8 +181,6 @@ def is_permissions_initialised(repo_name, repo_path):
         # find the new-style message we then check for > 1 of the old-style
         # message.
         old_style_msg = "Initial permissions"
-        cmd = ['git', 'log', '--grep', old_style_msg]
-        stdout = common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=repo_path)
         if stdout:
             count = 0
             for line in stdout.split('\n'):
@@ -168,6 +192,221 @@ def is_permissions_initialised(repo_name, repo_path):
     return False
 
 
+def read_ref(git_dir, ref):
+    """Return the sha1 ref points to in git_dir, or None if it does not
+    exist.  Reads the loose ref or packed-refs directly rather than forking
+    git.
+    """
+    path = os.path.join(git_dir, ref)
+    if os.path.isfile(path):
+        with open(path) as f:
+            return f.read().strip() or None
+
+    packed = os.path.join(git_dir, 'packed-refs')
+    if os.path.isfile(packed):
+        with open(packed) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    return None
+
+
+def _read_permissions_state():
+    try:
+        with open(PERMISSIONS_STATE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_permissions_state(repo_name, sha):
+    state = _read_permissions_state()
+    state[repo_name] = sha
+    with open(PERMISSIONS_STATE_FILE, 'w') as f:
+        json.dump(state, f)
+
+
+def permissions_initialised(repo_name):
+    """Check whether permissions of repo_name are initialised without
+    cloning it.
+
+    The commit refs/meta/config points to is read from the repository under
+    GIT_PATH and compared with the one recorded in PERMISSIONS_STATE_FILE
+    when it was last found to be initialised.  Only if it moved is its
+    history inspected.
+    """
+    git_dir = os.path.join(GIT_PATH, repo_name)
+    sha = read_ref(git_dir, 'refs/meta/config')
+    if not sha:
+        return False
+
+    if _read_permissions_state().get(repo_name) == sha:
+        return True
+
+    if is_permissions_initialised(repo_name, git_dir, 'refs/meta/config'):
+        _write_permissions_state(repo_name, sha)
+        return True
+    return False
+
+
+def checkout_meta_config(repo_url, path):
+    """Check out refs/meta/config of repo_url into the empty dir path."""
+    config_ref = 'refs/meta/config:refs/remotes/origin/meta/config'
+
+    for cmd in [['git', 'init'],
+                ['git', 'remote', 'add', 'repo', repo_url],
+                ['git', 'fetch', 'repo', config_ref],
+                ['git', 'checkout', 'meta/config']]:
+        common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=path)
+
+
+def git_blob_hash(data):
+    """Return the sha1 git gives a blob holding data."""
+    return hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+def permission_projects():
+    """Return a dict mapping each project with a project.config under
+    PERMISSIONS_DIR, e.g. 'All-Projects' or 'openstack/nova', to its dir.
+    """
+    projects = {}
+    for root, dirs, files in os.walk(PERMISSIONS_DIR):
+        if 'project.config' in files:
+            projects[os.path.relpath(root, PERMISSIONS_DIR)] = root
+    return projects
+
+
+def desired_permissions(path, groups):
+    """Return a dict mapping file name to the content it should have on
+    refs/meta/config: every file in path, plus a groups file generated from
+    the name -> UUID map groups unless path provides one.
+    """
+    files = {}
+    for name in os.listdir(path):
+        if os.path.isfile(os.path.join(path, name)):
+            with open(os.path.join(path, name)) as f:
+                files[name] = f.read()
+    if 'groups' not in files:
+        files['groups'] = ''.join('%s\t%s\n' % (uuid, name) for name, uuid
+                                  in sorted(groups.iteritems()))
+    return files
+
+
+def changed_permissions(git_dir, files):
+    """Return the names of files whose content differs from that on
+    refs/meta/config in git_dir, comparing blob hashes from one ls-tree.
+    """
+    cmd = ['git', 'ls-tree', 'refs/meta/config']
+    stdout = common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=git_dir)
+    current = {}
+    for line in stdout.splitlines():
+        info, _, name = line.partition('\t')
+        current[name] = info.split()[-1]
+    return sorted(name for name, data in files.iteritems()
+                  if current.get(name) != git_blob_hash(data))
+
+
+def push_permissions(repo_url, files, admin_username, admin_email, message):
+    """Commit files to refs/meta/config of repo_url and push it."""
+    tmppath = tempfile.mkdtemp('', 'gerritperms')
+    try:
+        cmd = ["chown", "%s:%s" % (GERRIT_USER, GERRIT_USER), tmppath]
+        trace.run(subprocess.check_call, cmd)
+        os.chmod(tmppath, 0774)
+
+        checkout_meta_config(repo_url, tmppath)
+        for name, data in files.iteritems():
+            with open(os.path.join(tmppath, name), 'w') as f:
+                f.write(data)
+
+        cmds = [['git', 'add', '-A'],
+                ['git', '-c', 'user.name=%s' % admin_username,
+                 '-c', 'user.email=%s' % admin_email,
+                 'commit', '-m', message],
+                ['git', 'push', 'repo', 'meta/config:meta/config']]
+        for cmd in cmds:
+            common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=tmppath)
+    finally:
+        shutil.rmtree(tmppath)
+
+
+@trace.phase
+def sync_permissions(gerrit_client, admin_username, admin_email):
+    """Bring refs/meta/config of every project under PERMISSIONS_DIR in
+    line with the config repo, pushing only projects that differ.
+
+    The desired content and refs/meta/config commit of each project are
+    recorded in PERMISSIONS_STATE_FILE so that later runs skip projects
+    where neither changed without running git at all.
+
+    Returns True if any project was updated.
+    """
+    groups = gerrit_client.list_groups()
+    if not groups:
+        groups = query_gerrit_groups()
+    if not groups:
+        log('Failed to query gerrit db for groups, skipping permissions '
+            'sync.', level=ERROR)
+        return False
+
+    state = _read_permissions_state()
+    updated = False
+    for project, path in sorted(permission_projects().iteritems()):
+        with trace.span(project):
+            repo_name = '%s.git' % project
+            git_dir = os.path.join(GIT_PATH, repo_name)
+            sha = read_ref(git_dir, 'refs/meta/config')
+            if not sha:
+                log("Project '%s' not found, skipping its permissions." %
+                    project, level=WARNING)
+                continue
+
+            files = desired_permissions(path, groups)
+            digest = hashlib.sha1(json.dumps(sorted(files.items()))) \
+                .hexdigest()
+            key = 'sync:%s' % project
+            if state.get(key) == [sha, digest]:
+                continue
+
+            changed = changed_permissions(git_dir, files)
+            if changed:
+                log('Updating %s permissions (%s changed).' %
+                    (project, ', '.join(changed)), level=INFO)
+                repo_url = ('ssh://%s@localhost:%s/%s' %
+                            (admin_username, SSH_PORT, repo_name))
+                try:
+                    push_permissions(repo_url, files, admin_username,
+                                     admin_email,
+                                     PERMISSIONS_SYNC_COMMIT_MSG)
+                except Exception as e:
+                    log('Failed to update %s permissions: %s' %
+                        (project, str(e)), level=ERROR)
+                    continue
+                updated = True
+                sha = read_ref(git_dir, 'refs/meta/config')
+
+            state[key] = [sha, digest]
+
+    with open(PERMISSIONS_STATE_FILE, 'w') as f:
+        json.dump(state, f)
+    return updated
+
+
+def schedule_launchpad_sync(admin_username, admin_privkey):
+    """Install the launchpad_sync cron job if lp-schedule is set."""
+    if not config('lp-schedule'):
+        return
+    command = ('%s %s %s > %s 2>&1' %
+               (os.path.join(os.environ['CHARM_DIR'], 'scripts',
+                'query_lp_members.py'), admin_username, admin_privkey,
+                LOGS_PATH+'/launchpad_sync.log'))
+    cron.schedule_generic_job(
+        config('lp-schedule'), 'root', 'launchpad_sync', command,
+        jitter=config('cron-jitter'))
+
+
+@trace.phase
 def update_permissions(admin_username, admin_email, admin_privkey):
     if not os.path.isdir(PERMISSIONS_DIR):
         log('Gerrit permissions directory not found @ %s, skipping '
@@ -178,23 +417,22 @@ def update_permissions(admin_username, admin_email, admin_privkey):
     if not os.path.isdir(LAUNCHPAD_DIR):
         os.mkdir(LAUNCHPAD_DIR)
         cmd = ['chown', "%s:%s" % (GERRIT_USER, GERRIT_USER), LAUNCHPAD_DIR]
-        subprocess.check_call(cmd)
+        trace.run(subprocess.check_call, cmd)
         os.chmod(LAUNCHPAD_DIR, 0774)
 
     # check if we have creds, push to dir
+    new_creds = False
     if config('lp-credentials-file'):
         creds = b64decode(config('lp-credentials-file'))
-        with open(os.path.join(LAUNCHPAD_DIR, 'creds'), 'w') as f:
-            f.write(creds)
+        creds_file = os.path.join(LAUNCHPAD_DIR, 'creds')
+        if not os.path.isfile(creds_file) or \
+                open(creds_file).read() != creds:
+            with open(creds_file, 'w') as f:
+                f.write(creds)
+            new_creds = True
 
     # if we have teams and schedule, update cronjob
-    if config('lp-schedule'):
-        command = ('%s %s %s > %s 2>&1' %
-                   (os.path.join(os.environ['CHARM_DIR'], 'scripts',
-                    'query_lp_members.py'), admin_username, admin_privkey,
-                    LOGS_PATH+'/launchpad_sync.log'))
-        cron.schedule_generic_job(
-            config('lp-schedule'), 'root', 'launchpad_sync', command)
+    schedule_launchpad_sync(admin_username, admin_privkey)
 
     repo_name = 'All-Projects.git'
     repo_url = ('ssh://%s@localhost:%s/%s' % (admin_username, SSH_PORT,
@@ -207,9 +445,27 @@ def update_permissions(admin_username, admin_email, admin_privkey):
     with open(GROUPS_CONFIG_FILE, 'r') as f:
         groups_config = yaml.load(f)
 
-    # Create group(s)
-    for group, _ in groups_config.items():
-        gerrit_client.create_group(group)
+    # Create any missing group(s)
+    gerrit_client.create_groups(groups_config.keys())
+
+    # With new credentials, sync members now rather than on the next cron run.
+    if new_creds:
+        try:
+            launchpad_sync.sync(groups_config, gerrit_client,
+                                launchpad_sync.login(),
+                                snapshot_file=launchpad_sync.SNAPSHOT_FILE)
+        except Exception as e:
+            log('Failed to sync launchpad members: %s' % str(e),
+                level=WARNING)
+
+    if config('permissions-sync'):
+        return sync_permissions(gerrit_client, admin_username, admin_email)
+
+    # Only proceed if the repo has NOT been successfully initialised.
+    if permissions_initialised(repo_name):
+        log("%s is already initialised - skipping update permissions" %
+            (repo_name), level=INFO)
+        return False
 
     # Update git repo with permissions
     log('Installing gerrit permissions from %s.' % PERMISSIONS_DIR)
@@ -217,31 +473,26 @@ def update_permissions(admin_username, admin_email, admin_privkey):
         tmppath = tempfile.mkdtemp('', 'gerritperms')
         if tmppath:
             cmd = ["chown", "%s:%s" % (GERRIT_USER, GERRIT_USER), tmppath]
-            subprocess.check_call(cmd)
+            trace.run(subprocess.check_call, cmd)
             os.chmod(tmppath, 0774)
 
-            config_ref = 'refs/meta/config:refs/remotes/origin/meta/config'
-
-            for cmd in [['git', 'init'],
-                        ['git', 'remote', 'add', 'repo', repo_url],
-                        ['git', 'fetch', 'repo', config_ref],
-                        ['git', 'checkout', 'meta/config']]:
-                common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=tmppath)
+            checkout_meta_config(repo_url, tmppath)
 
             common.sync_dir(os.path.join(PERMISSIONS_DIR, 'All-Projects'),
                             tmppath)
 
-            # Only proceed if the repo has NOT been successfully initialised.
-            if is_permissions_initialised(repo_name, tmppath):
-                log("%s is already initialised - skipping update permissions" %
-                    (repo_name), level=INFO)
-                return False
-
             try:
-                setup_gerrit_groups(tmppath, admin_username, admin_email)
+                setup_gerrit_groups(tmppath, admin_username, admin_email,
+                                    gerrit_client)
             except GerritConfigurationException as exc:
                 log(str(exc), level=ERROR)
                 return False
+
+            # Remember the pushed commit so later hooks skip the clone.
+            sha = read_ref(os.path.join(GIT_PATH, repo_name),
+                           'refs/meta/config')
+            if sha:
+                _write_permissions_state(repo_name, sha)
         else:
             log('Failed to create permissions temporary directory',
                 level=ERROR)
@@ -252,6 +503,13 @@ def update_permissions(admin_username, admin_email, admin_privkey):
     return True
 
 
+def queue_required_packages():
+    """Queue the packages needed to update gerrit, so that they can be
+    installed in one go with install_queued_packages()."""
+    # jinja2 is used to render .gitreview in setup_gitreview().
+    queue_packages(['python-jinja2'])
+
+
 def setup_gitreview(path, repo, host):
     """
     Configure .gitreview so that when user clones repo the default git-review
@@ -278,7 +536,8 @@ def setup_gitreview(path, repo, host):
     try:
         import jinja2  # NOQA
     except ImportError:
-        apt_install(filter_installed_packages(['python-jinja2']), fatal=True)
+        queue_required_packages()
+        install_queued_packages(fatal=True)
     finally:
         from jinja2 import Template
 
@@ -308,7 +567,7 @@ def repo_is_initialised(url, branches=None):
     """
     # Get list of refs extant in the repo
     cmd = ['git', 'ls-remote', url]
-    stdout = subprocess.check_output(cmd)
+    stdout = trace.run(subprocess.check_output, cmd)
 
     # Match branches
     key = r"^[\S]+\s+?%s"
@@ -353,11 +612,12 @@ def get_gerrit_hostname(url):
     return url
 
 
+@trace.phase
 def create_projects(admin_username, admin_email, admin_privkey, base_url,
                     projects, branches, git_host, tmpdir):
     """Globally create all projects and repositories, clone and push"""
     cmd = ["chown", "%s:%s" % (GERRIT_USER, GERRIT_USER), tmpdir]
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
     os.chmod(tmpdir, 0774)
 
     gerrit_client = GerritClient(host='localhost', user=admin_username,
@@ -365,67 +625,82 @@ def create_projects(admin_username, admin_email, admin_privkey, base_url,
     try:
         for project in projects:
             name, repo = project.itervalues()
+            with trace.span(name):
+                setup_project(gerrit_client, admin_username, admin_email,
+                              base_url, name, repo, branches, git_host,
+                              tmpdir)
+    except Exception as exc:
+        msg = ('project setup failed (%s)' % str(exc))
+        log(msg, ERROR)
+        raise exc
 
-            if not gerrit_client.create_project(name):
-                log("failed to create project in gerrit - skipping setup "
-                    "for '%s'" % (name))
-                continue
-
-            git_srv_path = os.path.join(GIT_PATH, name)
-            repo_path = os.path.join(tmpdir, name.replace('/', ''))
-            repo_url = 'https://%s/%s' % (base_url, repo)
-            gerrit_remote_url = "%s/%s.git" % (GIT_PATH, repo)
 
-            # Only proceed if the repo has NOT been successfully initialised.
-            if repo_is_initialised(gerrit_remote_url, branches):
-                log("Repository '%s' already initialised - skipping" %
-                    (git_srv_path), level=INFO)
-                continue
+def setup_project(gerrit_client, admin_username, admin_email, base_url,
+                  name, repo, branches, git_host, tmpdir):
+    """Create a single project in gerrit then clone its upstream repository
+    and push the requested branches to it.
+    """
+    with trace.span('create'):
+        if not gerrit_client.create_project(name):
+            log("failed to create project in gerrit - skipping setup "
+                "for '%s'" % (name))
+            return
+
+    git_srv_path = os.path.join(GIT_PATH, name)
+    repo_path = os.path.join(tmpdir, name.replace('/', ''))
+    repo_url = 'https://%s/%s' % (base_url, repo)
+    gerrit_remote_url = "%s/%s.git" % (GIT_PATH, repo)
+
+    # Only proceed if the repo has NOT been successfully initialised.
+    if repo_is_initialised(gerrit_remote_url, branches):
+        log("Repository '%s' already initialised - skipping" %
+            (git_srv_path), level=INFO)
+        return
 
-            # Git config may not have been set yet so just in case.
-            cmds = [['git', 'config', '--global', 'user.name', admin_username],
-                    ['git', 'config', '--global', 'user.email', admin_email]]
+    # Git config may not have been set yet so just in case.
+    cmds = [['git', 'config', '--global', 'user.name', admin_username],
+            ['git', 'config', '--global', 'user.email', admin_email]]
 
-            log("Cloning git repository '%s'" % (repo_url))
-            cmds.append(['git', 'clone', repo_url, repo_path])
-            for cmd in cmds:
-                common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=tmpdir)
+    log("Cloning git repository '%s'" % (repo_url))
+    cmds.append(['git', 'clone', repo_url, repo_path])
+    with trace.span('clone'):
+        for cmd in cmds:
+            common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=tmpdir)
 
-            # Setup the .gitreview file to point to this repo by default (as
-            # opposed to upstream openstack).
-            host = get_gerrit_hostname(git_host)
-            cmds = setup_gitreview(repo_path, name, host)
+    # Setup the .gitreview file to point to this repo by default (as
+    # opposed to upstream openstack).
+    host = get_gerrit_hostname(git_host)
+    cmds = setup_gitreview(repo_path, name, host)
 
-            cmds.append(['git', 'remote', 'add', 'gerrit', gerrit_remote_url])
-            cmds.append(['git', 'fetch', '--all'])
+    cmds.append(['git', 'remote', 'add', 'gerrit', gerrit_remote_url])
+    cmds.append(['git', 'fetch', '--all'])
 
-            for cmd in cmds:
-                common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=repo_path)
+    with trace.span('gitreview'):
+        for cmd in cmds:
+            common.run_as_user(user=GERRIT_USER, cmd=cmd, cwd=repo_path)
 
-            # Push to each branch if needed
-            for branch in branches:
-                branch = branch.strip()
-                try:
-                    cmd = ['git', 'show-branch', 'gerrit/%s' % (branch)]
+    # Push to each branch if needed
+    with trace.span('push'):
+        for branch in branches:
+            branch = branch.strip()
+            try:
+                cmd = ['git', 'show-branch', 'gerrit/%s' % (branch)]
+                common.run_as_user(user=GERRIT_USER, cmd=cmd,
+                                   cwd=repo_path)
+            except Exception:
+                # branch does not exist, create it
+                ref = 'HEAD:refs/heads/%s' % branch
+                cmds = [['git', 'checkout', branch],
+                        ['git', 'pull'],
+                        ['git', 'push', '--force', 'gerrit', ref]]
+                for cmd in cmds:
                     common.run_as_user(user=GERRIT_USER, cmd=cmd,
                                        cwd=repo_path)
-                except Exception:
-                    # branch does not exist, create it
-                    ref = 'HEAD:refs/heads/%s' % branch
-                    cmds = [['git', 'checkout', branch],
-                            ['git', 'pull'],
-                            ['git', 'push', '--force', 'gerrit', ref]]
-                    for cmd in cmds:
-                        common.run_as_user(user=GERRIT_USER, cmd=cmd,
-                                           cwd=repo_path)
-
-            gerrit_client.flush_cache()
-    except Exception as exc:
-        msg = ('project setup failed (%s)' % str(exc))
-        log(msg, ERROR)
-        raise exc
 
+    gerrit_client.flush_cache()
 
+
+@trace.phase
 def update_projects(admin_username, admin_email, privkey_path, git_host):
     """Install initial projects and branches based on config."""
     if not os.path.isfile(PROJECTS_CONFIG_FILE):
@@ -482,6 +757,23 @@ def get_relation_settings(keys):
     return settings
 
 
+@trace.phase
+def update_launchpad_sync_cron():
+    """Rewrite only the launchpad_sync cron job, e.g. after lp-schedule or
+    cron-jitter changed, without re-running the rest of the gerrit update."""
+    if not os.path.isdir(PERMISSIONS_DIR):
+        return
+    rel_settings = get_relation_settings(['admin_username',
+                                          'admin_privkey_path'])
+    if not rel_settings:
+        log("Missing or invalid relation settings - skipping launchpad_sync "
+            "cron update", level=INFO)
+        return
+    schedule_launchpad_sync(rel_settings['admin_username'],
+                            rel_settings['admin_privkey_path'])
+
+
+@trace.phase
 def update_gerrit():
     if not relation_ids('gerrit-configurator'):
         log('*** No relation to gerrit, skipping update.')
@@ -13,8 +13,8 @@ from utils import (
     is_valid_config_repo,
 )
 
-from charmhelpers.fetch import apt_install, filter_installed_packages
-from charmhelpers.canonical_ci import cron
+from charmhelpers.fetch import install_queued_packages, queue_packages
+from charmhelpers.canonical_ci import cron, trace, webhook
 from charmhelpers.core.hookenv import (
     charm_dir,
     config,
@@ -30,19 +30,54 @@ from charmhelpers.core.hookenv import (
 
 hooks = Hooks()
 
+# Stages of config_changed() that need re-running when a given charm config
+# option changes.  Options not listed here affect every stage.
+ALL_STAGES = ('ssh-keys', 'lp-login', 'config-repo', 'relations', 'lp-cron',
+              'cron')
+CONFIG_STAGES = {
+    'ssh-privkey': ['ssh-keys'],
+    'ssh-pubkey': ['ssh-keys'],
+    'lp-login': ['lp-login'],
+    'config-repo': ['config-repo', 'relations'],
+    'config-repo-rcs': ['config-repo', 'relations', 'cron'],
+    'config-repo-revision': ['config-repo', 'relations'],
+    'disable-strict-host-checking-hosts': ['config-repo', 'relations'],
+    'jjb-install-source': ['relations'],
+    'lp-credentials-file': ['relations'],
+    'lp-schedule': ['lp-cron'],
+    'cron-jitter': ['lp-cron', 'cron'],
+    'permissions-sync': ['relations'],
+    'force-package-install': ['relations'],
+    'schedule-updates': ['cron'],
+    'update-frequency': ['cron'],
+    'webhook-port': ['cron'],
+    'webhook-secret': ['cron'],
+}
+
 
 @hooks.hook()
+@trace.phase
 def install():
     common.ensure_user()
     if not os.path.exists(common.CONFIG_DIR):
         os.mkdir(common.CONFIG_DIR)
-    apt_install(filter_installed_packages(common.PACKAGES), fatal=True)
+    queue_packages(common.PACKAGES)
+    install_queued_packages(fatal=True)
 
 
 def run_relation_hooks():
     """Run relation hooks (if relations exist) to ensure that configs are
     updated/accurate.
     """
+    # Install the packages every hook needs in a single transaction.
+    if any(related_units(relid=rid)
+           for rid in relation_ids('jenkins-configurator')):
+        jjb.queue_required_packages()
+    if any(related_units(relid=rid)
+           for rid in relation_ids('gerrit-configurator')):
+        gerrit.queue_required_packages()
+    install_queued_packages(fatal=True)
+
     for rid in relation_ids('jenkins-configurator'):
         if related_units(relid=rid):
             log("Running jenkins-configurator-changed hook", level=DEBUG)
@@ -59,14 +94,39 @@ def run_relation_hooks():
             zuul_configurator_relation_changed(rid=rid)
 
 
+def changed_stages(cfg):
+    """Return the set of config_changed() stages affected by the options that
+    changed since the config was last saved.
+
+    On the first run there is no saved config so every option is considered
+    changed and all stages are returned.
+    """
+    if not os.path.exists(cfg.path):
+        return set(ALL_STAGES)
+
+    stages = set()
+    for key in cfg:
+        if cfg.changed(key):
+            stages.update(CONFIG_STAGES.get(key, ALL_STAGES))
+    return stages
+
+
 @hooks.hook()
-def config_changed():
+@trace.phase
+def config_changed(stages=None):
+    cfg = config()
+    if stages is None:
+        stages = changed_stages(cfg)
+    log("Running config-changed stages: %s" % ', '.join(sorted(stages)),
+        level=DEBUG)
+
     # setup identity to reach private LP resources
     common.ensure_user()
-    common.install_ssh_keys()
+    if 'ssh-keys' in stages:
+        common.install_ssh_keys()
 
     lp_user = config('lp-login')
-    if lp_user:
+    if lp_user and 'lp-login' in stages:
         cmd = ['bzr', 'launchpad-login', lp_user]
         common.run_as_user(cmd=cmd, user=common.CI_USER)
 
@@ -75,28 +135,52 @@ def config_changed():
     bundled_repo = os.path.join(charm_dir(), common.LOCAL_CONFIG_REPO)
     conf_repo = config('config-repo')
     conf_repo_rcs = config('config-repo-rcs')
-    if os.path.exists(bundled_repo) and os.path.isdir(bundled_repo):
-        common.update_configs_from_charm(bundled_repo)
-        run_relation_hooks()
-    elif is_valid_config_repo(conf_repo_rcs, conf_repo):
-        common.update_configs_from_repo(conf_repo_rcs,
-                                        conf_repo,
-                                        config('config-repo-revision'))
+    if 'config-repo' in stages:
+        if os.path.exists(bundled_repo) and os.path.isdir(bundled_repo):
+            common.update_configs_from_charm(bundled_repo)
+            stages = set(stages) | set(['relations'])
+        elif is_valid_config_repo(conf_repo_rcs, conf_repo):
+            common.update_configs_from_repo(conf_repo_rcs,
+                                            conf_repo,
+                                            config('config-repo-revision'))
+            stages = set(stages) | set(['relations'])
+
+    if 'relations' in stages:
+        # Also rewrites the launchpad_sync cron job.
         run_relation_hooks()
+    elif 'lp-cron' in stages:
+        gerrit.update_launchpad_sync_cron()
 
-    if config('schedule-updates'):
+    if config('schedule-updates') and 'cron' in stages:
         schedule = config('update-frequency')
         cron.schedule_repo_updates(
             schedule, common.CI_USER, common.CI_CONFIG_DIR, conf_repo_rcs,
-            jjb.JOBS_CONFIG_DIR)
+            jjb.JOBS_CONFIG_DIR, jitter=config('cron-jitter'))
+
+    if 'cron' in stages:
+        update_command = cron.repo_update_command(
+            common.CI_CONFIG_DIR, conf_repo_rcs, jjb.JOBS_CONFIG_DIR)
+        if config('webhook-port') and update_command:
+            webhook.install(config('webhook-port'), common.CI_USER,
+                            'repo_update', update_command,
+                            config('webhook-secret'))
+        else:
+            webhook.remove()
+
+    # Only remember this config once every stage has succeeded so that a
+    # failed hook is fully retried next time.
+    cfg.save()
 
 
 @hooks.hook()
+@trace.phase
 def upgrade_charm():
-    config_changed()
+    # The bundled config repo may have changed so redo everything.
+    config_changed(stages=ALL_STAGES)
 
 
 @hooks.hook()
+@trace.phase
 def jenkins_configurator_relation_joined(rid=None):
     """Install jenkins job builder.
 
@@ -110,6 +194,7 @@ def jenkins_configurator_relation_joined(rid=None):
 
 
 @hooks.hook('jenkins-configurator-relation-changed')
+@trace.phase
 def jenkins_configurator_relation_changed(rid=None):
     """Update/configure Jenkins installation.
 
@@ -117,6 +202,8 @@ def jenkins_configurator_relation_changed(rid=None):
     """
     # Ensure jjb and any available plugins are installed before attempting
     # update.
+    jjb.queue_required_packages()
+    install_queued_packages(fatal=True)
     jenkins_configurator_relation_joined(rid=rid)
 
     if is_ci_configured():
@@ -129,15 +216,19 @@ def jenkins_configurator_relation_changed(rid=None):
 
 
 @hooks.hook('gerrit-configurator-relation-changed')
+@trace.phase
 def gerrit_configurator_relation_changed(rid=None):
     """Update/configure Gerrit installation."""
     if is_ci_configured():
+        gerrit.queue_required_packages()
+        install_queued_packages(fatal=True)
         gerrit.update_gerrit()
     else:
         log('CI not yet configured - skipping gerrit update', level=INFO)
 
 
 @hooks.hook('zuul-configurator-relation-changed')
+@trace.phase
 def zuul_configurator_relation_changed(rid=None):
     """Update/configure Zuul installation."""
     if is_ci_configured():
@@ -151,6 +242,8 @@ def main():
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
+    finally:
+        trace.finish()
 
 
 if __name__ == '__main__':
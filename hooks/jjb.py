@@ -1,7 +1,10 @@
+import base64
 import json
 import os
 import shutil
+import socket
 import subprocess
+import tempfile
 import urllib2
 import time
 import xml.etree.ElementTree as ET
@@ -10,10 +13,11 @@ import common
 
 from charmhelpers.core.hookenv import (
     charm_dir, config, log, relation_ids, relation_get,
-    related_units, ERROR)
+    related_units, ERROR, WARNING)
 from charmhelpers.fetch import (
-    apt_install, apt_update, filter_installed_packages)
-from charmhelpers.core.host import lsb_release, restart_on_change
+    apt_install, apt_update, install_queued_packages, queue_packages)
+from charmhelpers.core.host import lsb_release, service_restart
+from charmhelpers.canonical_ci import trace
 
 PACKAGES = ['git', 'python-pip']
 CONFIG_DIR = '/etc/jenkins_jobs'
@@ -43,6 +47,7 @@ url=%(jenkins_url)s
 """
 
 
+@trace.phase
 def install():
     """
     Install jenkins-job-builder from a archive, remote git repository or a
@@ -90,26 +95,28 @@ def install_from_file(tarball):
     outdir = os.path.join('/tmp', 'jenkins-job-builder')
     _clean_tmp_dir(outdir)
 
-    apt_install(filter_installed_packages(['python-pip']), fatal=True)
+    queue_packages(['python-pip'])
+    install_queued_packages(fatal=True)
     os.chdir(os.path.dirname(outdir))
     cmd = ['tar', 'xfz', tarball]
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
     os.chdir(outdir)
     deps = os.path.join(charm_dir(), 'files', LOCAL_PIP_DEPS)
     cmd = ['pip', 'install', '--no-index',
            '--find-links=file://%s' % deps, '-r', 'requirements.txt']
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
     cmd = ['python', './setup.py', 'install']
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
     log('*** Installed from local tarball.')
 
 
 def install_from_git(repo):
     # assumes internet access
     log('*** Installing from remote git repository: %s' % repo)
-    apt_install(filter_installed_packages(['git', 'python-pip']), fatal=True)
+    queue_packages(['git', 'python-pip'])
+    install_queued_packages(fatal=True)
     cmd = ['pip', 'install', 'git+{}'.format(repo)]
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
 
 
 def write_jjb_config():
@@ -198,6 +205,100 @@ def is_jenkins_slave():
     return os.path.isfile('/etc/init/jenkins-slave.conf')
 
 
+# Elements whose order jenkins does not preserve when it saves config.xml,
+# e.g. the matrix-auth permissions.
+UNORDERED_XML_TAGS = ('permission',)
+
+
+def canonical_xml(element):
+    """Return a form of element that compares equal for semantically equal
+    XML, whatever its whitespace, attribute order and the order of its
+    UNORDERED_XML_TAGS children."""
+    children = [canonical_xml(child) for child in element]
+    ordered = [c for c in children if c[0] not in UNORDERED_XML_TAGS]
+    unordered = sorted(c for c in children if c[0] in UNORDERED_XML_TAGS)
+    return (element.tag, sorted(element.attrib.items()),
+            (element.text or '').strip(), ordered + unordered)
+
+
+def security_configured(root, security):
+    """Return True if the jenkins config root already enables security with
+    the authorization strategy in security."""
+    use_security = root.find('useSecurity')
+    if (use_security is None or
+            (use_security.text or '').strip().lower() != 'true'):
+        return False
+    if (security.tag != 'authorizationStrategy' and
+            root.find('authorizationStrategy') is not None):
+        return False
+    current = root.find(security.tag)
+    return (current is not None and
+            canonical_xml(current) == canonical_xml(security))
+
+
+def reload_jenkins():
+    """Ask jenkins to reload its configuration from disk.
+
+    Returns False if jenkins could not be asked."""
+    admin_user, admin_cred = admin_credentials()
+    url = (jenkins_context() or {}).get('jenkins_url')
+    if not (url and admin_user and admin_cred):
+        return False
+
+    url = url.rstrip('/')
+    headers = {'Authorization': 'Basic ' + base64.b64encode(
+        '%s:%s' % (admin_user, admin_cred))}
+    log('Reloading jenkins configuration.')
+    try:
+        try:
+            crumb = json.load(urllib2.urlopen(urllib2.Request(
+                url + '/crumbIssuer/api/json', headers=headers)))
+            headers[crumb['crumbRequestField']] = crumb['crumb']
+        except urllib2.HTTPError as err:
+            # CSRF protection is not enabled.
+            if err.code != 404:
+                raise
+        urllib2.urlopen(urllib2.Request(url + '/reload', data='',
+                                        headers=headers))
+    except urllib2.HTTPError as err:
+        # jenkins redirects to a page that is unavailable while it reloads
+        if err.code == 503:
+            return True
+        log('Could not reload jenkins configuration: %s' % err, WARNING)
+        return False
+    except (urllib2.URLError, ValueError, KeyError) as err:
+        log('Could not reload jenkins configuration: %s' % err, WARNING)
+        return False
+    return True
+
+
+def wait_for_jenkins(timeout=MAX_RETRIES * SLEEP_TIME):
+    """Wait for jenkins to answer requests again after a reload or restart.
+
+    Returns False if it has not within timeout seconds."""
+    url = (jenkins_context() or {}).get('jenkins_url')
+    if not url:
+        return False
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib2.urlopen(url.rstrip('/') + '/api/json', timeout=SLEEP_TIME)
+            return True
+        except urllib2.HTTPError as err:
+            # e.g. 403 for anonymous users once jenkins is back up
+            if err.code != 503:
+                return True
+        except (urllib2.URLError, socket.error):
+            pass
+        if time.time() >= deadline:
+            log('Jenkins did not come back within %d seconds.' % timeout,
+                WARNING)
+            return False
+        log('Jenkins is still not available, waiting.')
+        time.sleep(min(SLEEP_TIME, max(deadline - time.time(), 0)))
+
+
+@trace.phase
 def _update_jenkins_config():
     if not os.path.isdir(JOBS_CONFIG_DIR):
         log('Could not find jobs-config directory at expected location, '
@@ -213,35 +314,51 @@ def _update_jenkins_config():
     # open existing config.xml and manipulate to enable
     # our security rules, use parser to don't overwrite it
     tree = ET.parse(JENKINS_CONFIG_FILE)
+    root = tree.getroot()
+    security = ET.parse(JENKINS_SECURITY_FILE).getroot()
+    if security_configured(root, security):
+        log('Jenkins security already configured, leaving %s untouched.' %
+            JENKINS_CONFIG_FILE)
+        return False
+
     securityItem = tree.find('useSecurity')
     if securityItem is not None:
         securityItem.text = 'True'
     else:
         # create security item
-        root = tree.getroot()
         parent = root.find(".")
         securityItem = ET.SubElement(parent, 'useSecurity')
         securityItem.text = 'True'
 
     # now replace authorization strategy with our bits
-    root = tree.getroot()
-    auth = root.find('authorizationStrategy')
-    if auth is not None:
-        root.remove(auth)
+    for tag in set(['authorizationStrategy', security.tag]):
+        auth = root.find(tag)
+        if auth is not None:
+            root.remove(auth)
 
     # create our own tree with security bits
-    secElement = ET.parse(JENKINS_SECURITY_FILE)
-    root.append(secElement.getroot())
-
-    tree.write(JENKINS_CONFIG_FILE)
-    cmd = ['chown', 'jenkins:nogroup', JENKINS_CONFIG_FILE]
-    subprocess.check_call(cmd)
-    os.chmod(JENKINS_CONFIG_FILE, 0644)
-
-    # restart only if needed
-    restart_on_change({JENKINS_CONFIG_FILE: ['jenkins']})
-
-
+    root.append(security)
+
+    # write next to config.xml and rename it into place, so jenkins never
+    # sees a partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(JENKINS_CONFIG_FILE),
+                               prefix='.config.xml.')
+    with os.fdopen(fd, 'w') as out:
+        tree.write(out)
+    cmd = ['chown', 'jenkins:nogroup', tmp]
+    trace.run(subprocess.check_call, cmd)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, JENKINS_CONFIG_FILE)
+
+    # a reload applies the config without aborting running builds
+    if not reload_jenkins():
+        service_restart('jenkins')
+    # jenkins-jobs update comes next, and fails while jenkins answers 503
+    wait_for_jenkins()
+    return True
+
+
+@trace.phase
 def _update_jenkins_jobs():
     if not write_jjb_config():
         log('Could not write jenkins-job-builder config, skipping '
@@ -263,7 +380,7 @@ def _update_jenkins_jobs():
     os.environ['JJB_CHARM_CONTEXT'] = CHARM_CONTEXT_DUMP
     os.environ['JJB_JOBS_CONFIG_DIR'] = JOBS_CONFIG_DIR
     log('Calling jenkins-job-builder repo update hook: %s.' % hook)
-    subprocess.check_call(hook)
+    trace.run(subprocess.check_call, hook)
 
     # call jenkins-jobs to actually update jenkins
     # TODO: Call 'jenkins-job test' to validate configs before updating?
@@ -291,6 +408,7 @@ def _update_jenkins_jobs():
         break
 
 
+@trace.phase
 def update_jenkins():
     if not relation_ids('jenkins-configurator'):
         return
@@ -312,9 +430,10 @@ def update_jenkins():
     if os.path.isdir(setupd):
         cmd = ["run-parts", "--exit-on-error", setupd]
         log('Running repo setup.')
-        subprocess.check_call(cmd)
+        trace.run(subprocess.check_call, cmd)
 
-    # install any packages that the repo says we need as dependencies.
+    # install any packages that the repo says we need as dependencies.  This
+    # comes after setup.d, which may add the apt sources they are from.
     pkgs = required_packages()
     if pkgs:
         opts = []
@@ -332,6 +451,19 @@ def required_packages():
         return control['required_jenkins_packages']
 
 
+def queue_required_packages():
+    """Queue the packages needed to install jenkins-job-builder, so that
+    they can be installed in one go with install_queued_packages().
+
+    The packages the repo says we need are installed by update_jenkins(),
+    once its setup.d scripts have run."""
+    tarball = os.path.join(charm_dir(), 'files', TARBALL)
+    if os.path.isfile(tarball):
+        queue_packages(['python-pip'])
+    elif config('jjb-install-source').startswith('git://'):
+        queue_packages(['git', 'python-pip'])
+
+
 def required_plugins():
     control = common.load_control()
     if control and 'required_jenkins_plugins' in control:
@@ -0,0 +1,346 @@
+# Copyright (C) 2011 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Synchronize Gerrit users from Launchpad.
+
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import yaml
+
+from charmhelpers.canonical_ci import trace
+from charmhelpers.canonical_ci.gerrit import GerritClient
+
+try:
+    from lazr.restfulclient.errors import Unauthorized
+except ImportError:
+    # launchpadlib is only needed to talk to the real launchpad.
+    class Unauthorized(Exception):
+        pass
+
+GERRIT_HOME = os.path.join('/home', 'gerrit2')
+LAUNCHPAD_DIR = os.path.join(GERRIT_HOME, '.launchpadlib')
+GERRIT_CACHE_DIR = os.path.join(LAUNCHPAD_DIR, 'cache')
+GERRIT_CREDENTIALS = os.path.join(LAUNCHPAD_DIR, 'creds')
+# Membership of each team as last read from launchpad.
+SNAPSHOT_FILE = os.path.join(LAUNCHPAD_DIR, 'membership.json')
+# Same as gerrit.GROUPS_CONFIG_FILE, without importing the hook module.
+GROUPS_CONFIG_FILE = os.path.join('/etc', 'ci-configurator', 'ci-config',
+                                  'gerrit', 'permissions', 'groups.yml')
+SSH_PORT = 29418
+# Teams whose membership is unchanged are still re-read in full after this
+# many seconds, to pick up changed ssh keys and email addresses.
+SNAPSHOT_MAX_AGE = 24 * 60 * 60
+
+
+def get_type(in_type):
+    if in_type == "RSA":
+        return "ssh-rsa"
+    else:
+        return "ssh-dsa"
+
+
+def get_openid(lp_user):
+    from openid.consumer import consumer
+    from openid.cryptutil import randomString
+
+    k = dict(id=randomString(16, '0123456789abcdef'))
+    openid_consumer = consumer.Consumer(k, None)
+    openid_request = openid_consumer.begin(
+        "https://launchpad.net/~%s" % lp_user)
+    return openid_request.endpoint.getLocalID()
+
+
+def login():
+    from launchpadlib.launchpad import Launchpad
+    from launchpadlib.uris import LPNET_SERVICE_ROOT
+
+    for check_path in (os.path.dirname(GERRIT_CACHE_DIR),
+                       os.path.dirname(GERRIT_CREDENTIALS)):
+        if not os.path.exists(check_path):
+            os.makedirs(check_path)
+
+    return Launchpad.login_with('Canonical CI Gerrit User Sync',
+                                LPNET_SERVICE_ROOT,
+                                GERRIT_CACHE_DIR,
+                                credentials_file=GERRIT_CREDENTIALS)
+
+
+def assert_is_valid_email(email):
+    if not email or not re.search(r'.+?@.+?\..+?', email):
+        msg = "invalid email address '%s'" % (email)
+        raise Exception(msg)
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_snapshot(path, snapshot):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(path + '.tmp', path)
+
+
+def membership_fingerprint(members_details):
+    entries = sorted((d.self_link, d.status,
+                      str(getattr(d, 'date_last_changed', '')))
+                     for d in members_details)
+    return hashlib.sha1(json.dumps(entries)).hexdigest()
+
+
+class TeamWalker(object):
+    """Resolves launchpad teams to the logins of the users in them,
+    recursing into nested teams.
+
+    Every person is looked up once per walker and kept in people, mapping
+    login to a (login, full_name, email, ssh_keys, openid) tuple, and every
+    team is walked once however many groups or teams it is part of.  Teams
+    whose membership is unchanged since their entry in snapshot was taken
+    reuse it instead of looking up every member.
+    """
+    def __init__(self, lp, snapshot=None, openid=get_openid):
+        self.lp = lp
+        self.snapshot = snapshot if snapshot is not None else {}
+        self.openid = openid
+        self.people = {}
+        self.teams = {}
+
+    def team_members(self, team_login, team_name):
+        """Return the logins of the users in team_login and the teams nested
+        in it."""
+        if team_login in self.teams:
+            return self.teams[team_login]
+        # Guard against teams that are members of themselves.
+        self.teams[team_login] = []
+
+        try:
+            members_details = list(self.lp.people[team_login].members_details)
+        except Unauthorized:
+            print "WARN: skipping team={} (Unauthorized)".format(team_name)
+            return []
+
+        fingerprint = membership_fingerprint(members_details)
+        snapshot = self.snapshot.get(team_login)
+        if (snapshot and snapshot['fingerprint'] == fingerprint and
+                time.time() - snapshot['time'] < SNAPSHOT_MAX_AGE):
+            print "Team {} unchanged - using snapshot".format(team_name)
+            logins = self.snapshot_members(snapshot['members'], team_name)
+        else:
+            members = []
+            logins = self.all_members(members_details, team_name, members)
+            self.snapshot[team_login] = {'fingerprint': fingerprint,
+                                         'time': time.time(),
+                                         'members': members}
+
+        self.teams[team_login] = logins
+        return logins
+
+    def snapshot_members(self, members, team_name):
+        """Return the logins recorded in a team snapshot, only walking nested
+        teams."""
+        logins = []
+        for login, is_team, user in members:
+            if is_team:
+                logins.extend(self.team_members(
+                    login, "{}/{}".format(team_name, login)))
+            else:
+                if login not in self.people:
+                    login, full_name, email, ssh_keys, openid = user
+                    self.people[login] = (login, full_name, email,
+                                          tuple(ssh_keys), openid)
+                logins.append(login)
+        return logins
+
+    def person(self, login, member):
+        """Return the user tuple of member:
+        (login, full_name, email, ssh_keys, openid)
+        or None if it has no valid email address."""
+        full_name = member.display_name.encode('ascii', 'replace')
+        email = ''
+        errmsg = ("failed to get valid email address for '%s' (%s) "
+                  "- skipping")
+        try:
+            email = member.preferred_email_address.email
+            assert_is_valid_email(email)
+        except Exception as exc:
+            print (errmsg % (login, str(exc)))
+            return None
+        except:  # NOQA
+            # Do catchall just in case an exception is raised that
+            # does not inherit Exception.
+            print (errmsg % (login, 'no exception info available'))
+            return None
+
+        ssh_keys = tuple(
+            "{} {} {}".format(get_type(key.keytype), key.keytext,
+                              key.comment).strip()
+            for key in member.sshkeys
+        )
+        return (login, full_name, email, ssh_keys, self.openid(login))
+
+    def all_members(self, members_details, team_name, members):
+        """Recurse members_details to return the logins of the (final)users
+        in them, adding each newly found user to people.
+
+        Every member used is also appended to members as
+        (login, is_team, user).
+        """
+        logins = []
+        for detail in members_details:
+            # detail.self_link ==
+            # 'https://api.launchpad.net/1.0/~team/+member/${username}'
+            login = detail.self_link.split('/')[-1]
+
+            status = detail.status
+            if not (status == "Approved" or status == "Administrator"):
+                continue
+
+            # People and teams already found elsewhere are not looked up
+            # again.
+            if login in self.people:
+                logins.append(login)
+                members.append((login, False, self.people[login]))
+                continue
+            if login in self.teams:
+                logins.extend(self.teams[login])
+                members.append((login, True, None))
+                continue
+
+            member = self.lp.people[login]
+            print '{}-entry: {}/{}'.format('T' if member.is_team else 'U',
+                                           team_name, login)
+
+            # If is_team recurse down(branch), else add this user
+            # details(leaf) to people
+            if member.is_team:
+                logins.extend(self.team_members(
+                    login, "{}/{}".format(team_name, member.name)))
+                members.append((login, True, None))
+            else:
+                user = self.person(login, member)
+                if user is None:
+                    continue
+                self.people[login] = user
+                logins.append(login)
+                members.append((login, False, user))
+
+        return logins
+
+
+@trace.phase
+def sync(groups, client, lp, snapshot_file=None, openid=get_openid):
+    """Create the gerrit groups in groups and add the members of their
+    launchpad teams to them.
+
+    groups maps each gerrit group to a space separated list of launchpad
+    teams, as in groups.yml.  client is a GerritClient and lp a launchpadlib
+    Launchpad.  Team snapshots are read from and saved to snapshot_file if
+    given.
+
+    The account of every person is written once, whichever groups they are
+    in, and then the members of each group are added in bulk.
+
+    Returns a dict mapping each group to the status of each of its users,
+    see GerritClient.create_users_batch().
+    """
+    snapshot = load_snapshot(snapshot_file) if snapshot_file else {}
+    walker = TeamWalker(lp, snapshot, openid=openid)
+    results = {}
+
+    # flush gerrit caches once, after every group is done
+    with client.batch():
+        # create groups if not exists
+        try:
+            if client.create_groups(groups.keys()):
+                client.defer('flush-caches')
+        except Exception:
+            print "Skipping group creation"
+
+        # grab all the users in the teams of each group
+        memberships = {}
+        for group, teams in groups.items():
+            memberships[group] = set()
+            for team_todo in teams.split(' '):
+                print "Finding users for team %s" % team_todo
+                memberships[group].update(walker.team_members(team_todo,
+                                                              team_todo))
+
+        # create or update every account once
+        users = [walker.people[login] for login in sorted(walker.people)]
+        accounts = client.create_users_batch(None, users)
+
+        # add all the users to their groups
+        for group, logins in memberships.items():
+            failed = client.add_group_members(
+                group, sorted(login for login in logins
+                              if accounts.get(login) != 'failed'))
+            results[group] = dict(
+                (login, 'failed' if login in failed else accounts[login])
+                for login in logins)
+
+    if snapshot_file:
+        save_snapshot(snapshot_file, snapshot)
+    return results
+
+
+def run(admin_username, admin_privkey, groups_file=GROUPS_CONFIG_FILE):
+    """Log in to launchpad and sync the groups in groups_file with the
+    local gerrit."""
+    with open(groups_file, 'r') as f:
+        groups_config = yaml.load(f)
+
+    # create gerrit connection
+    gerrit_client = GerritClient(
+        host='localhost',
+        user=admin_username,
+        port=SSH_PORT,
+        key_file=admin_privkey)
+    try:
+        return sync(groups_config, gerrit_client, login(),
+                    snapshot_file=SNAPSHOT_FILE)
+    finally:
+        # Workaround https://github.com/paramiko/paramiko/issues/17
+        gerrit_client.ssh.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # check parameters from command line
+    if len(argv) < 2:
+        print "ERROR: Please send user and private key in parameters."
+        return 1
+
+    try:
+        run(argv[0], argv[1])
+    except Exception as e:
+        print "ERROR creating users %s" % str(e)
+        return 1
+    finally:
+        # Run from cron, so there is no juju log for trace.finish() to write
+        # the summary to.
+        try:
+            trace.write()
+        except (IOError, OSError) as e:
+            print "ERROR writing trace %s" % str(e)
+        trace.reset()
+    return 0
@@ -1,19 +1,38 @@
+import distutils.spawn
 import os
+import shutil
+import signal
 import subprocess
+import tempfile
+import yaml
 
 import common
+import jjb
 
-from charmhelpers.core.hookenv import log, related_units, relation_ids, INFO
+from charmhelpers.core.hookenv import (
+    log,
+    related_units,
+    relation_ids,
+    ERROR,
+    INFO,
+    WARNING
+)
+from charmhelpers.core.host import file_hash
+from charmhelpers.canonical_ci import trace
 
 ZUUL_CONFIG_DIR = os.path.join(common.CI_CONFIG_DIR, 'zuul')
 ZUUL_INIT_SCRIPT = "/etc/init.d/zuul"
+ZUUL_CONF = '/etc/zuul/zuul.conf'
+ZUUL_LAYOUT = '/etc/zuul/layout.yaml'
+ZUUL_PID_FILE = '/var/run/zuul/zuul.pid'
+LAYOUT_NAMES = ['layout.yaml', 'layout.yml']
 
 
 # start and stop services
 def start_zuul():
     log("*** Starting zuul server ***", INFO)
     try:
-        subprocess.call([ZUUL_INIT_SCRIPT, "start"])
+        trace.run(subprocess.call, [ZUUL_INIT_SCRIPT, "start"])
     except:
         pass
 
@@ -21,11 +40,221 @@ def start_zuul():
 def stop_zuul():
     log("*** Stopping zuul server ***", INFO)
     try:
-        subprocess.call([ZUUL_INIT_SCRIPT, "stop"])
+        trace.run(subprocess.call, [ZUUL_INIT_SCRIPT, "stop"])
     except:
         pass
 
 
+def reload_zuul():
+    """Ask the running zuul server to reload its layout with SIGHUP, which
+    keeps the changes queued in its pipelines.
+
+    Returns False if no running server could be signalled.
+    """
+    try:
+        with open(ZUUL_PID_FILE) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, signal.SIGHUP)
+    except (IOError, OSError, ValueError) as exc:
+        log('Could not signal zuul server to reload (%s).' % exc, WARNING)
+        return False
+    log("*** Reloading zuul layout (pid %d) ***" % pid, INFO)
+    return True
+
+
+def layout_source():
+    """Return the layout file shipped in ZUUL_CONFIG_DIR, or None."""
+    files = sorted(f for f in os.listdir(ZUUL_CONFIG_DIR)
+                   if os.path.isfile(os.path.join(ZUUL_CONFIG_DIR, f)))
+    for name in LAYOUT_NAMES:
+        if name in files:
+            return os.path.join(ZUUL_CONFIG_DIR, name)
+    if len(files) == 1:
+        return os.path.join(ZUUL_CONFIG_DIR, files[0])
+    return None
+
+
+def load_layout(path):
+    """Parse the layout at path, returning None if there is none."""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+def jenkins_jobs():
+    """Return the names of the jobs jenkins-job-builder generates from
+    JOBS_CONFIG_DIR, or None if they cannot be generated here."""
+    if not (os.path.isdir(jjb.JOBS_CONFIG_DIR) and
+            distutils.spawn.find_executable('jenkins-jobs')):
+        return None
+
+    outdir = tempfile.mkdtemp(prefix='zuul-jobs')
+    try:
+        cmd = ['jenkins-jobs', 'test', jjb.JOBS_CONFIG_DIR, '-o', outdir]
+        with open(os.devnull, 'w') as devnull:
+            trace.run(subprocess.check_call, cmd, stdout=devnull,
+                      stderr=devnull)
+        return set(os.listdir(outdir))
+    except subprocess.CalledProcessError as exc:
+        log('Could not generate jenkins jobs to check zuul layout against '
+            '(%s).' % exc, WARNING)
+        return None
+    finally:
+        shutil.rmtree(outdir)
+
+
+def _job_names(tree):
+    """Yield the job names in a project pipeline's job tree."""
+    if isinstance(tree, basestring):
+        yield tree
+    elif isinstance(tree, list):
+        for item in tree:
+            for name in _job_names(item):
+                yield name
+    elif isinstance(tree, dict):
+        for name, subtree in tree.iteritems():
+            yield name
+            for name in _job_names(subtree):
+                yield name
+
+
+def _by_name(layout, section):
+    return dict((item.get('name'), item) for item in layout.get(section) or []
+                if isinstance(item, dict))
+
+
+# Keys of a zuul project that are not pipelines.
+PROJECT_KEYS = ('name', 'template', 'merge-mode')
+
+
+def _expand(job, params):
+    """Return job with the template parameters params substituted, or None
+    if it uses a parameter that is not given."""
+    try:
+        return job.format(**params)
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def check_layout(layout, jobs=None):
+    """Check the structure of a parsed layout: every project must name
+    known pipelines and templates, and, if jobs is given, every job it runs
+    must be one of them.
+
+    Returns a list of errors.
+    """
+    if not isinstance(layout, dict):
+        return ['layout is not a mapping']
+
+    errors = []
+    pipelines = _by_name(layout, 'pipelines')
+    if not pipelines:
+        errors.append('no pipelines defined')
+    templates = _by_name(layout, 'project-templates')
+
+    for project in layout.get('projects') or []:
+        name = project.get('name')
+        if not name:
+            errors.append('project without a name')
+            continue
+
+        # Expand templates as zuul does, {name} being the short name.
+        runs = []
+        for template in project.get('template') or []:
+            if template.get('name') not in templates:
+                errors.append('project %s: unknown template %s' %
+                              (name, template.get('name')))
+                continue
+            params = dict(template, name=name.split('/')[-1])
+            for pipeline, tree in templates[template['name']].iteritems():
+                if pipeline == 'name':
+                    continue
+                names = []
+                for job in _job_names(tree):
+                    expanded = _expand(job, params)
+                    if expanded is None:
+                        errors.append('project %s: cannot expand job %s of '
+                                      'template %s' %
+                                      (name, job, template['name']))
+                    else:
+                        names.append(expanded)
+                runs.append((pipeline, names))
+        for pipeline, tree in project.iteritems():
+            if pipeline not in PROJECT_KEYS:
+                runs.append((pipeline, list(_job_names(tree))))
+
+        for pipeline, names in runs:
+            if pipeline not in pipelines:
+                errors.append('project %s: unknown pipeline %s' %
+                              (name, pipeline))
+            if jobs is not None:
+                for job in names:
+                    if job != 'noop' and job not in jobs:
+                        errors.append('project %s: job %s not defined in '
+                                      'jenkins' % (name, job))
+    return errors
+
+
+def diff_layouts(old, new):
+    """Return lines describing how layout new differs from old: the named
+    items of its sections by name, '+' added, '-' removed and '~' changed,
+    and any other top-level key that changed."""
+    old = old or {}
+    lines = []
+    sections = ('pipelines', 'jobs', 'project-templates', 'projects')
+    for section in sections:
+        before = _by_name(old, section)
+        after = _by_name(new, section)
+        for name in sorted(set(before) | set(after)):
+            if name not in before:
+                lines.append('%s: + %s' % (section, name))
+            elif name not in after:
+                lines.append('%s: - %s' % (section, name))
+            elif before[name] != after[name]:
+                lines.append('%s: ~ %s' % (section, name))
+    for key in sorted(set(old) | set(new)):
+        if key not in sections and old.get(key) != new.get(key):
+            lines.append('~ %s' % key)
+    return lines
+
+
+def validate_layout(path, layout):
+    """Check that the layout parsed from path is one zuul will load.
+
+    The structure of the layout is checked against the jenkins jobs and, if
+    zuul-server is installed, it is loaded with zuul's layout test mode.
+    Returns True if the layout is valid.
+    """
+    errors = check_layout(layout, jenkins_jobs())
+    for error in errors:
+        log('Invalid zuul layout %s: %s' % (path, error), ERROR)
+    if errors:
+        return False
+
+    if not distutils.spawn.find_executable('zuul-server'):
+        return True
+
+    cmd = ['zuul-server', '-c', ZUUL_CONF, '-l', path, '-t']
+    try:
+        trace.run(subprocess.check_output, cmd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as exc:
+        log('Invalid zuul layout %s: %s' % (path, exc.output), ERROR)
+        return False
+    return True
+
+
+def install_layout(src, dst):
+    """Replace dst with src atomically."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst),
+                               prefix='.layout.')
+    with os.fdopen(fd, 'w') as out, open(src) as f:
+        out.write(f.read())
+    os.chmod(tmp, 0644)
+    os.rename(tmp, dst)
+
+
+@trace.phase
 def update_zuul():
     zuul_units = []
 
@@ -37,17 +266,52 @@ def update_zuul():
         return
 
     log("*** Updating zuul.")
-    layout_path = '/etc/zuul/layout.yaml'
+    layout_path = ZUUL_LAYOUT
 
     if not os.path.isdir(ZUUL_CONFIG_DIR):
         log('Could not find zuul config directory at expected location, '
             'skipping zuul update (%s)' % ZUUL_CONFIG_DIR)
         return
 
-    log('Installing layout from %s to %s.' % (ZUUL_CONFIG_DIR, layout_path))
-    common.sync_dir(ZUUL_CONFIG_DIR, layout_path)
+    src = layout_source()
+    if not src:
+        log('Could not find a zuul layout in %s, skipping zuul update.' %
+            ZUUL_CONFIG_DIR, WARNING)
+        return
+
+    if file_hash(src) == file_hash(layout_path):
+        log('Zuul layout %s unchanged, skipping zuul update.' % layout_path)
+        return
+
+    try:
+        layout = load_layout(src)
+    except yaml.YAMLError as exc:
+        log('Invalid zuul layout %s: %s' % (src, exc), ERROR)
+        return False
+
+    if not validate_layout(src, layout):
+        log('Not installing invalid zuul layout from %s.' % src, ERROR)
+        return False
+
+    try:
+        installed = load_layout(layout_path)
+    except yaml.YAMLError:
+        installed = None
+    if layout == installed:
+        # Only comments or formatting changed.  Install the file so that
+        # later hooks find it unchanged, but zuul has nothing to reload.
+        log('Zuul layout %s has only cosmetic changes, installing it '
+            'without reloading zuul.' % src)
+        install_layout(src, layout_path)
+        return
+    changes = diff_layouts(installed, layout) or ['(unnamed items changed)']
+    log('Zuul layout changes:\n%s' % '\n'.join(changes))
+
+    log('Installing layout from %s to %s.' % (src, layout_path))
+    install_layout(src, layout_path)
 
-    stop_zuul()
-    start_zuul()
+    if not reload_zuul():
+        stop_zuul()
+        start_zuul()
 
     return True
@@ -0,0 +1,17 @@
+#! /usr/bin/env python
+# Run a cron job unless its previous run is still going.
+#
+# usage: cron_job.py [--jitter <seconds>] <name> <shell command>
+#
+# The work is done by hooks/charmhelpers/canonical_ci/cron.py, which also
+# records the start, duration and outcome of each run.
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '../hooks'))
+
+from charmhelpers.canonical_ci import cron  # NOQA
+
+if __name__ == '__main__':
+    sys.exit(cron.main())
@@ -0,0 +1,17 @@
+#! /usr/bin/env python
+# Listen for config repo push webhooks and run the update job.
+#
+# usage: webhook_listener.py --port <port> [--secret-file <file>]
+#                            <name> <shell command>
+#
+# The work is done by hooks/charmhelpers/canonical_ci/webhook.py.
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/' + '../hooks'))
+
+from charmhelpers.canonical_ci import webhook  # NOQA
+
+if __name__ == '__main__':
+    sys.exit(webhook.main())
@@ -0,0 +1,124 @@
+import fcntl
+import os
+import mock
+import testtools
+import tempfile
+import shutil
+import subprocess
+import sys
+
+from charmhelpers.canonical_ci import cron
+
+
+class CronTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(CronTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(cron, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(CronTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_job_records_status(self):
+        self.assertEqual(0, cron.run_job('ok', 'true', state_dir=self.tmpdir))
+        status = cron.read_status('ok', self.tmpdir)
+        self.assertEqual('success', status['outcome'])
+        self.assertEqual(0, status['returncode'])
+        self.assertTrue(status['duration'] >= 0)
+
+        self.assertEqual(3, cron.run_job('fail', 'exit 3',
+                                         state_dir=self.tmpdir))
+        status = cron.read_status('fail', self.tmpdir)
+        self.assertEqual('failed', status['outcome'])
+        self.assertEqual(3, status['returncode'])
+
+    def test_run_job_skips_while_locked(self):
+        marker = os.path.join(self.tmpdir, 'ran')
+        cron.run_job('job', 'true', state_dir=self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'job', 'lock')) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertIsNone(cron.run_job('job', 'touch %s' % marker,
+                                           state_dir=self.tmpdir))
+        self.assertFalse(os.path.exists(marker))
+        status = cron.read_status('job', self.tmpdir)
+        self.assertEqual(1, status['skipped'])
+        self.assertEqual('success', status['outcome'])
+
+        # The lock is released with the file.
+        cron.run_job('job', 'touch %s' % marker, state_dir=self.tmpdir)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_run_job_keeps_skips_during_run(self):
+        # The job itself tries to start another run, which is skipped while
+        # it still holds the lock.
+        hooks_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(cron.__file__))))
+        job = ('%s -c "import sys; sys.path.insert(0, \'%s\'); '
+               'from charmhelpers.canonical_ci import cron; '
+               'cron.run_job(\'job\', \'true\', state_dir=\'%s\')" '
+               '2>/dev/null' % (sys.executable, hooks_dir, self.tmpdir))
+        self.assertEqual(0, cron.run_job('job', job, state_dir=self.tmpdir))
+        status = cron.read_status('job', self.tmpdir)
+        self.assertEqual('success', status['outcome'])
+        self.assertEqual(1, status['skipped'])
+
+    @mock.patch('time.sleep')
+    @mock.patch('random.uniform')
+    def test_run_job_jitter(self, mock_uniform, mock_sleep):
+        mock_uniform.return_value = 12.5
+        cron.run_job('job', 'true', jitter=60, state_dir=self.tmpdir)
+        mock_uniform.assert_called_with(0, 60)
+        mock_sleep.assert_called_with(12.5)
+
+    @mock.patch('os.chown')
+    @mock.patch.dict(os.environ, {'CHARM_DIR': '/charm'})
+    def test_wrap_job(self, mock_chown):
+        with mock.patch.object(cron, 'STATE_DIR', self.tmpdir):
+            self.assertEqual(
+                "/charm/scripts/cron_job.py --jitter 30 sync "
+                "'sync.py > /tmp/log 2>&1'",
+                cron.wrap_job('sync', 'root', 'sync.py > /tmp/log 2>&1', 30))
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir, 'sync')))
+        mock_chown.assert_called_with(os.path.join(self.tmpdir, 'sync'), 0, 0)
+
+    def _git(self, repo, *args):
+        subprocess.check_call(['git', '-C', repo, '-c', 'user.name=ci',
+                               '-c', 'user.email=ci@example.com'] +
+                              list(args), stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+
+    def test_repo_update_command_retries_failed_update(self):
+        upstream = os.path.join(self.tmpdir, 'upstream')
+        checkout = os.path.join(self.tmpdir, 'checkout')
+        os.makedirs(os.path.join(self.tmpdir, 'repo_update'))
+        subprocess.check_call(['git', 'init', '-q', upstream])
+        self._git(upstream, 'commit', '-q', '--allow-empty', '-m', 'one')
+        self._git(self.tmpdir, 'clone', '-q', upstream, checkout)
+
+        updates = os.path.join(self.tmpdir, 'updates')
+        jenkins_jobs = os.path.join(self.tmpdir, 'jenkins-jobs')
+        with open(jenkins_jobs, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\nexit $FAIL\n' % updates)
+        os.chmod(jenkins_jobs, 0755)
+
+        def update(fail=0):
+            with mock.patch.object(cron, 'JENKINS_JOBS', jenkins_jobs):
+                cmd = cron.repo_update_command(checkout, 'git', '/jobs',
+                                               state_dir=self.tmpdir)
+            with open(os.devnull, 'w') as null:
+                ret = subprocess.call(cmd, shell=True, stdout=null,
+                                      stderr=null,
+                                      env=dict(os.environ, FAIL=str(fail)))
+            with open(updates) as f:
+                return ret, len(f.readlines())
+
+        # A failed update is retried although no new revision came in.
+        self.assertEqual((1, 1), update(fail=1))
+        self.assertEqual((0, 2), update())
+        self.assertEqual((0, 2), update())
+        self._git(upstream, 'commit', '-q', '--allow-empty', '-m', 'two')
+        self.assertEqual((0, 3), update())
@@ -0,0 +1,247 @@
+import hashlib
+import importlib
+import mock
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import testtools
+import urllib2
+
+from charmhelpers import fetch
+
+
+def package(version=None):
+    p = mock.Mock()
+    p.current_ver = version and mock.Mock(ver_str=version)
+    return p
+
+
+class FetchTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(FetchTestCase, self).setUp()
+        fetch.invalidate_package_cache()
+        self.addCleanup(fetch.invalidate_package_cache)
+        for name in ('apt_pkg', 'log', 'subprocess'):
+            patcher = mock.patch.object(fetch, name)
+            setattr(self, 'mock_' + name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.packages = {'git': package('1:1.9.1'), 'bzr': package()}
+        self.mock_apt_pkg.Cache.return_value = self.packages
+
+    def test_installed_versions(self):
+        self.assertEqual({'git': '1:1.9.1', 'bzr': None, 'nope': None},
+                         fetch.installed_versions(['git', 'bzr', 'nope']))
+        self.assertEqual(['bzr', 'nope'],
+                         fetch.filter_installed_packages(['git', 'bzr',
+                                                          'nope']))
+        self.assertEqual(1, self.mock_apt_pkg.Cache.call_count)
+
+    def test_apt_install_invalidates_cache(self):
+        self.assertEqual(['bzr'], fetch.filter_installed_packages(['bzr']))
+        self.packages['bzr'] = package('2.6.0')
+        self.assertEqual(['bzr'], fetch.filter_installed_packages(['bzr']))
+
+        fetch.apt_install(['bzr'], fatal=True)
+        self.assertEqual([], fetch.filter_installed_packages(['bzr']))
+        self.assertEqual(2, self.mock_apt_pkg.Cache.call_count)
+
+    def test_install_queued_packages(self):
+        fetch.queue_packages(['git', 'bzr'])
+        fetch.queue_packages(['python-pip'])
+        fetch.queue_packages('bzr', options=['--option', 'Foo=1'])
+        self.assertEqual(['bzr', 'python-pip'],
+                         fetch.install_queued_packages(fatal=True))
+        self.mock_subprocess.check_call.assert_called_once_with(
+            ['apt-get', '--assume-yes',
+             '--option=Dpkg::Options::=--force-confold', 'install',
+             'bzr', 'python-pip'], env=mock.ANY)
+
+        # Nothing is queued any more.
+        self.assertEqual([], fetch.install_queued_packages(fatal=True))
+        self.assertEqual(1, self.mock_subprocess.check_call.call_count)
+
+    def test_install_queued_packages_keeps_options_apart(self):
+        fetch.queue_packages(['bzr'])
+        fetch.queue_packages(['python-pip', 'bzr'],
+                             options=['--option', 'Foo=1'])
+        self.assertEqual(['bzr', 'python-pip'],
+                         fetch.install_queued_packages(fatal=True))
+        self.assertEqual(
+            [mock.call(['apt-get', '--assume-yes',
+                        '--option=Dpkg::Options::=--force-confold',
+                        'install', 'bzr'], env=mock.ANY),
+             mock.call(['apt-get', '--assume-yes', '--option', 'Foo=1',
+                        'install', 'python-pip'], env=mock.ANY)],
+            self.mock_subprocess.check_call.call_args_list)
+
+
+class BzrUrlFetchHandlerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(BzrUrlFetchHandlerTestCase, self).setUp()
+        self.bzrlib = mock.Mock()
+        # NotBranchError and NoWorkingTree need to be real exceptions.
+        self.bzrlib.errors.NotBranchError = type('NotBranchError',
+                                                 (Exception,), {})
+        self.bzrlib.errors.NoWorkingTree = type('NoWorkingTree',
+                                                (Exception,), {})
+        modules = dict(('bzrlib' + name, getattr(self.bzrlib, name[1:])
+                        if name else self.bzrlib)
+                       for name in ('', '.branch', '.bzrdir', '.errors',
+                                    '.plugin'))
+        patcher = mock.patch.dict(sys.modules, modules)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Imported afresh against the mocked bzrlib of each test.
+        bzrurl = importlib.import_module('charmhelpers.fetch.bzrurl')
+        for name in ('log', 'mkdir'):
+            patcher = mock.patch.object(bzrurl, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.handler = bzrurl.BzrUrlFetchHandler()
+        self.Branch = self.bzrlib.branch.Branch
+        self.remote = mock.Mock()
+        self.local = mock.Mock()
+
+    def _open(self, local):
+        def open_branch(path):
+            if path == '/fetched/project':
+                if isinstance(local, type):
+                    raise local(path)
+                return local
+            return self.remote
+        self.Branch.open.side_effect = open_branch
+
+    def test_branch_new(self):
+        self._open(self.bzrlib.errors.NotBranchError)
+        sprouted = self.remote.bzrdir.sprout.return_value.open_branch()
+        sprouted.revno.return_value = 42
+        self.assertEqual(42, self.handler.branch('lp:project',
+                                                 '/fetched/project'))
+        self.assertTrue(self.bzrlib.plugin.load_plugins.called)
+        self.remote.bzrdir.sprout.assert_called_with('/fetched/project')
+
+    def test_branch_pulls_into_existing(self):
+        self._open(self.local)
+        tree = self.local.bzrdir.open_workingtree.return_value
+        tree.pull.return_value = mock.Mock(old_revno=40, new_revno=42)
+        self.assertEqual(2, self.handler.branch('lp:project',
+                                                '/fetched/project'))
+        tree.pull.assert_called_with(self.remote, overwrite=True)
+        self.assertFalse(self.remote.bzrdir.sprout.called)
+
+    def test_branch_overwritten_with_older_history(self):
+        self._open(self.local)
+        self.local.bzrdir.open_workingtree.side_effect = \
+            self.bzrlib.errors.NoWorkingTree()
+        self.local.pull.return_value = mock.Mock(old_revno=42, new_revno=40)
+        self.assertEqual(0, self.handler.branch('lp:project',
+                                                '/fetched/project'))
+        self.local.pull.assert_called_with(self.remote, overwrite=True)
+
+    def test_install_uses_shared_repository(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch.dict(os.environ, {'CHARM_DIR': tmpdir}), \
+                mock.patch.object(self.handler, 'branch') as branch:
+            branch.return_value = 3
+            self.assertEqual(
+                os.path.join(tmpdir, 'fetched', 'project'),
+                self.handler.install('lp:~team/project'))
+        self.bzrlib.bzrdir.BzrDir.create.assert_called_with(
+            os.path.join(tmpdir, 'fetched'))
+        self.bzrlib.bzrdir.BzrDir.create().create_repository \
+            .assert_called_with(shared=True)
+
+
+class ArchiveUrlFetchHandlerTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ArchiveUrlFetchHandlerTestCase, self).setUp()
+        from charmhelpers.fetch import archiveurl
+        self.archiveurl = archiveurl
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, 'foo.tgz')
+        mkdir = mock.Mock(side_effect=lambda path, perms: os.makedirs(path))
+        for name, value in [('log', mock.Mock()), ('mkdir', mkdir)]:
+            patcher = mock.patch.object(archiveurl, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(archiveurl.urllib2, 'urlopen')
+        self.urlopen = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = archiveurl.ArchiveUrlFetchHandler()
+
+    def _response(self, data, code=200):
+        response = StringIO.StringIO(data)
+        response.getcode = lambda: code
+        return response
+
+    def _http_error(self, code):
+        return urllib2.HTTPError('http://example.com/foo.tgz', code, 'error',
+                                 {}, None)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_download_resumes_partial(self):
+        with open(self.dest + '.part', 'w') as f:
+            f.write('hello ')
+        self.urlopen.return_value = self._response('world', 206)
+        self.handler.download('http://example.com/foo.tgz', self.dest,
+                              hashlib.sha256('hello world').hexdigest())
+        request = self.urlopen.call_args[0][0]
+        self.assertEqual('bytes=6-', request.get_header('Range'))
+        self.assertEqual('hello world', self._read(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_download_restarts_unsatisfiable_range(self):
+        with open(self.dest + '.part', 'w') as f:
+            f.write('stale data')
+        self.urlopen.side_effect = [self._http_error(416),
+                                    self._response('hello world')]
+        self.handler.download('http://example.com/foo.tgz', self.dest)
+        self.assertEqual(2, self.urlopen.call_count)
+        self.assertIsNone(
+            self.urlopen.call_args[0][0].get_header('Range'))
+        self.assertEqual('hello world', self._read(self.dest))
+
+    def test_download_checksum_mismatch(self):
+        self.urlopen.return_value = self._response('tampered')
+        self.assertRaises(self.archiveurl.ChecksumError,
+                          self.handler.download,
+                          'http://example.com/foo.tgz', self.dest,
+                          hashlib.sha256('hello world').hexdigest())
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    @mock.patch.dict(os.environ, {})
+    def test_install_uses_cache(self):
+        os.environ['CHARM_DIR'] = self.tmpdir
+        checksum = hashlib.sha256('hello world').hexdigest()
+        source = 'http://example.com/foo.tgz#sha256=%s' % checksum
+        self.urlopen.return_value = self._response('hello world')
+        with mock.patch.object(self.archiveurl, 'extract') as extract:
+            extract.return_value = '/archives/foo.tgz'
+            self.assertEqual('/archives/foo.tgz',
+                             self.handler.install(source))
+            cached = self.handler.cache_path(source, checksum)
+            self.assertTrue(cached.startswith(
+                os.path.join(self.tmpdir, 'fetched')))
+            extract.assert_called_with(cached)
+            self.assertEqual('hello world', self._read(cached))
+
+            # The second install is served from the cache.
+            self.handler.install(source)
+        self.assertEqual(1, self.urlopen.call_count)
+
+    def test_install_checksum_mismatch(self):
+        self.urlopen.return_value = self._response('tampered')
+        with mock.patch.dict(os.environ, {'CHARM_DIR': self.tmpdir}):
+            self.assertRaises(fetch.UnhandledSource, self.handler.install,
+                              'http://example.com/foo.tgz#sha256=abc')
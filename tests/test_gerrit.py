@@ -3,6 +3,7 @@ import mock
 import testtools
 import tempfile
 import shutil
+import subprocess
 import gerrit
 
 LS_REMOTE_OUTPUT_NO_BRANCHES = """
@@ -20,7 +21,7 @@ LS_REMOTE_OUTPUT_W_BRANCHES = """
 def common_mocks(f):
     def common_test_mocks_inner(inst, *args, **kwargs):
 
-        @mock.patch('gerrit.apt_install')
+        @mock.patch('gerrit.install_queued_packages')
         @mock.patch('gerrit.log')
         def common_test_mocks_inner2(*inner_args):
             for arg in inner_args:
@@ -142,3 +143,152 @@ class GerritTestCase(testtools.TestCase):
         mock_run_as_user.return_value = \
             "Initial permissions\nInitial permissions\n"
         self.assertTrue(gerrit.is_permissions_initialised('foo', 'bar'))
+
+    @mock.patch('gerrit.query_gerrit_groups')
+    @mock.patch('common.run_as_user')
+    @common_mocks
+    def test_setup_gerrit_groups_from_client(self, mock_run_as_user,
+                                             mock_query_gerrit_groups):
+        client = mock.Mock()
+        client.list_groups.return_value = {'Administrators': 'abc123',
+                                           'ci-team': 'def456'}
+        gerrit.setup_gerrit_groups(self.tmpdir, 'admin', 'admin@localhost',
+                                   client)
+        self.assertFalse(mock_query_gerrit_groups.called)
+        with open(os.path.join(self.tmpdir, 'groups')) as fd:
+            self.assertEqual('abc123\tAdministrators\ndef456\tci-team\n',
+                             fd.read())
+        self.assertEqual(2, mock_run_as_user.call_count)
+
+    @mock.patch('gerrit.query_gerrit_groups')
+    @mock.patch('common.run_as_user')
+    @common_mocks
+    def test_setup_gerrit_groups_fallback(self, mock_run_as_user,
+                                          mock_query_gerrit_groups):
+        client = mock.Mock()
+        client.list_groups.return_value = None
+        mock_query_gerrit_groups.return_value = {}
+        self.assertRaises(gerrit.GerritConfigurationException,
+                          gerrit.setup_gerrit_groups, self.tmpdir, 'admin',
+                          'admin@localhost', client)
+        self.assertTrue(mock_query_gerrit_groups.called)
+        self.assertFalse(mock_run_as_user.called)
+
+    def test_read_ref(self):
+        os.makedirs(os.path.join(self.tmpdir, 'refs', 'meta'))
+        with open(os.path.join(self.tmpdir, 'packed-refs'), 'w') as fd:
+            fd.write('# pack-refs with: peeled fully-peeled\n'
+                     '9e536656202181d9c2684a66eaf38886555cf740 '
+                     'refs/heads/master\n')
+        self.assertEqual('9e536656202181d9c2684a66eaf38886555cf740',
+                         gerrit.read_ref(self.tmpdir, 'refs/heads/master'))
+        self.assertIsNone(gerrit.read_ref(self.tmpdir, 'refs/meta/config'))
+
+        with open(os.path.join(self.tmpdir, 'refs', 'meta', 'config'),
+                  'w') as fd:
+            fd.write('15ac7baff8d1251547a51dd3b1d51c52e0932d0d\n')
+        self.assertEqual('15ac7baff8d1251547a51dd3b1d51c52e0932d0d',
+                         gerrit.read_ref(self.tmpdir, 'refs/meta/config'))
+
+    @mock.patch('gerrit.is_permissions_initialised')
+    @mock.patch('gerrit.read_ref')
+    @common_mocks
+    def test_permissions_initialised_state(self, mock_read_ref,
+                                           mock_is_initialised):
+        state_file = os.path.join(self.tmpdir, 'state.json')
+        mock_read_ref.return_value = 'abc123'
+        mock_is_initialised.return_value = True
+        with mock.patch('gerrit.PERMISSIONS_STATE_FILE', state_file):
+            self.assertTrue(gerrit.permissions_initialised('All-Projects.git'))
+            self.assertEqual(1, mock_is_initialised.call_count)
+            # The recorded commit is trusted without looking at history.
+            self.assertTrue(gerrit.permissions_initialised('All-Projects.git'))
+            self.assertEqual(1, mock_is_initialised.call_count)
+
+            mock_read_ref.return_value = 'def456'
+            mock_is_initialised.return_value = False
+            self.assertFalse(
+                gerrit.permissions_initialised('All-Projects.git'))
+
+    @common_mocks
+    def test_changed_permissions(self):
+        env = dict(os.environ, GIT_AUTHOR_NAME='test',
+                   GIT_AUTHOR_EMAIL='test@localhost',
+                   GIT_COMMITTER_NAME='test',
+                   GIT_COMMITTER_EMAIL='test@localhost')
+
+        def git(*args):
+            return subprocess.check_output(('git',) + args, cwd=self.tmpdir,
+                                           env=env)
+
+        git('init', '--quiet', '--bare')
+        blob = git('hash-object', '-w', '--stdin').strip()
+        self.assertEqual(gerrit.git_blob_hash(''), blob)
+        tree = subprocess.Popen(
+            ['git', 'mktree'], cwd=self.tmpdir, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE).communicate(
+                '100644 blob %s\tproject.config\n' % blob)[0].strip()
+        commit = git('commit-tree', tree, '-m', 'init').strip()
+        git('update-ref', 'refs/meta/config', commit)
+
+        with mock.patch('common.run_as_user') as mock_run_as_user:
+            mock_run_as_user.side_effect = \
+                lambda user, cmd, cwd: subprocess.check_output(cmd, cwd=cwd)
+            self.assertEqual(['groups'], gerrit.changed_permissions(
+                self.tmpdir, {'project.config': '', 'groups': 'x\ty\n'}))
+
+    @mock.patch('gerrit.push_permissions')
+    @mock.patch('gerrit.changed_permissions')
+    @mock.patch('gerrit.read_ref')
+    @common_mocks
+    def test_sync_permissions_skips_unchanged(self, mock_read_ref,
+                                              mock_changed_permissions,
+                                              mock_push_permissions):
+        perms = os.path.join(self.tmpdir, 'permissions')
+        os.makedirs(os.path.join(perms, 'All-Projects'))
+        with open(os.path.join(perms, 'All-Projects', 'project.config'),
+                  'w') as fd:
+            fd.write('[access]\n')
+        client = mock.Mock()
+        client.list_groups.return_value = {'ci-team': 'def456'}
+        mock_read_ref.return_value = 'abc123'
+        mock_changed_permissions.return_value = ['project.config']
+
+        with mock.patch('gerrit.PERMISSIONS_DIR', perms), \
+                mock.patch('gerrit.PERMISSIONS_STATE_FILE',
+                           os.path.join(self.tmpdir, 'state.json')):
+            self.assertTrue(gerrit.sync_permissions(client, 'admin',
+                                                    'admin@localhost'))
+            files = mock_push_permissions.call_args[0][1]
+            self.assertEqual('def456\tci-team\n', files['groups'])
+
+            self.assertFalse(gerrit.sync_permissions(client, 'admin',
+                                                     'admin@localhost'))
+            self.assertEqual(1, mock_changed_permissions.call_count)
+            self.assertEqual(1, mock_push_permissions.call_count)
+
+    @mock.patch('gerrit.cron')
+    @mock.patch('gerrit.get_relation_settings')
+    @mock.patch('gerrit.config')
+    @common_mocks
+    def test_update_launchpad_sync_cron(self, mock_config,
+                                        mock_get_relation_settings,
+                                        mock_cron):
+        mock_config.side_effect = {'lp-schedule': '@hourly',
+                                   'cron-jitter': 60}.get
+        mock_get_relation_settings.return_value = {
+            'admin_username': 'admin', 'admin_privkey_path': '/key'}
+        with mock.patch('gerrit.PERMISSIONS_DIR', self.tmpdir), \
+                mock.patch.dict('os.environ', {'CHARM_DIR': '/charm'}):
+            gerrit.update_launchpad_sync_cron()
+        mock_cron.schedule_generic_job.assert_called_once_with(
+            '@hourly', 'root', 'launchpad_sync',
+            '/charm/scripts/query_lp_members.py admin /key > %s 2>&1' %
+            os.path.join(gerrit.LOGS_PATH, 'launchpad_sync.log'),
+            jitter=60)
+
+        mock_cron.reset_mock()
+        mock_get_relation_settings.return_value = None
+        with mock.patch('gerrit.PERMISSIONS_DIR', self.tmpdir):
+            gerrit.update_launchpad_sync_cron()
+        self.assertFalse(mock_cron.schedule_generic_job.called)
@@ -0,0 +1,276 @@
+import mock
+import socket
+import testtools
+
+from charmhelpers.canonical_ci import gerrit
+
+LS_GROUPS_OUTPUT = """Administrators	abc123		Administrators	abc123	false
+ci-team	def456	CI team	Administrators	abc123	false
+"""
+
+
+class GerritClientTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(GerritClientTestCase, self).setUp()
+        gerrit._connections.clear()
+        self.addCleanup(gerrit._connections.clear)
+        patcher = mock.patch.object(gerrit.paramiko, 'SSHClient')
+        self.mock_ssh_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = \
+            self.mock_ssh_client.return_value.get_transport.return_value
+        self.transport.is_active.return_value = True
+
+    def test_get_ssh_pools_by_key(self):
+        conn = gerrit.get_ssh('localhost', 'admin', 29418, '/key')
+        self.assertIs(conn, gerrit.get_ssh('localhost', 'admin', 29418,
+                                           '/key'))
+        self.assertIsNot(conn, gerrit.get_ssh('localhost', 'other', 29418,
+                                              '/key'))
+        self.transport.set_keepalive.assert_called_with(
+            gerrit.KEEPALIVE_INTERVAL)
+
+    def test_get_ssh_reconnects_dead_transport(self):
+        conn = gerrit.get_ssh('localhost', 'admin', 29418, '/key')
+        self.transport.is_active.return_value = False
+        with mock.patch.object(gerrit.SSHConnection, 'connect') as connect:
+            self.assertIs(conn, gerrit.get_ssh('localhost', 'admin', 29418,
+                                               '/key'))
+            self.assertTrue(connect.called)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_get_ssh_probes_transport(self, mock_log):
+        conn = gerrit.get_ssh('localhost', 'admin', 29418, '/key')
+        self.assertTrue(conn.is_alive())
+        # The session is gone although paramiko hasn't noticed yet.
+        self.transport.send_ignore.side_effect = EOFError()
+        self.assertFalse(conn.is_alive())
+        with mock.patch.object(gerrit.SSHConnection, 'connect') as connect:
+            gerrit.get_ssh('localhost', 'admin', 29418, '/key')
+            self.assertTrue(connect.called)
+
+    def test_connect_skips_replaced_client(self):
+        self.mock_ssh_client.side_effect = lambda: mock.Mock()
+        conn = gerrit.SSHConnection('localhost', 'admin', 29418, '/key')
+        stale = conn.client
+        conn.connect(stale=stale)
+        current = conn.client
+        self.assertIsNot(stale, current)
+        # Another thread that saw the old client fail leaves the new one.
+        conn.connect(stale=stale)
+        self.assertIs(current, conn.client)
+        self.assertFalse(current.close.called)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_run_cmd_reconnects_once(self, mock_log):
+        self.mock_ssh_client.side_effect = lambda: mock.Mock()
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        stale = client.ssh.client
+        replaced = []
+
+        def run(cmd, ssh_client=None):
+            if ssh_client is stale:
+                # Another command failed and reconnected meanwhile.
+                client.ssh.connect(stale=stale)
+                replaced.append(client.ssh.client)
+                raise socket.error('reset')
+            return ('out', '', 0)
+
+        with mock.patch.object(client.ssh, 'run', side_effect=run):
+            self.assertEqual(('out', ''), client._run_cmd('gerrit ls-groups'))
+        self.assertIs(replaced[0], client.ssh.client)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_run_cmd_retries_idempotent(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client.ssh, 'run') as run, \
+                mock.patch.object(client.ssh, 'connect') as connect:
+            run.side_effect = [socket.error('reset'), ('out', '', 0)]
+            self.assertEqual(('out', ''), client._run_cmd(
+                'gerrit gsql --format json -c "SELECT 1"'))
+            self.assertTrue(connect.called)
+            self.assertEqual(2, run.call_count)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_run_cmd_does_not_retry_writes(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client.ssh, 'run') as run, \
+                mock.patch.object(client.ssh, 'connect'):
+            run.side_effect = [socket.error('reset'), ('out', '', 0)]
+            self.assertRaises(socket.error, client._run_cmd,
+                              'gerrit gsql -c "DELETE FROM account_ssh_keys"')
+            self.assertEqual(1, run.call_count)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_list_groups_cached(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd:
+            run_cmd.return_value = (LS_GROUPS_OUTPUT, '')
+            self.assertEqual({'Administrators': 'abc123',
+                              'ci-team': 'def456'}, client.list_groups())
+            client.list_groups()
+            self.assertEqual(1, run_cmd.call_count)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_create_groups_only_missing(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd, \
+                mock.patch.object(client, '_run_cmds') as run_cmds:
+            run_cmd.return_value = (LS_GROUPS_OUTPUT, '')
+            run_cmds.return_value = [('', '', 0)]
+            self.assertEqual(['new-team'], client.create_groups(
+                ['ci-team', 'new-team']))
+            run_cmds.assert_called_with(['gerrit create-group "new-team"'])
+
+            # Groups created meanwhile by someone else are not reported.
+            run_cmds.return_value = [
+                ('', 'fatal: Name Already Used\n', 1), ('', '', 0),
+                ('', 'fatal: Permission denied\n', 1)]
+            self.assertEqual(['b-team'], client.create_groups(
+                ['a-team', 'b-team', 'c-team']))
+
+    @mock.patch.object(gerrit, 'log')
+    def test_create_project_uses_inventory(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd:
+            run_cmd.side_effect = [('{"All-Projects": {"id": "x"}, '
+                                    '"neutron": {"id": "y"}}\n', ''),
+                                   ('', '')]
+            self.assertTrue(client.create_project('neutron'))
+            self.assertTrue(client.create_project('nova'))
+            self.assertTrue(client.create_project('nova'))
+            run_cmd.assert_has_calls([
+                mock.call('gerrit ls-projects --type all --format json'),
+                mock.call('gerrit create-project nova')])
+            self.assertEqual(2, run_cmd.call_count)
+
+    @mock.patch.object(gerrit, 'start_gerrit')
+    @mock.patch.object(gerrit, 'stop_gerrit')
+    @mock.patch.object(gerrit, 'log')
+    def test_create_users_flushes_once(self, mock_log, mock_stop,
+                                       mock_start):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd:
+            run_cmd.side_effect = lambda cmd: (
+                ('', 'fatal: bad key\n') if 'bob' in cmd else ('', ''))
+            status = client.create_users([
+                ('alice', 'Alice', 'ci-team', 'ssh-rsa AAAA'),
+                ('bob', 'Bob', 'ci-team', 'ssh-rsa BBBB'),
+                ('carol', 'Carol', 'ci-team', 'ssh-rsa CCCC')])
+            self.assertEqual({'alice': 'created', 'bob': 'failed',
+                              'carol': 'created'}, status)
+            cmds = [c[0][0] for c in run_cmd.call_args_list]
+            self.assertEqual(['gerrit flush-caches'], cmds[3:])
+        self.assertFalse(mock_stop.called)
+        self.assertFalse(mock_start.called)
+
+    @mock.patch.object(gerrit, 'start_gerrit')
+    @mock.patch.object(gerrit, 'stop_gerrit')
+    @mock.patch.object(gerrit, 'log')
+    def test_apply_deferred_restarts_if_flush_fails(self, mock_log,
+                                                    mock_stop, mock_start):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd:
+            run_cmd.return_value = ('', 'fatal: not permitted\n')
+            with client.batch():
+                client.defer('flush-caches')
+                client.defer('flush-caches')
+                self.assertFalse(run_cmd.called)
+            run_cmd.assert_called_once_with('gerrit flush-caches')
+        mock_stop.assert_called_once_with()
+        mock_start.assert_called_once_with()
+
+    def test_parse_gsql(self):
+        lines = ['{"type":"row","columns":{"account_id":"1000001",'
+                 '"name":"alice"}}\n',
+                 '\n',
+                 '{"type":"row","columns":{"account_id":"1000002",'
+                 '"name":"bob"}}\n',
+                 '{"type":"query-stats","rowCount":2,'
+                 '"runTimeMilliseconds":3}\n']
+        stats = {}
+        rows = list(gerrit.parse_gsql(iter(lines),
+                                      types={'account_id': int},
+                                      stats=stats))
+        self.assertEqual([{'account_id': 1000001, 'name': 'alice'},
+                          {'account_id': 1000002, 'name': 'bob'}], rows)
+        self.assertEqual(2, stats['rowCount'])
+
+    @mock.patch.object(gerrit, 'log')
+    def test_parse_gsql_error(self, mock_log):
+        lines = ['{"type":"error","message":"no such table"}\n']
+        self.assertRaises(gerrit.GerritException, list,
+                          gerrit.parse_gsql(iter(lines)))
+
+    @mock.patch.object(gerrit, 'log')
+    def test_get_account_id(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        stdout = mock.MagicMock()
+        stdout.__iter__.return_value = iter(
+            ['{"type":"row","columns":{"account_id":"1000001"}}\n',
+             '{"type":"query-stats","rowCount":1}\n'])
+        stdout.channel.recv_exit_status.return_value = 0
+        with mock.patch.object(client.ssh, 'exec_command') as exec_command:
+            exec_command.return_value = (None, stdout, mock.Mock())
+            self.assertEqual(1000001, client.get_account_id('alice'))
+            self.assertTrue(stdout.channel.close.called)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_gsql_batch_reports_failed_statements(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        stdin = mock.Mock()
+        stdout = mock.MagicMock()
+        stdout.__iter__.return_value = iter(
+            ['{"type":"update-stats","rowCount":1}\n',
+             '{"type":"error","message":"duplicate key"}\n',
+             '{"type":"update-stats","rowCount":0}\n'])
+        stdout.channel.recv_exit_status.return_value = 0
+        stderr = mock.Mock()
+        stderr.read.return_value = ''
+        with mock.patch.object(client.ssh, 'exec_command') as exec_command:
+            exec_command.return_value = (stdin, stdout, stderr)
+            failed = client.gsql_batch([('alice', 'DELETE 1'),
+                                        ('bob', 'INSERT 2'),
+                                        ('bob', 'INSERT 3'),
+                                        ('carol', 'INSERT 4')])
+            exec_command.assert_called_once_with('gerrit gsql --format json')
+            stdin.write.assert_called_once_with(
+                'DELETE 1;\nINSERT 2;\nINSERT 3;\nINSERT 4;\n')
+        self.assertEqual([('bob', 'INSERT 2', 'duplicate key'),
+                          ('carol', 'INSERT 4', 'no result from gsql')],
+                         failed)
+
+    @mock.patch.object(gerrit, 'log')
+    def test_add_group_members(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd, \
+                mock.patch.object(gerrit, 'GSQL_BATCH_SIZE', 2):
+            run_cmd.side_effect = [('', ''), ('', 'fatal: not registered\n'),
+                                   ('', '')]
+            self.assertEqual(['carol'], client.add_group_members(
+                'ci-team', ['alice', 'bob', 'carol']))
+            run_cmd.assert_has_calls([
+                mock.call('gerrit set-members "ci-team" --add alice '
+                          '--add bob'),
+                mock.call('gerrit set-members "ci-team" --add carol'),
+                mock.call('gerrit flush-caches')])
+
+    @mock.patch.object(gerrit, 'log')
+    def test_add_group_members_retries_failed_chunk(self, mock_log):
+        client = gerrit.GerritClient('localhost', 'admin', 29418, '/key')
+        with mock.patch.object(client, '_run_cmd') as run_cmd, \
+                mock.patch.object(gerrit, 'GSQL_BATCH_SIZE', 2):
+            run_cmd.side_effect = [('', 'fatal: bob not registered\n'),
+                                   ('', ''),
+                                   ('', 'fatal: bob not registered\n'),
+                                   ('', ''), ('', '')]
+            self.assertEqual(['bob'], client.add_group_members(
+                'ci-team', ['alice', 'bob', 'carol']))
+            run_cmd.assert_has_calls([
+                mock.call('gerrit set-members "ci-team" --add alice '
+                          '--add bob'),
+                mock.call('gerrit set-members "ci-team" --add alice'),
+                mock.call('gerrit set-members "ci-team" --add bob'),
+                mock.call('gerrit set-members "ci-team" --add carol'),
+                mock.call('gerrit flush-caches')])
@@ -0,0 +1,138 @@
+import json
+import os
+import mock
+import testtools
+import tempfile
+import shutil
+import hooks
+
+from charmhelpers.core import hookenv
+
+
+class HooksTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(HooksTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(HooksTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _config(self, current, previous=None):
+        if previous is not None:
+            path = os.path.join(self.tmpdir,
+                                hookenv.Config.CONFIG_FILE_NAME)
+            with open(path, 'w') as fd:
+                json.dump(previous, fd)
+        with mock.patch.object(hookenv, 'charm_dir') as mock_charm_dir:
+            mock_charm_dir.return_value = self.tmpdir
+            return hookenv.Config(current)
+
+    def test_changed_stages_first_run(self):
+        cfg = self._config({'update-frequency': '@daily'})
+        self.assertEqual(set(hooks.ALL_STAGES), hooks.changed_stages(cfg))
+
+    def test_changed_stages_unchanged(self):
+        current = {'update-frequency': '@daily', 'config-repo': 'lp:foo'}
+        cfg = self._config(current, previous=dict(current))
+        self.assertEqual(set(), hooks.changed_stages(cfg))
+
+    def test_changed_stages_update_frequency(self):
+        cfg = self._config({'update-frequency': '@hourly'},
+                           previous={'update-frequency': '@daily'})
+        self.assertEqual(set(['cron']), hooks.changed_stages(cfg))
+
+    def test_changed_stages_update_trigger(self):
+        cfg = self._config({'update-trigger': '2'},
+                           previous={'update-trigger': '1'})
+        self.assertEqual(set(hooks.ALL_STAGES), hooks.changed_stages(cfg))
+
+    @mock.patch('hooks.webhook')
+    @mock.patch('hooks.cron')
+    @mock.patch('hooks.run_relation_hooks')
+    @mock.patch('hooks.common')
+    @mock.patch('hooks.config')
+    @mock.patch('hooks.log')
+    def test_config_changed_cron_only(self, mock_log, mock_config,
+                                      mock_common, mock_run_relation_hooks,
+                                      mock_cron, mock_webhook):
+        cfg = self._config({'schedule-updates': True,
+                            'update-frequency': '@hourly',
+                            'config-repo-rcs': 'git'},
+                           previous={'schedule-updates': True,
+                                     'update-frequency': '@daily',
+                                     'config-repo-rcs': 'git'})
+        cfg.save = mock.Mock()
+
+        def fake_config(key=None):
+            if key is None:
+                return cfg
+            return cfg.get(key)
+
+        mock_config.side_effect = fake_config
+        hooks.config_changed()
+        self.assertFalse(mock_common.install_ssh_keys.called)
+        self.assertFalse(mock_common.update_configs_from_repo.called)
+        self.assertFalse(mock_run_relation_hooks.called)
+        self.assertTrue(mock_cron.schedule_repo_updates.called)
+        self.assertTrue(mock_webhook.remove.called)
+        self.assertTrue(cfg.save.called)
+
+    def test_changed_stages_lp_schedule(self):
+        cfg = self._config({'lp-schedule': '@hourly'},
+                           previous={'lp-schedule': '@daily'})
+        self.assertEqual(set(['lp-cron']), hooks.changed_stages(cfg))
+
+    def _fake_config(self, cfg):
+        cfg.save = mock.Mock()
+
+        def fake_config(key=None):
+            if key is None:
+                return cfg
+            return cfg.get(key)
+        return fake_config
+
+    @mock.patch('hooks.webhook')
+    @mock.patch('hooks.cron')
+    @mock.patch('hooks.gerrit')
+    @mock.patch('hooks.run_relation_hooks')
+    @mock.patch('hooks.common')
+    @mock.patch('hooks.config')
+    @mock.patch('hooks.log')
+    def test_config_changed_lp_schedule_only(self, mock_log, mock_config,
+                                             mock_common,
+                                             mock_run_relation_hooks,
+                                             mock_gerrit, mock_cron,
+                                             mock_webhook):
+        cfg = self._config({'lp-schedule': '@hourly'},
+                           previous={'lp-schedule': '@daily'})
+        mock_config.side_effect = self._fake_config(cfg)
+        hooks.config_changed()
+        self.assertFalse(mock_run_relation_hooks.called)
+        mock_gerrit.update_launchpad_sync_cron.assert_called_once_with()
+        self.assertFalse(mock_cron.schedule_repo_updates.called)
+        self.assertTrue(cfg.save.called)
+
+    @mock.patch('hooks.is_valid_config_repo')
+    @mock.patch('hooks.charm_dir')
+    @mock.patch('hooks.gerrit')
+    @mock.patch('hooks.run_relation_hooks')
+    @mock.patch('hooks.common')
+    @mock.patch('hooks.config')
+    @mock.patch('hooks.log')
+    def test_config_changed_without_config_repo(self, mock_log, mock_config,
+                                                mock_common,
+                                                mock_run_relation_hooks,
+                                                mock_gerrit, mock_charm_dir,
+                                                mock_is_valid):
+        cfg = self._config({'config-repo': ''},
+                           previous={'config-repo': 'lp:foo'})
+        mock_config.side_effect = self._fake_config(cfg)
+        mock_charm_dir.return_value = self.tmpdir
+        mock_common.LOCAL_CONFIG_REPO = 'no-such-repo'
+        mock_is_valid.return_value = False
+        hooks.config_changed()
+        self.assertFalse(mock_common.update_configs_from_repo.called)
+        mock_run_relation_hooks.assert_called_once_with()
+        self.assertFalse(mock_gerrit.update_launchpad_sync_cron.called)
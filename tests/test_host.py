@@ -0,0 +1,70 @@
+import hashlib
+import os
+import mock
+import testtools
+import tempfile
+import shutil
+
+from charmhelpers.core import host
+
+
+class HostTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(HostTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        host._hash_memo.clear()
+
+    def tearDown(self):
+        super(HostTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, content):
+        with open(os.path.join(self.tmpdir, path), 'w') as fd:
+            fd.write(content)
+
+    def test_file_hash(self):
+        path = os.path.join(self.tmpdir, 'config.xml')
+        self.assertIsNone(host.file_hash(path))
+        content = 'x' * (3 * host.HASH_CHUNK_SIZE + 1)
+        self._write('config.xml', content)
+        expected = host.file_hash(path)
+        self.assertEqual(hashlib.md5(content).hexdigest(), expected)
+
+        # Unchanged files are not read again.
+        with mock.patch('__builtin__.open') as mock_open:
+            self.assertEqual(expected, host.file_hash(path))
+            self.assertFalse(mock_open.called)
+
+        self._write('config.xml', 'y')
+        self.assertNotEqual(expected, host.file_hash(path))
+
+    def test_path_hash_directory(self):
+        os.makedirs(os.path.join(self.tmpdir, 'hooks', 'lib'))
+        self._write('hooks/patchset-created', 'a')
+        self._write('hooks/lib/common', 'b')
+        path = os.path.join(self.tmpdir, 'hooks')
+        before = host.path_hash(path)
+        self.assertEqual(before, host.path_hash(path))
+
+        self._write('hooks/lib/common', 'c')
+        changed = host.path_hash(path)
+        self.assertNotEqual(before, changed)
+
+        os.rename(os.path.join(path, 'lib', 'common'),
+                  os.path.join(path, 'lib', 'other'))
+        self.assertNotEqual(changed, host.path_hash(path))
+
+    @mock.patch('charmhelpers.core.host.service')
+    def test_restart_on_change_directory(self, mock_service):
+        os.makedirs(os.path.join(self.tmpdir, 'theme'))
+
+        @host.restart_on_change({os.path.join(self.tmpdir, 'theme'):
+                                 ['gerrit']})
+        def write(content):
+            self._write('theme/GerritSite.css', content)
+
+        write('body {}')
+        mock_service.assert_called_once_with('restart', 'gerrit')
+        write('body {}')
+        self.assertEqual(1, mock_service.call_count)
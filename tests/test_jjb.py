@@ -0,0 +1,147 @@
+import os
+import mock
+import testtools
+import tempfile
+import shutil
+import jjb
+
+CONFIG = """<hudson>
+  <numExecutors>2</numExecutors>
+  <useSecurity>true</useSecurity>
+  <authorizationStrategy class="hudson.security.FullControlOnceLoggedIn">
+    <permission>hudson.model.Hudson.Administer:admin</permission>
+  </authorizationStrategy>
+</hudson>
+"""
+
+# Same strategy as CONFIG, formatted differently.
+SECURITY = """<authorizationStrategy
+    class="hudson.security.FullControlOnceLoggedIn">
+  <permission>hudson.model.Hudson.Administer:admin</permission>
+</authorizationStrategy>"""
+
+
+class JJBTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(JJBTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'config.xml')
+        self.security_file = os.path.join(self.tmpdir, 'security.xml')
+        self._write(self.config_file, CONFIG)
+        self._write(self.security_file, SECURITY)
+        for name, value in [('JOBS_CONFIG_DIR', self.tmpdir),
+                            ('JENKINS_CONFIG_FILE', self.config_file),
+                            ('JENKINS_SECURITY_FILE', self.security_file),
+                            ('log', mock.Mock())]:
+            patcher = mock.patch.object(jjb, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(JJBTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, content):
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    @mock.patch('jjb.service_restart')
+    @mock.patch('jjb.reload_jenkins')
+    def test_update_jenkins_config_unchanged(self, mock_reload,
+                                             mock_restart):
+        self.assertFalse(jjb._update_jenkins_config())
+        with open(self.config_file) as fd:
+            self.assertEqual(CONFIG, fd.read())
+        self.assertFalse(mock_reload.called)
+        self.assertFalse(mock_restart.called)
+
+    @mock.patch('jjb.wait_for_jenkins')
+    @mock.patch('charmhelpers.canonical_ci.trace.run')
+    @mock.patch('jjb.service_restart')
+    @mock.patch('jjb.reload_jenkins')
+    def test_update_jenkins_config_changed(self, mock_reload, mock_restart,
+                                           mock_run, mock_wait):
+        self._write(self.config_file,
+                    CONFIG.replace('Administer:admin', 'Read:anonymous'))
+        mock_reload.return_value = True
+        self.assertTrue(jjb._update_jenkins_config())
+        self.assertTrue(mock_reload.called)
+        self.assertFalse(mock_restart.called)
+        self.assertTrue(mock_wait.called)
+        self.assertEqual(['config.xml', 'security.xml'],
+                         sorted(os.listdir(self.tmpdir)))
+
+        # The result is semantically equal to what was asked for.
+        mock_reload.reset_mock()
+        self.assertFalse(jjb._update_jenkins_config())
+        self.assertFalse(mock_reload.called)
+
+        # Jenkins is restarted if it can't be asked to reload.
+        self._write(self.config_file,
+                    CONFIG.replace('<useSecurity>true', '<useSecurity>false'))
+        mock_reload.return_value = False
+        self.assertTrue(jjb._update_jenkins_config())
+        mock_restart.assert_called_once_with('jenkins')
+
+    def test_security_configured_ignores_permission_order(self):
+        root = jjb.ET.fromstring(CONFIG.replace(
+            '<permission>hudson.model.Hudson.Administer:admin</permission>',
+            '<permission>hudson.model.Item.Read:anonymous</permission>\n'
+            '    <permission>hudson.model.Hudson.Administer:admin'
+            '</permission>'))
+        security = jjb.ET.fromstring(SECURITY.replace(
+            '</authorizationStrategy>',
+            '  <permission>hudson.model.Item.Read:anonymous</permission>\n'
+            '</authorizationStrategy>'))
+        self.assertTrue(jjb.security_configured(root, security))
+
+    @mock.patch('time.sleep')
+    @mock.patch('urllib2.urlopen')
+    @mock.patch('jjb.jenkins_context')
+    def test_wait_for_jenkins(self, mock_context, mock_urlopen, mock_sleep):
+        mock_context.return_value = {'jenkins_url': 'http://jenkins:8080/'}
+        unavailable = jjb.urllib2.HTTPError('http://jenkins:8080/api/json',
+                                            503, 'Unavailable', {}, None)
+        forbidden = jjb.urllib2.HTTPError('http://jenkins:8080/api/json',
+                                          403, 'Forbidden', {}, None)
+        mock_urlopen.side_effect = [jjb.urllib2.URLError('refused'),
+                                    unavailable, forbidden]
+        self.assertTrue(jjb.wait_for_jenkins())
+        self.assertEqual(3, mock_urlopen.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+
+        mock_urlopen.side_effect = unavailable
+        self.assertFalse(jjb.wait_for_jenkins(timeout=0))
+
+    @mock.patch('jjb.apt_install')
+    @mock.patch('charmhelpers.canonical_ci.trace.run')
+    @mock.patch('jjb.required_packages')
+    @mock.patch('jjb.is_jenkins_slave')
+    @mock.patch('jjb.config')
+    @mock.patch('jjb.relation_ids')
+    def test_update_jenkins_installs_packages_after_setupd(
+            self, mock_relation_ids, mock_config, mock_is_slave,
+            mock_required, mock_run, mock_apt_install):
+        mock_relation_ids.return_value = ['jenkins-configurator:1']
+        mock_config.return_value = True
+        mock_is_slave.return_value = True
+        mock_required.return_value = ['foo']
+        setupd = os.path.join(self.tmpdir, 'setup.d')
+        os.mkdir(setupd)
+        calls = mock.Mock()
+        calls.attach_mock(mock_run, 'run')
+        calls.attach_mock(mock_apt_install, 'apt_install')
+        with mock.patch.multiple(jjb, JENKINS_PATH=self.tmpdir,
+                                 common=mock.Mock(CI_CONFIG_DIR=self.tmpdir)):
+            jjb.update_jenkins()
+        self.assertEqual(
+            [mock.call.run(mock.ANY,
+                           ['run-parts', '--exit-on-error', setupd]),
+             mock.call.apt_install(
+                 ['foo'], options=['--option',
+                                   'Dpkg::Options::=--force-confnew',
+                                   '--option',
+                                   'Dpkg::Options::=--force-confdef'],
+                 fatal=True)],
+            calls.mock_calls)
@@ -0,0 +1,90 @@
+import mock
+import testtools
+
+import launchpad_sync
+
+
+def person(name, members=None):
+    p = mock.Mock()
+    p.name = name
+    p.display_name = name.title()
+    p.is_team = members is not None
+    p.preferred_email_address.email = '%s@example.com' % name
+    p.sshkeys = [mock.Mock(keytype='RSA', keytext='AAAA%s' % name,
+                           comment=name)]
+    p.members_details = [
+        mock.Mock(self_link='https://api.launchpad.net/1.0/~%s/+member/%s' %
+                  (name, m), status='Approved', date_last_changed='')
+        for m in members or []]
+    return p
+
+
+class LaunchpadSyncTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(LaunchpadSyncTestCase, self).setUp()
+        self.lp = mock.Mock()
+        self.lp.people = dict((p.name, p) for p in [
+            person('alice'), person('bob'), person('carol'),
+            person('core', ['alice', 'bob']),
+            person('all', ['core', 'carol'])])
+        self.openid = mock.Mock(side_effect=lambda login: 'id/' + login)
+        patcher = mock.patch('sys.stdout')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_team_members_recurses(self):
+        walker = launchpad_sync.TeamWalker(self.lp, openid=self.openid)
+        self.assertEqual(['alice', 'bob', 'carol'],
+                         sorted(walker.team_members('all', 'all')))
+        self.assertEqual(('alice', 'Alice', 'alice@example.com',
+                          ('ssh-rsa AAAAalice alice',), 'id/alice'),
+                         walker.people['alice'])
+
+    def test_team_members_reuses_snapshot(self):
+        snapshot = {}
+        walker = launchpad_sync.TeamWalker(self.lp, snapshot,
+                                           openid=self.openid)
+        walker.team_members('all', 'all')
+        self.assertEqual(3, self.openid.call_count)
+
+        walker = launchpad_sync.TeamWalker(self.lp, snapshot,
+                                           openid=self.openid)
+        self.assertEqual(['alice', 'bob', 'carol'],
+                         sorted(walker.team_members('all', 'all')))
+        self.assertEqual(3, self.openid.call_count)
+        self.assertEqual(['alice', 'bob', 'carol'], sorted(walker.people))
+
+        # A changed nested team is walked again.
+        self.lp.people['core'] = person('core', ['alice'])
+        walker = launchpad_sync.TeamWalker(self.lp, snapshot,
+                                           openid=self.openid)
+        self.assertEqual(['alice', 'carol'],
+                         sorted(walker.team_members('all', 'all')))
+        self.assertEqual(4, self.openid.call_count)
+
+    def test_sync_writes_each_person_once(self):
+        client = mock.MagicMock()
+        client.create_groups.return_value = []
+        client.create_users_batch.return_value = {
+            'alice': 'created', 'bob': 'updated', 'carol': 'failed'}
+        client.add_group_members.return_value = []
+        results = launchpad_sync.sync({'core-team': 'core',
+                                       'all-team': 'all core'},
+                                      client, self.lp, openid=self.openid)
+        self.assertEqual(['all-team', 'core-team'],
+                         sorted(client.create_groups.call_args[0][0]))
+        self.assertEqual(1, client.create_users_batch.call_count)
+        group, users = client.create_users_batch.call_args[0]
+        self.assertIsNone(group)
+        self.assertEqual(['alice', 'bob', 'carol'], [u[0] for u in users])
+        self.assertEqual(3, self.openid.call_count)
+
+        client.add_group_members.assert_has_calls(
+            [mock.call('core-team', ['alice', 'bob']),
+             mock.call('all-team', ['alice', 'bob'])], any_order=True)
+        self.assertEqual({'alice': 'created', 'bob': 'updated',
+                          'carol': 'failed'}, results['all-team'])
+        self.assertEqual({'alice': 'created', 'bob': 'updated'},
+                         results['core-team'])
+        self.assertTrue(client.batch.called)
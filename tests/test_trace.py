@@ -0,0 +1,93 @@
+import json
+import mock
+import os
+import subprocess
+import testtools
+import tempfile
+import shutil
+
+from charmhelpers.canonical_ci import trace
+
+
+class TraceTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(TraceTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = mock.Mock()
+        self.patch(trace, 'log', self.log)
+        trace.reset()
+
+    def tearDown(self):
+        super(TraceTestCase, self).tearDown()
+        trace.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def test_nested_spans(self):
+        with trace.span('create_projects'):
+            with trace.span('neutron'):
+                with trace.span('clone'):
+                    pass
+
+        names = [r['name'] for r in trace.records()]
+        self.assertEqual(['create_projects/neutron/clone',
+                          'create_projects/neutron',
+                          'create_projects'], names)
+
+    def test_span_failure(self):
+        def fail():
+            with trace.span('broken'):
+                raise ValueError('boom')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(1, trace.records()[0]['status'])
+
+    def test_run_records_exit_status(self):
+        with trace.span('hook'):
+            trace.run(subprocess.call, ['false'])
+            self.assertRaises(subprocess.CalledProcessError, trace.run,
+                              subprocess.check_call, ['false'])
+
+        call, check_call, hook = trace.records()
+        self.assertEqual('hook/false', call['name'])
+        self.assertEqual('false', call['cmd'])
+        self.assertEqual(1, call['status'])
+        self.assertEqual(1, check_call['status'])
+        self.assertEqual(0, hook['status'])
+
+    def test_finish_writes_jsonl(self):
+        path = os.path.join(self.tmpdir, 'logs', 'trace.jsonl')
+        with trace.span('config_changed'):
+            pass
+        trace.finish(path)
+
+        with open(path) as fd:
+            lines = fd.readlines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual('config_changed', json.loads(lines[0])['name'])
+        self.assertEqual([], trace.records())
+        self.assertIn('Trace summary', self.log.call_args[0][0])
+
+    def test_reset_closes_open_spans(self):
+        # e.g. a span in a generator that was never resumed
+        trace.span('abandoned').__enter__()
+        trace.reset()
+        with trace.span('config_changed'):
+            pass
+        self.assertEqual(['config_changed'],
+                         [r['name'] for r in trace.records()])
+
+    def test_write_rotates_large_file(self):
+        path = os.path.join(self.tmpdir, 'trace.jsonl')
+        with open(path, 'w') as fd:
+            fd.write('x' * 100 + '\n')
+        with trace.span('config_changed'):
+            pass
+        self.patch(trace, 'MAX_TRACE_SIZE', 100)
+        trace.write(path)
+
+        with open(path + '.1') as fd:
+            self.assertEqual('x' * 100 + '\n', fd.read())
+        with open(path) as fd:
+            self.assertEqual(['config_changed'],
+                             [json.loads(line)['name'] for line in fd])
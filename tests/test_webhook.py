@@ -0,0 +1,133 @@
+import hashlib
+import hmac
+import json
+import mock
+import os
+import shutil
+import stat
+import tempfile
+import testtools
+import threading
+import time
+import urllib2
+
+from charmhelpers.canonical_ci import webhook
+
+
+class WebhookTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(WebhookTestCase, self).setUp()
+        patcher = mock.patch.object(webhook, 'log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_debouncer_coalesces_triggers(self):
+        calls = []
+        debouncer = webhook.Debouncer(lambda: calls.append(1) or 0,
+                                      delay=0.1)
+        self.addCleanup(debouncer.stop)
+        for _ in range(5):
+            debouncer.trigger()
+            time.sleep(0.02)
+        self._wait_for(lambda: calls)
+        time.sleep(0.2)
+        self.assertEqual(1, len(calls))
+
+        debouncer.trigger()
+        self._wait_for(lambda: len(calls) == 2)
+        self.assertEqual(2, len(calls))
+
+    def test_debouncer_retries_skipped_run(self):
+        results = [None, 0]
+        debouncer = webhook.Debouncer(lambda: results.pop(0), delay=0.05)
+        self.addCleanup(debouncer.stop)
+        debouncer.trigger()
+        self._wait_for(lambda: not results)
+        self.assertEqual([], results)
+
+    def test_check_signature(self):
+        body = '{"ref": "refs/heads/master"}'
+        signature = 'sha1=' + hmac.new('s3cret', body,
+                                       hashlib.sha1).hexdigest()
+        self.assertTrue(webhook.check_signature('', body, {}))
+        self.assertTrue(webhook.check_signature(
+            's3cret', body, {'X-Hub-Signature': signature}))
+        self.assertTrue(webhook.check_signature(
+            's3cret', body, {'X-Webhook-Token': 's3cret'}))
+        self.assertFalse(webhook.check_signature(
+            's3cret', body + ' ', {'X-Hub-Signature': signature}))
+        self.assertFalse(webhook.check_signature('s3cret', body, {}))
+        self.assertFalse(webhook.check_signature(
+            's3cret', body, {'X-Webhook-Token': 's3creT'}))
+
+    @mock.patch('charmhelpers.canonical_ci.cron.read_status')
+    @mock.patch('charmhelpers.canonical_ci.cron.run_job')
+    def test_server(self, mock_run_job, mock_read_status):
+        mock_run_job.return_value = 0
+        mock_read_status.return_value = {'outcome': 'success'}
+        server = webhook.make_server(0, 'repo_update', 'true', 's3cret',
+                                     delay=0.05, address='127.0.0.1')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(server.debouncer.stop)
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+        request = urllib2.Request(url, data='{}',
+                                  headers={'X-Webhook-Token': 'wrong'})
+        exc = self.assertRaises(urllib2.HTTPError, urllib2.urlopen, request)
+        self.assertEqual(403, exc.code)
+
+        for _ in range(3):
+            request = urllib2.Request(url, data='{}',
+                                      headers={'X-Webhook-Token': 's3cret'})
+            self.assertEqual(202, urllib2.urlopen(request).getcode())
+        self._wait_for(lambda: mock_run_job.called)
+        time.sleep(0.1)
+        mock_run_job.assert_called_once_with('repo_update', 'true')
+
+        exc = self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                                url + 'status')
+        self.assertEqual(403, exc.code)
+        request = urllib2.Request(url + 'status',
+                                  headers={'X-Webhook-Token': 's3cret'})
+        self.assertEqual({'outcome': 'success'},
+                         json.load(urllib2.urlopen(request)))
+
+    @mock.patch('BaseHTTPServer.HTTPServer')
+    def test_server_without_secret_listens_on_localhost(self, mock_server):
+        server = webhook.make_server(8080, 'repo_update', 'true', '')
+        self.addCleanup(server.debouncer.stop)
+        mock_server.assert_called_with(('127.0.0.1', 8080),
+                                       webhook.WebhookHandler)
+
+        server = webhook.make_server(8080, 'repo_update', 'true', 's3cret')
+        self.addCleanup(server.debouncer.stop)
+        mock_server.assert_called_with(('', 8080), webhook.WebhookHandler)
+
+    @mock.patch('charmhelpers.canonical_ci.webhook.service_restart')
+    @mock.patch('charmhelpers.canonical_ci.cron.prepare_job')
+    @mock.patch('charmhelpers.canonical_ci.cron.user_ids')
+    @mock.patch('os.chown')
+    def test_install_writes_private_secret(self, mock_chown, mock_user_ids,
+                                           mock_prepare_job,
+                                           mock_service_restart):
+        mock_user_ids.return_value = (1000, 1000)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        secret_file = os.path.join(tmpdir, 'webhook-secret')
+        with mock.patch.multiple(webhook, SECRET_FILE=secret_file,
+                                 UPSTART_CONF=os.path.join(tmpdir, 'conf')):
+            with mock.patch.dict(os.environ, {'CHARM_DIR': '/charm'}):
+                webhook.install(8080, 'ci', 'repo_update', 'true', 's3cret')
+        self.assertEqual(0600, stat.S_IMODE(os.stat(secret_file).st_mode))
+        with open(secret_file) as f:
+            self.assertEqual('s3cret', f.read())
+        mock_service_restart.assert_called_with(webhook.SERVICE)
@@ -0,0 +1,182 @@
+import os
+import mock
+import testtools
+import tempfile
+import shutil
+import zuul
+
+LAYOUT = """pipelines:
+  - name: check
+    manager: IndependentPipelineManager
+
+projects:
+  - name: example/project
+    check:
+      - example-unit
+"""
+
+
+class ZuulTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ZuulTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_dir = os.path.join(self.tmpdir, 'zuul')
+        os.mkdir(self.config_dir)
+        self.layout = os.path.join(self.tmpdir, 'layout.yaml')
+        for name, value in [('ZUUL_CONFIG_DIR', self.config_dir),
+                            ('ZUUL_LAYOUT', self.layout),
+                            ('log', mock.Mock()),
+                            ('relation_ids', mock.Mock(return_value=['z:1'])),
+                            ('related_units',
+                             mock.Mock(return_value=['zuul/0']))]:
+            patcher = mock.patch.object(zuul, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(ZuulTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, content):
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    @mock.patch('zuul.start_zuul')
+    @mock.patch('zuul.stop_zuul')
+    @mock.patch('zuul.reload_zuul')
+    @mock.patch('zuul.validate_layout')
+    def test_update_zuul_reloads(self, mock_validate, mock_reload,
+                                 mock_stop, mock_start):
+        self._write(os.path.join(self.config_dir, 'layout.yml'), LAYOUT)
+        mock_validate.return_value = True
+        mock_reload.return_value = True
+        self.assertTrue(zuul.update_zuul())
+        with open(self.layout) as fd:
+            self.assertEqual(LAYOUT, fd.read())
+        self.assertTrue(mock_reload.called)
+        self.assertFalse(mock_stop.called)
+        self.assertFalse(mock_start.called)
+
+        # Nothing to do once the layout is installed.
+        mock_reload.reset_mock()
+        self.assertIsNone(zuul.update_zuul())
+        self.assertFalse(mock_reload.called)
+
+    @mock.patch('zuul.start_zuul')
+    @mock.patch('zuul.stop_zuul')
+    @mock.patch('zuul.reload_zuul')
+    @mock.patch('zuul.validate_layout')
+    def test_update_zuul_restarts_if_reload_fails(self, mock_validate,
+                                                  mock_reload, mock_stop,
+                                                  mock_start):
+        self._write(os.path.join(self.config_dir, 'layout.yml'), LAYOUT)
+        mock_validate.return_value = True
+        mock_reload.return_value = False
+        self.assertTrue(zuul.update_zuul())
+        self.assertTrue(mock_stop.called)
+        self.assertTrue(mock_start.called)
+
+    @mock.patch('zuul.reload_zuul')
+    @mock.patch('distutils.spawn.find_executable')
+    def test_update_zuul_skips_invalid_layout(self, mock_find_executable,
+                                              mock_reload):
+        mock_find_executable.return_value = None
+        self._write(os.path.join(self.config_dir, 'layout.yml'),
+                    'pipelines: [\n')
+        self._write(self.layout, LAYOUT)
+        self.assertFalse(zuul.update_zuul())
+        with open(self.layout) as fd:
+            self.assertEqual(LAYOUT, fd.read())
+        self.assertFalse(mock_reload.called)
+
+    @mock.patch('zuul.reload_zuul')
+    @mock.patch('zuul.validate_layout')
+    def test_update_zuul_skips_cosmetic_changes(self, mock_validate,
+                                                mock_reload):
+        self._write(os.path.join(self.config_dir, 'layout.yml'),
+                    '# comment\n' + LAYOUT)
+        self._write(self.layout, LAYOUT)
+        mock_validate.return_value = True
+        self.assertIsNone(zuul.update_zuul())
+        with open(self.layout) as fd:
+            self.assertEqual('# comment\n' + LAYOUT, fd.read())
+        self.assertFalse(mock_reload.called)
+
+        # The installed layout now matches, so it is not even parsed again.
+        mock_validate.reset_mock()
+        self.assertIsNone(zuul.update_zuul())
+        self.assertFalse(mock_validate.called)
+
+    @mock.patch('zuul.reload_zuul')
+    @mock.patch('zuul.validate_layout')
+    def test_update_zuul_installs_unnamed_changes(self, mock_validate,
+                                                  mock_reload):
+        changed = 'includes:\n  - python-file: openstack_functions.py\n'
+        self._write(os.path.join(self.config_dir, 'layout.yml'),
+                    changed + LAYOUT)
+        self._write(self.layout, LAYOUT)
+        mock_validate.return_value = True
+        mock_reload.return_value = True
+        self.assertTrue(zuul.update_zuul())
+        with open(self.layout) as fd:
+            self.assertEqual(changed + LAYOUT, fd.read())
+        self.assertTrue(mock_reload.called)
+
+    def test_check_layout(self):
+        layout = {
+            'pipelines': [{'name': 'check'}, {'name': 'gate'}],
+            'project-templates': [{'name': 'python',
+                                   'check': ['{name}-pep8']}],
+            'projects': [
+                {'name': 'example/project',
+                 'template': [{'name': 'python'}],
+                 'check': ['example-unit', {'example-docs': ['publish']}],
+                 'post': ['noop']},
+                {'name': 'example/other',
+                 'template': [{'name': 'unknown'}]}]}
+        self.assertEqual(sorted([
+            'project example/project: unknown pipeline post',
+            'project example/other: unknown template unknown']),
+            sorted(zuul.check_layout(layout)))
+        self.assertEqual(sorted([
+            'project example/project: job project-pep8 not defined in '
+            'jenkins',
+            'project example/project: job publish not defined in jenkins',
+            'project example/project: unknown pipeline post',
+            'project example/other: unknown template unknown']),
+            sorted(zuul.check_layout(layout, set(['example-unit',
+                                                  'example-docs']))))
+        self.assertEqual(['no pipelines defined'],
+                         zuul.check_layout({'projects': []}))
+
+    def test_check_layout_project_keys(self):
+        layout = {
+            'pipelines': [{'name': 'check'}],
+            'project-templates': [{'name': 'flavored',
+                                   'check': ['gate-{name}-{flavor}']}],
+            'projects': [
+                {'name': 'openstack/nova', 'merge-mode': 'cherry-pick',
+                 'check': ['nova-unit']},
+                {'name': 'openstack/glance',
+                 'template': [{'name': 'flavored', 'flavor': 'py27'}]}]}
+        self.assertEqual([], zuul.check_layout(layout))
+
+        # A template parameter the project doesn't pass is a layout error.
+        del layout['projects'][1]['template'][0]['flavor']
+        self.assertEqual(['project openstack/glance: cannot expand job '
+                          'gate-{name}-{flavor} of template flavored'],
+                         zuul.check_layout(layout))
+
+    def test_diff_layouts(self):
+        old = {'pipelines': [{'name': 'check'}, {'name': 'gate'}],
+               'projects': [{'name': 'a', 'check': ['a-unit']}]}
+        new = {'pipelines': [{'name': 'check'}, {'name': 'post'}],
+               'projects': [{'name': 'a', 'check': ['a-unit', 'a-docs']}]}
+        self.assertEqual(['pipelines: - gate', 'pipelines: + post',
+                          'projects: ~ a'], zuul.diff_layouts(old, new))
+        new['includes'] = [{'python-file': 'functions.py'}]
+        self.assertEqual(['pipelines: - gate', 'pipelines: + post',
+                          'projects: ~ a', '~ includes'],
+                         zuul.diff_layouts(old, new))
+        self.assertEqual([], zuul.diff_layouts(new, new))